@@ -1,14 +1,25 @@
 import re
 import os
+import gzip
+import json
 import sqlite3
-from collections import defaultdict
+import concurrent.futures
 from datetime import datetime, timedelta
 from contextlib import contextmanager
+from pathlib import Path
 
 # 数据库路径配置
 DB_PATH = r'F:\Pic\Gelbooru\new\gelbooru_metadata.db'
-# 日志保留天数（删除多少天前的日志记录）
+# 日志路径前缀（taglog1.txt ~ taglog6.txt 及其归档段 taglog1.2024-05-01_2024-05-07.txt.gz）
+LOG_PREFIX = r'F:\Pic\Gelbooru\new\taglog'
+# 日志保留天数（整段删除末日早于此天数的归档段）
 DEL_DAYS = 60
+# 归档段文件名格式（由 core.rotate_log 生成）
+SEGMENT_PATTERN = re.compile(r'\.(\d{4}-\d{2}-\d{2})_(\d{4}-\d{2}-\d{2})(?:\.\d+)?\.txt\.gz$')
+# 增量分析状态（每个文件的解析位置 + 已汇总的每日统计）
+STATE_PATH = LOG_PREFIX + '_state.json'
+# 待解析字节数超过此值且文件多于一个时才启用进程池
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
 
 def parse_size(size_str):
     size_str = size_str.strip()
@@ -30,14 +41,19 @@ def format_size(size):
         return f"{size/1024:.2f} KB"
 
 @contextmanager
-def get_db_cursor(db_path=DB_PATH):
-    """获取数据库游标的上下文管理器"""
-    conn = sqlite3.connect(db_path, timeout=30.0)
+def get_db_cursor(db_path=None):
+    """
+    获取只读数据库游标的上下文管理器
+    
+    mode=ro + query_only：统计只读，不拿写锁，库不存在时也不会新建空库
+    """
+    uri = Path(os.path.abspath(db_path or DB_PATH)).as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, timeout=30.0)
     conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA query_only=ON')
     cursor = conn.cursor()
     try:
         yield cursor
-        conn.commit()
     finally:
         cursor.close()
         conn.close()
@@ -48,40 +64,33 @@ def analyze_from_db(days=60):
         print(f"数据库文件不存在: {DB_PATH}")
         return
     
-    # 先清理所有日志文件（删除DEL_DAYS天前的记录）
+    # 先清理过期的日志归档段（只删文件，不改写日志）
     for i in range(1, 7):
-        log_file = f'F:\\Pic\\Gelbooru\\new\\taglog{i}.txt'
-        if os.path.exists(log_file):
-            delete_log(log_file, DEL_DAYS)
+        prune_segments(f'{LOG_PREFIX}{i}.txt', DEL_DAYS)
     
     cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
     
     with get_db_cursor() as cursor:
-        # 按日期统计
+        # 只读汇总表（由主程序的触发器增量维护），不扫描 pictures
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name='daily_rollup'")
+        if cursor.fetchone() is None:
+            print("数据库中没有每日统计汇总表，请先运行: python main.py 9 rollup")
+            return
+        
         cursor.execute("""
             SELECT 
-                DATE(download_time) as download_date,
-                COUNT(DISTINCT tag_name) as tag_count,
-                COUNT(*) as file_count,
-                SUM(file_size) as total_size
-            FROM pictures
-            WHERE DATE(download_time) >= ?
-            GROUP BY DATE(download_time)
-            ORDER BY download_time
+                day as download_date,
+                queried as queried_count,
+                tags as tag_count,
+                files as file_count,
+                bytes as total_size
+            FROM daily_rollup
+            WHERE day >= ? AND files > 0
+            ORDER BY day
         """, (cutoff_date,))
         
         results = cursor.fetchall()
         
-        # 获取每日查询tag数
-        cursor.execute("""
-            SELECT query_date, queried_count
-            FROM daily_query_stats
-            WHERE query_date >= ?
-            ORDER BY query_date
-        """, (cutoff_date,))
-        
-        query_stats = {row['query_date']: row['queried_count'] for row in cursor.fetchall()}
-        
         if not results:
             print("没有找到符合条件的记录")
             return
@@ -91,7 +100,7 @@ def analyze_from_db(days=60):
         
         for row in results:
             date = row['download_date']
-            queried_count = query_stats.get(date, 0)
+            queried_count = row['queried_count']
             tag_count = row['tag_count']
             file_count = row['file_count']
             total_size = row['total_size'] or 0
@@ -109,49 +118,91 @@ def analyze_from_db(days=60):
         if grand_total_files:
             print(f"Avg size   : {format_size(grand_total_size / grand_total_files)}")
 
-def merge_stats(stats1, stats2):
-    """合并两个统计结果"""
-    merged_tags = defaultdict(set)
-    merged_downloads = defaultdict(lambda: defaultdict(list))
-    
-    # 合并tags
-    for date in set(list(stats1[0].keys()) + list(stats2[0].keys())):
-        merged_tags[date] = stats1[0][date].union(stats2[0][date])
-    
-    # 合并downloads
-    for date in set(list(stats1[1].keys()) + list(stats2[1].keys())):
-        for tag in set(list(stats1[1][date].keys()) + list(stats2[1][date].keys())):
-            merged_downloads[date][tag].extend(stats1[1][date][tag])
-            merged_downloads[date][tag].extend(stats2[1][date][tag])
-    
-    return merged_tags, merged_downloads
+def log_segments(path):
+    """列出活动日志对应的归档段 [(段路径, 首日, 末日)]，按日期升序"""
+    folder, name = os.path.split(path)
+    stem = os.path.splitext(name)[0]
+    segments = []
+    try:
+        names = os.listdir(folder or '.')
+    except FileNotFoundError:
+        return []
+    for entry in names:
+        match = SEGMENT_PATTERN.search(entry)
+        if match and entry[:match.start()] == stem:
+            segments.append((os.path.join(folder, entry), match.group(1), match.group(2)))
+    segments.sort(key=lambda seg: (seg[1], seg[2], seg[0]))
+    return segments
+
+def prune_segments(path, delete_days=60):
+    """删除末日早于 delete_days 天前的归档段（每段一次 unlink）"""
+    cutoff = (datetime.now() - timedelta(days=delete_days)).strftime('%Y-%m-%d')
+    removed = 0
+    for seg_path, _, last_day in log_segments(path):
+        if last_day < cutoff:
+            try:
+                os.remove(seg_path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def open_log(path):
+    """以二进制打开日志文件（.gz 归档段透明解压），便于按字节位置续读"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def read_head(path):
+    """读取日志首行，用来识别文件是否被替换/轮转"""
+    try:
+        with open_log(path) as f:
+            return f.readline(256).decode('utf-8', 'replace').strip()
+    except (OSError, EOFError):
+        return ''
 
-def check_log(path):
-    """从日志文件解析统计（支持Mode 1/2/3格式）"""
-    daily_tags = defaultdict(set)
-    daily_downloads = defaultdict(lambda: defaultdict(list))
-    current_tag = None
-    prev_line_was_tag = False
+# 预编译正则表达式（提高性能）
+# Mode 1/2: i/total(page/endpage) tag file_counter date time filename size
+MODE12_PATTERN = re.compile(
+    r'(\d+/\d+\(\d+/\d+\))\s+(\S+)\s+\d+\s+([\d-]+)\s+[\d:]+\s+\S+\s+([\d.]+\s*(?:Kb|Mb|Gb))'
+)
+# Mode 3: tag(offset) file_counter date time filename size
+MODE3_PATTERN = re.compile(
+    r'([^()]+)\((\d+)\)\s+\d+\s+([\d-]+)\s+[\d:]+\s+\S+\s+([\d.]+\s*(?:Kb|Mb|Gb))'
+)
+# Tag行: Tag(xxx): number tag_name
+TAG_PATTERN = re.compile(r'Tag\([^)]*\):\s*\d+\s+(.+)')
+# 跳过的关键字（合并判断提高效率）
+SKIP_KEYWORDS = ('start', 'end', 'total size', 'total time', 'total download')
 
-    # 预编译正则表达式（提高性能）
-    # Mode 1/2: i/total(page/endpage) tag file_counter date time filename size
-    mode12_pattern = re.compile(
-        r'(\d+/\d+\(\d+/\d+\))\s+(\S+)\s+\d+\s+([\d-]+)\s+[\d:]+\s+\S+\s+([\d.]+\s*(?:Kb|Mb|Gb))'
-    )
-    # Mode 3: tag(offset) file_counter date time filename size
-    mode3_pattern = re.compile(
-        r'([^()]+)\((\d+)\)\s+\d+\s+([\d-]+)\s+[\d:]+\s+\S+\s+([\d.]+\s*(?:Kb|Mb|Gb))'
-    )
-    # Tag行: Tag(xxx): number tag_name
-    tag_pattern = re.compile(r'Tag\([^)]*\):\s*\d+\s+(.+)')
+def check_log(path, offset=0, current_tag=None, prev_line_was_tag=False):
+    """
+    从 offset 字节处解析日志（支持Mode 1/2/3格式）
+    
+    只消费完整的行，末尾未写完的半行留给下次。current_tag / prev_line_was_tag
+    是跨行的解析状态，续读时由检查点传入。
     
-    # 跳过的关键字（合并判断提高效率）
-    skip_keywords = ('start', 'end', 'total size', 'total time', 'total download')
+    Returns:
+        (daily, 新offset, current_tag, prev_line_was_tag)
+        daily: {date: [文件数, 总字节数, tag集合]}
+    """
+    daily = {}
+
+    def day_of(date):
+        stats = daily.get(date)
+        if stats is None:
+            stats = daily[date] = [0, 0, set()]
+        return stats
 
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
+        with open_log(path) as f:
+            if offset:
+                f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                offset += len(raw)
+                line = raw.decode('utf-8', 'replace').strip()
                 if not line:
                     continue
 
@@ -167,111 +218,174 @@ def check_log(path):
 
                 # 跳过特定行
                 content_lower = content.lower()
-                if any(kw in content_lower for kw in skip_keywords):
+                if any(kw in content_lower for kw in SKIP_KEYWORDS):
                     continue
 
                 # 匹配Tag行
-                tag_match = tag_pattern.search(content)
+                tag_match = TAG_PATTERN.search(content)
                 if tag_match:
                     if prev_line_was_tag and current_tag:
-                        daily_tags[log_date].add(current_tag)
+                        day_of(log_date)[2].add(current_tag)
                     current_tag = tag_match.group(1).strip()
                     prev_line_was_tag = True
                     continue
 
                 # 匹配下载行
-                m12 = mode12_pattern.search(content)
+                m12 = MODE12_PATTERN.search(content)
                 if m12:
-                    tag_name = m12.group(2)
-                    size = parse_size(m12.group(4))
-                    daily_downloads[log_date][tag_name].append(size)
-                    daily_tags[log_date].add(tag_name)
+                    stats = day_of(log_date)
+                    stats[0] += 1
+                    stats[1] += parse_size(m12.group(4))
+                    stats[2].add(m12.group(2))
                     prev_line_was_tag = False
                     continue
                 
-                m3 = mode3_pattern.search(content)
+                m3 = MODE3_PATTERN.search(content)
                 if m3:
-                    tag_name = m3.group(1).strip()
-                    size = parse_size(m3.group(4))
-                    daily_downloads[log_date][tag_name].append(size)
-                    daily_tags[log_date].add(tag_name)
+                    stats = day_of(log_date)
+                    stats[0] += 1
+                    stats[1] += parse_size(m3.group(4))
+                    stats[2].add(m3.group(1).strip())
                     prev_line_was_tag = False
                     continue
 
                 # count行标记tag结束
                 if 'count:' in content_lower and current_tag:
-                    daily_tags[log_date].add(current_tag)
+                    day_of(log_date)[2].add(current_tag)
                     prev_line_was_tag = False
     
-    except FileNotFoundError:
+    except (FileNotFoundError, EOFError):
         pass
                 
-    return daily_tags, daily_downloads
+    return daily, offset, current_tag, prev_line_was_tag
+
+def _parse_job(job):
+    """进程池任务：从检查点续读一个文件"""
+    key, path, checkpoint = job
+    return key, check_log(path, checkpoint['offset'], checkpoint['tag'], checkpoint['prev_tag'])
 
-def print_stats(daily_tags, daily_downloads):
+def merge_stats(merged, daily):
+    """把一个文件的每日计数并入总计数"""
+    for date, (files, size, tags) in daily.items():
+        stats = merged.get(date)
+        if stats is None:
+            merged[date] = [files, size, set(tags)]
+        else:
+            stats[0] += files
+            stats[1] += size
+            stats[2].update(tags)
+
+def print_stats(daily):
     """打印统计结果"""
-    if not daily_tags:
+    if not daily:
         print("没有数据")
         return
     
-    for date in sorted(daily_tags.keys()):
-        tag_count = len(daily_tags[date])
-        total_files = sum(len(sizes) for sizes in daily_downloads[date].values())
-        total_size = sum(sum(sizes) for sizes in daily_downloads[date].values())
+    for date in sorted(daily.keys()):
+        total_files, total_size, tags = daily[date]
         avg_size = total_size / total_files if total_files else 0
         
-        print(f"{date}: {tag_count} | {total_files} | {format_size(total_size)} | {format_size(avg_size)}")
+        print(f"{date}: {len(tags)} | {total_files} | {format_size(total_size)} | {format_size(avg_size)}")
+
+def load_state():
+    """读取增量分析状态：{'files': {文件名: 检查点}, 'daily': {date: [文件数, 字节, tag集合]}}"""
+    try:
+        with open(STATE_PATH, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        daily = {date: [files, size, set(tags)] for date, (files, size, tags) in state['daily'].items()}
+        return state['files'], daily
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return {}, {}
+
+def save_state(files, daily):
+    """原子写回增量分析状态"""
+    state = {
+        'files': files,
+        'daily': {date: [n, size, sorted(tags)] for date, (n, size, tags) in daily.items()},
+    }
+    tmp_path = STATE_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, STATE_PATH)
+
+def _new_checkpoint(head, inode=None):
+    return {'inode': inode, 'head': head, 'offset': 0, 'tag': None, 'prev_tag': False, 'done': False}
 
 def analyze_all_logs():
-    """分析所有日志文件并合并结果"""
-    merged_tags = defaultdict(set)
-    merged_downloads = defaultdict(lambda: defaultdict(list))
+    """
+    增量分析所有日志文件（含 gzip 归档段）
+    
+    每个文件记录检查点（活动日志按 inode + 首行识别，归档段按文件名），只解析
+    上次之后新追加的字节，结果并入持久化的每日计数。活动日志被轮转成归档段时，
+    归档段按首行认领原检查点，从原位置继续，不会重复计数。
+    """
+    files, daily = load_state()
+    since = (datetime.now() - timedelta(days=DEL_DAYS)).strftime('%Y-%m-%d')
+    jobs = []
+    pending_bytes = 0
+    seen = set()
     
-    # 处理所有日志文件（taglog1.txt ~ taglog6.txt）
     for i in range(1, 7):
-        log_file = f'F:\\Pic\\Gelbooru\\new\\taglog{i}.txt'
-        if os.path.exists(log_file):
-            delete_log(log_file, DEL_DAYS)  # 删除DEL_DAYS天前的记录
-            daily_tags, daily_downloads = check_log(log_file)
-            merged_tags, merged_downloads = merge_stats(
-                (merged_tags, merged_downloads), 
-                (daily_tags, daily_downloads)
-            )
+        log_file = f'{LOG_PREFIX}{i}.txt'
+        prune_segments(log_file, DEL_DAYS)  # 整段删除DEL_DAYS天前的归档
+        
+        # 活动日志：inode / 首行变了或文件变短，说明已被轮转，检查点留给归档段认领
+        orphans = {}
+        key = os.path.basename(log_file)
+        checkpoint = files.pop(key, None)
+        try:
+            st = os.stat(log_file)
+        except FileNotFoundError:
+            st = None
+        if checkpoint and (st is None or checkpoint['inode'] != st.st_ino
+                           or st.st_size < checkpoint['offset'] or checkpoint['head'] != read_head(log_file)):
+            orphans[checkpoint['head']] = checkpoint
+            checkpoint = None
+        
+        for seg_path, _, _ in log_segments(log_file):
+            seg_key = os.path.basename(seg_path)
+            seen.add(seg_key)
+            seg_checkpoint = files.get(seg_key)
+            if seg_checkpoint is None:
+                head = read_head(seg_path)
+                seg_checkpoint = orphans.pop(head, None) or _new_checkpoint(head)
+                files[seg_key] = seg_checkpoint
+            if not seg_checkpoint['done']:
+                jobs.append((seg_key, seg_path, seg_checkpoint))
+                pending_bytes += os.path.getsize(seg_path)
+        
+        if st is not None:
+            if checkpoint is None:
+                checkpoint = _new_checkpoint(read_head(log_file), st.st_ino)
+            files[key] = checkpoint
+            seen.add(key)
+            if st.st_size > checkpoint['offset']:
+                jobs.append((key, log_file, checkpoint))
+                pending_bytes += st.st_size - checkpoint['offset']
     
-    print_stats(merged_tags, merged_downloads)
-
-def delete_log(path, delete_days=60):
-    """删除指定天数之前的日志记录"""
-    cutoff = datetime.now() - timedelta(days=delete_days)
+    # 已删除的归档段不再保留检查点
+    for key in [k for k in files if k not in seen]:
+        del files[key]
     
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        return
+    if len(jobs) > 1 and pending_bytes >= PARALLEL_MIN_BYTES:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+            results = list(executor.map(_parse_job, jobs))
+    else:
+        results = [_parse_job(job) for job in jobs]
     
-    kept_lines = []
-    for line in lines:
-        line_stripped = line.strip()
-        if not line_stripped:
-            continue
-        
-        # 检查行格式: "YYYY-MM-DD HH:MM:SS | content"
-        parts = line_stripped.split(' | ', 1)
-        if len(parts) != 2 or len(parts[0]) != 19:
-            continue
-        
-        try:
-            line_dt = datetime.strptime(parts[0], '%Y-%m-%d %H:%M:%S')
-            if line_dt >= cutoff:
-                kept_lines.append(line)
-        except ValueError:
-            # 保留无法解析的行
-            kept_lines.append(line)
+    for key, (part, offset, current_tag, prev_tag) in results:
+        checkpoint = files[key]
+        checkpoint.update(offset=offset, tag=current_tag, prev_tag=prev_tag)
+        if key.endswith('.gz'):
+            checkpoint['done'] = True
+        merge_stats(daily, part)
+    
+    # 只保留DEL_DAYS天内的每日计数
+    for date in [d for d in daily if d < since]:
+        del daily[date]
     
-    # 写回文件
-    with open(path, 'w', encoding='utf-8') as f:
-        f.writelines(kept_lines)
+    save_state(files, daily)
+    print_stats(daily)
 
 if __name__ == '__main__':
     import sys
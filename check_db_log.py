@@ -7,43 +7,243 @@
 功能:
     1. 根据tag查询该tag下所有图片
     2. 根据图片ID查询tag名字
-    3. 根据tags搜索图片
+    3. 根据tags搜索图片（精确匹配，支持全部匹配/排除）
     4. 自定义SQL查询
     5. 显示所有表名
+    6. 输入tag时下拉补全（tag 文件夹名和图片标签，数据库变化时自动更新）
+    
+    查询在后台线程执行，窗口不会卡住；结果显示在虚拟表格中，只取出并插入可见的行，
+    点击列标题在 SQL 中排序，选中一行在下方显示完整记录；
+    状态栏显示耗时/已取行数/已执行步数，"取消"按钮可中断正在执行的查询
 
 说明:
     这是一个独立的数据库查询工具，不依赖项目的其他模块
     只需要访问数据库文件即可运行
+    连接都是只读的（mode=ro + query_only），自定义SQL不能写库；
+    "快照"按钮用备份 API 复制一份一致的快照并改连快照，长查询不会拖住下载程序的写入和 WAL 检查点
 """
 
 import os
+import time
+import queue
 import sqlite3
+import threading
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
+from tkinter import ttk, scrolledtext, messagebox, font as tkfont
+from bisect import bisect_left
+from collections import OrderedDict
 from contextlib import contextmanager
-from typing import List, Dict, Optional
+from pathlib import Path
+from typing import List, Optional
 
 
 # ==================== 独立的数据库管理器 ====================
 
+def connect_readonly(db_path: str) -> sqlite3.Connection:
+    """只读连接（mode=ro + query_only）：自定义SQL也拿不到写锁，不会影响下载写入"""
+    uri = Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False, timeout=30.0)
+    conn.execute('PRAGMA query_only=ON')
+    return conn
+
+
+def _quote(name: str) -> str:
+    """SQL 标识符加引号"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _sort_key(value):
+    """与 sqlite 一致的排序键：NULL < 数字 < 文本 < BLOB"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, bytes(value))
+
+
+class ResultSet:
+    """
+    可随机访问的查询结果（虚拟表格的数据源）
+    
+    总数来自 COUNT，行按页取出，只缓存最近 CACHE_PAGES 页；排序在 SQL 中完成。
+    有唯一键(key)时，顺序翻页用上一页末行做键集定位，跳页时才用 OFFSET。
+    不能作为子查询的语句（PRAGMA 等）的结果直接放在 rows 中。
+    """
+    
+    PAGE_SIZE = 200
+    CACHE_PAGES = 16
+    
+    def __init__(self, db, source: str = '', where: str = '1', params=(), columns=(), total: int = 0,
+                 key: Optional[str] = None, order: Optional[int] = None, descending: bool = False,
+                 rows: Optional[list] = None):
+        self.db = db
+        self.source = source
+        self.where = where
+        self.params = list(params)
+        self.columns = list(columns)
+        self.total = total
+        self.key = key
+        self.order = order  # 排序列下标，None=默认顺序（有 key 时按 key 升序）
+        self.descending = descending
+        self._static = rows
+        self._pages = OrderedDict()  # 页号 -> 行
+        self._anchors = {}  # 页号 -> 该页末行的 (排序值, 键值)
+    
+    def __len__(self):
+        return self.total
+    
+    def sorted(self, order: int, descending: bool = False) -> 'ResultSet':
+        """按第 order 列排序的新结果（总数不变，不重新 COUNT）"""
+        if self._static is not None:
+            rows = sorted(self._static, key=lambda row: _sort_key(row[order]), reverse=descending)
+            return ResultSet(self.db, columns=self.columns, total=self.total, order=order,
+                             descending=descending, rows=rows)
+        return ResultSet(self.db, self.source, self.where, self.params, self.columns, self.total,
+                         self.key, order, descending)
+    
+    def is_cached(self, start: int, count: int) -> bool:
+        """[start, start+count) 的行是否都已在缓存中"""
+        if self._static is not None:
+            return True
+        end = min(start + count, self.total)
+        return all(n in self._pages for n in range(start // self.PAGE_SIZE, (end - 1) // self.PAGE_SIZE + 1))
+    
+    def rows(self, start: int, count: int) -> list:
+        """取第 start 行起的 count 行"""
+        end = min(start + count, self.total)
+        if start >= end:
+            return []
+        if self._static is not None:
+            return self._static[start:end]
+        out = []
+        for n in range(start // self.PAGE_SIZE, (end - 1) // self.PAGE_SIZE + 1):
+            base = n * self.PAGE_SIZE
+            out.extend(self._page(n)[max(start - base, 0):end - base])
+        return out
+    
+    def _page(self, n: int) -> list:
+        """取第 n 页（LRU 缓存）"""
+        rows = self._pages.get(n)
+        if rows is not None:
+            self._pages.move_to_end(n)
+            return rows
+        rows = self._query(n)
+        self._pages[n] = rows
+        if self.key and rows:
+            last = rows[-1]
+            self._anchors[n] = (None if self.order is None else last[self.order], last[self.key])
+        while len(self._pages) > self.CACHE_PAGES:
+            self._pages.popitem(last=False)
+        return rows
+    
+    def _query(self, n: int) -> list:
+        """从数据库取第 n 页"""
+        where, params = self.where, list(self.params)
+        anchor = self._anchors.get(n - 1)
+        offset = 0
+        if anchor is not None:
+            seek, seek_params = self._seek(*anchor)
+            where = f'({where}) AND {seek}'
+            params.extend(seek_params)
+        else:
+            offset = n * self.PAGE_SIZE
+        
+        order_by = self._order_by()
+        query = f'SELECT * FROM {self.source} WHERE {where}{order_by} LIMIT ? OFFSET ?'
+        if offset and self.key:
+            # 跳页：OFFSET 只在键上跳过，再按键取整行，避免为跳过的行生成完整列
+            key = _quote(self.key)
+            query = (f'SELECT * FROM {self.source} WHERE {key} IN '
+                     f'(SELECT {key} FROM {self.source} WHERE {where}{order_by} LIMIT ? OFFSET ?){order_by}')
+        with self.db.get_cursor() as cursor:
+            cursor.execute(query, params + [self.PAGE_SIZE, offset])
+            rows = cursor.fetchall()
+        self.db.rows_fetched += len(rows)
+        return rows
+    
+    def _order_by(self) -> str:
+        direction = ' DESC' if self.descending else ''
+        if self.order is None:
+            return f' ORDER BY {_quote(self.key)}' if self.key else ''
+        if not self.key:
+            return f' ORDER BY {self.order + 1}{direction}'
+        return f' ORDER BY {_quote(self.columns[self.order])}{direction}, {_quote(self.key)}{direction}'
+    
+    def _seek(self, value, key_value) -> tuple:
+        """键集定位条件：排在 (value, key_value) 之后的行（NULL 排最前，与 sqlite 一致）"""
+        k = _quote(self.key)
+        if self.order is None:
+            return f'{k} > ?', [key_value]
+        c = _quote(self.columns[self.order])
+        if not self.descending:
+            if value is None:
+                return f'({c} IS NOT NULL OR {k} > ?)', [key_value]
+            return f'({c} > ? OR ({c} = ? AND {k} > ?))', [value, value, key_value]
+        if value is None:
+            return f'({c} IS NULL AND {k} < ?)', [key_value]
+        return f'({c} < ? OR ({c} = ? AND {k} < ?) OR {c} IS NULL)', [value, value, key_value]
+
+
 class DatabaseManager:
     """数据库管理器（非单例，支持动态切换路径）"""
     
+    # 每执行多少条虚拟机指令回调一次进度（用于取消和状态显示）
+    PROGRESS_STEPS = 10000
+    
     def __init__(self, db_path: str):
         self.db_path = db_path
         self._connection = None
+        self._cancel = threading.Event()
+        self.steps = 0  # 当前查询已执行的虚拟机指令数（按 PROGRESS_STEPS 计）
+        self.rows_fetched = 0  # 当前查询已取出的行数
     
     def _get_connection(self) -> sqlite3.Connection:
-        """获取数据库连接"""
+        """获取数据库连接（可在后台线程使用，同一时间只有一个查询）"""
         if self._connection is None:
-            self._connection = sqlite3.connect(
-                self.db_path,
-                check_same_thread=False,
-                timeout=30.0
-            )
+            self._connection = connect_readonly(self.db_path)
             self._connection.row_factory = sqlite3.Row
+            self._connection.set_progress_handler(self._on_progress, self.PROGRESS_STEPS)
         return self._connection
     
+    def _on_progress(self) -> int:
+        """sqlite 进度回调：返回非0时中断当前语句（OperationalError: interrupted）"""
+        self.steps += self.PROGRESS_STEPS
+        return 1 if self._cancel.is_set() else 0
+    
+    def begin_query(self):
+        """开始新的后台查询（清除取消标记和计数）"""
+        self._cancel.clear()
+        self.steps = 0
+        self.rows_fetched = 0
+    
+    def cancel(self):
+        """请求取消正在执行的查询"""
+        self._cancel.set()
+    
+    def snapshot(self, dest_path: str) -> str:
+        """
+        用备份 API 一步复制一致的快照（与 core.snapshot_database 相同）
+        
+        分步复制遇到其他连接提交就会从头重来，下载写库时可能永远完不成；一步复制在 WAL 下不阻塞写入。
+        复制中途无法取消，取消在复制完成后生效（丢弃临时文件）
+        """
+        tmp_path = dest_path + '.tmp'
+        target = sqlite3.connect(tmp_path)
+        try:
+            self._get_connection().backup(target, pages=-1)
+            if self._cancel.is_set():
+                raise sqlite3.OperationalError('interrupted')
+            target.execute('PRAGMA journal_mode=DELETE')
+        except BaseException:
+            target.close()
+            os.remove(tmp_path)
+            raise
+        target.close()
+        os.replace(tmp_path, dest_path)
+        return dest_path
+    
     def close(self):
         """关闭连接"""
         if self._connection:
@@ -70,36 +270,94 @@ class DatabaseManager:
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
             return [row[0] for row in cursor.fetchall()]
     
-    def get_pictures_by_tag(self, tag_name: str) -> List[Dict]:
-        """获取标签下的所有图片"""
+    def is_normalized(self) -> bool:
+        """是否为规范化结构（posts / tag_dict / post_tags + picture_view，由主程序迁移）"""
         with self.get_cursor() as cursor:
-            cursor.execute('SELECT * FROM pictures WHERE tag_name=? ORDER BY pic_time DESC', (tag_name,))
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name='picture_view'")
+            return cursor.fetchone() is not None
     
-    def get_tag_by_pic_id(self, pic_id: str) -> List[Dict]:
-        """根据图片ID查询tag信息"""
+    def _result_set(self, source: str, where: str = '1', params=(), **kwargs) -> ResultSet:
+        """建立 source 上的结果集：取列名并 COUNT 总数"""
         with self.get_cursor() as cursor:
-            cursor.execute('SELECT * FROM pictures WHERE pic_id=?', (pic_id,))
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.execute(f'SELECT * FROM {source} LIMIT 0')
+            columns = [desc[0] for desc in cursor.description]
+            cursor.execute(f'SELECT COUNT(*) FROM {source} WHERE {where}', list(params))
+            total = cursor.fetchone()[0]
+        return ResultSet(self, source, where, params, columns, total, **kwargs)
     
-    def get_tag_by_filename(self, filename: str) -> List[Dict]:
+    def _select_pictures(self, where: str, params: list, by_time: bool = False) -> ResultSet:
+        """
+        按 pictures 表的列筛选，返回旧的行结构（默认按 pic_time 降序或 id 升序）
+        
+        新结构下先在 pictures 上用索引筛选 id，再从 picture_view 取完整行
+        """
+        if self.is_normalized():
+            result = self._result_set('picture_view', f'id IN (SELECT id FROM pictures WHERE {where})',
+                                      params, key='id')
+        else:
+            result = self._result_set('pictures', where, params, key='id')
+        if by_time:
+            return result.sorted(result.columns.index('pic_time'), descending=True)
+        return result
+    
+    def get_pictures_by_tag(self, tag_name: str) -> ResultSet:
+        """获取标签下的所有图片"""
+        return self._select_pictures('tag_name=?', [tag_name], by_time=True)
+    
+    def get_tag_by_pic_id(self, pic_id: str) -> ResultSet:
+        """根据图片ID查询tag信息"""
+        if self.is_normalized():
+            if not pic_id.isdigit():
+                return ResultSet(self, rows=[])
+            return self._select_pictures('pic_id=?', [int(pic_id)])
+        return self._select_pictures('pic_id=?', [pic_id])
+    
+    def get_tag_by_filename(self, filename: str) -> ResultSet:
         """根据文件名查询tag信息（支持带或不带扩展名）"""
-        with self.get_cursor() as cursor:
-            # 如果输入不包含扩展名，使用LIKE模糊匹配
-            if '.' not in filename:
-                cursor.execute('SELECT * FROM pictures WHERE filename LIKE ?', (f'{filename}.%',))
-            else:
-                cursor.execute('SELECT * FROM pictures WHERE filename=?', (filename,))
-            return [dict(row) for row in cursor.fetchall()]
+        # 如果输入不包含扩展名，使用LIKE模糊匹配
+        if '.' not in filename:
+            return self._select_pictures('filename LIKE ?', [f'{filename}.%'])
+        return self._select_pictures('filename=?', [filename])
     
-    def search_pictures_by_tags(self, tags: List[str]) -> List[Dict]:
-        """根据标签搜索图片（任意匹配）"""
-        with self.get_cursor() as cursor:
-            conditions = ' OR '.join(['pic_tags LIKE ?' for _ in tags])
-            params = [f'%{tag}%' for tag in tags]
-            query = f'SELECT * FROM pictures WHERE {conditions} ORDER BY pic_time DESC'
-            cursor.execute(query, params)
-            return [dict(row) for row in cursor.fetchall()]
+    def search_pictures_by_tags(self, tags: List[str], match_all: bool = False,
+                                exclude: Optional[List[str]] = None) -> ResultSet:
+        """
+        根据标签搜索图片（精确匹配整个tag，cat 不会匹配 catgirl）
+        
+        - 新结构：用 post_tags(tag_id, post_id) 索引
+        - 旧结构：instr 精确匹配（全表扫描）
+        """
+        exclude = exclude or []
+        if self.is_normalized():
+            posts_with = ('SELECT pt.post_id FROM post_tags pt JOIN tag_dict d ON d.id = pt.tag_id '
+                          'WHERE d.tag IN ({})')
+            clauses = []
+            params = []
+            if tags:
+                tags = list(dict.fromkeys(tags))
+                subquery = posts_with.format(','.join('?' * len(tags)))
+                if match_all:
+                    clauses.append(f'pic_id IN ({subquery} GROUP BY pt.post_id HAVING COUNT(DISTINCT pt.tag_id) = ?)')
+                    params.extend(tags + [len(tags)])
+                else:
+                    clauses.append(f'pic_id IN ({subquery})')
+                    params.extend(tags)
+            if exclude:
+                clauses.append(f'pic_id NOT IN ({posts_with.format(",".join("?" * len(exclude)))})')
+                params.extend(exclude)
+            return self._select_pictures(' AND '.join(clauses) or '1', params, by_time=True)
+        
+        exact = "instr(' ' || COALESCE(pic_tags, '') || ' ', ' ' || ? || ' ') > 0"
+        joiner = ' AND ' if match_all else ' OR '
+        clauses = []
+        params = []
+        if tags:
+            clauses.append('(' + joiner.join([exact] * len(tags)) + ')')
+            params.extend(tags)
+        for tag in exclude:
+            clauses.append(exact.replace('> 0', '= 0'))
+            params.append(tag)
+        return self._select_pictures(' AND '.join(clauses) or '1', params, by_time=True)
     
     def get_all_tags(self) -> List[str]:
         """获取所有唯一的tag_name"""
@@ -107,19 +365,185 @@ class DatabaseManager:
             cursor.execute('SELECT DISTINCT tag_name FROM pictures ORDER BY tag_name')
             return [row[0] for row in cursor.fetchall()]
     
-    def execute_sql(self, sql: str) -> tuple:
-        """执行自定义SQL，返回(columns, rows)"""
+    def execute_sql(self, sql: str) -> Optional[ResultSet]:
+        """
+        执行自定义SQL，有返回数据时返回结果集，否则返回 None
+        
+        SELECT 语句包成子查询，和其他查询一样分页、排序；其他语句直接执行
+        """
+        statement = sql.strip().rstrip(';')
+        try:
+            return self._result_set(f'({statement})')
+        except sqlite3.OperationalError as e:
+            if 'interrupted' in str(e):
+                raise
+        
         with self.get_cursor() as cursor:
             cursor.execute(sql)
-            if cursor.description:
-                columns = [desc[0] for desc in cursor.description]
-                rows = [dict(row) for row in cursor.fetchall()]
-                return columns, rows
-            return [], []
+            if not cursor.description:
+                return None
+            columns = [desc[0] for desc in cursor.description]
+            rows = cursor.fetchall()
+        self.rows_fetched = len(rows)
+        return ResultSet(self, columns=columns, total=len(rows), rows=rows)
+
+
+class TagIndex:
+    """
+    tag 前缀补全索引（排序数组 + bisect）
+    
+    收录 tag 文件夹名（pictures.tag_name）和图片标签（tag_dict 或 pic_tags 拆分），
+    在后台线程用独立连接构建；PRAGMA data_version 变化（其他连接写入过）时重建。
+    """
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.folders = []  # 排好序的 tag 文件夹名
+        self.tokens = []  # 排好序的全部 token（文件夹名 + 图片标签）
+        self.ready = False
+        self._version = None
+        self._thread = None
+        self._connection = None
+    
+    def _get_connection(self) -> sqlite3.Connection:
+        """索引专用连接（data_version 按连接计，必须固定用同一个）"""
+        if self._connection is None:
+            self._connection = connect_readonly(self.db_path)
+        return self._connection
+    
+    def close(self):
+        """关闭连接（构建中则等构建结束）"""
+        if self._thread is not None:
+            self._thread.join()
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+    
+    @property
+    def building(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def refresh(self) -> bool:
+        """数据库有变化时在后台重建，返回是否开始了重建（构建中不重复检查）"""
+        if self.building:
+            return False
+        version = self._get_connection().execute('PRAGMA data_version').fetchone()[0]
+        if version == self._version:
+            return False
+        self._version = version
+        self._thread = threading.Thread(target=self._build, daemon=True)
+        self._thread.start()
+        return True
+    
+    def _build(self):
+        """读取所有 tag 并排序（后台线程）"""
+        conn = self._get_connection()
+        try:
+            folders = {row[0] for row in conn.execute('SELECT DISTINCT tag_name FROM pictures') if row[0]}
+            tokens = set(folders)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE name='tag_dict'").fetchone():
+                tokens.update(row[0] for row in conn.execute('SELECT tag FROM tag_dict'))
+            else:
+                for (pic_tags,) in conn.execute('SELECT pic_tags FROM pictures WHERE pic_tags IS NOT NULL'):
+                    tokens.update(pic_tags.split())
+        except sqlite3.Error:
+            self._version = None  # 下次 refresh 重试
+            return
+        # 整体替换，读者不会看到构建到一半的列表
+        self.folders = sorted(folders)
+        self.tokens = sorted(tokens)
+        self.ready = True
+    
+    @staticmethod
+    def _prefix_range(items: List[str], prefix: str, limit: int) -> List[str]:
+        start = bisect_left(items, prefix)
+        end = bisect_left(items, prefix + '\U0010ffff', start)
+        return items[start:min(end, start + limit)]
+    
+    def complete(self, prefix: str, limit: int = 20, folders_only: bool = False) -> List[str]:
+        """返回以 prefix 开头的前 limit 个 tag（按字母序）"""
+        if not prefix:
+            return []
+        return self._prefix_range(self.folders if folders_only else self.tokens, prefix, limit)
 
 
 # ==================== GUI 应用 ====================
 
+class AutoComplete:
+    """
+    输入框的下拉补全：输入时显示候选，↓ 进入列表，回车/双击选中，Esc 关闭
+    
+    multi=True 时补全逗号分隔的最后一项（保留前面的 - 排除前缀）
+    """
+    
+    def __init__(self, entry: ttk.Entry, complete, multi: bool = False, limit: int = 10):
+        self.entry = entry
+        self.complete = complete  # complete(prefix, limit) -> List[str]
+        self.multi = multi
+        self.limit = limit
+        self.listbox = tk.Listbox(entry.winfo_toplevel(), height=limit, exportselection=False)
+        
+        entry.bind('<KeyRelease>', self._on_key, add='+')
+        entry.bind('<Down>', self._focus_list, add='+')
+        entry.bind('<Escape>', lambda e: self.hide(), add='+')
+        entry.bind('<Return>', lambda e: self.hide(), add='+')
+        entry.bind('<FocusOut>', self._on_focus_out, add='+')
+        self.listbox.bind('<Return>', self._accept)
+        self.listbox.bind('<Double-Button-1>', self._accept)
+        self.listbox.bind('<Escape>', lambda e: (self.hide(), self.entry.focus_set()))
+    
+    def _current_term(self):
+        """返回 (当前项开始位置, 当前项前缀)"""
+        text = self.entry.get()
+        start = 0
+        if self.multi:
+            text = text.replace('，', ',').replace('、', ',')
+            start = text.rfind(',') + 1
+            while start < len(text) and text[start] in ' -':
+                start += 1
+        return start, text[start:]
+    
+    def _on_key(self, event):
+        if event.keysym in ('Down', 'Up', 'Return', 'Escape', 'Tab'):
+            return
+        _, prefix = self._current_term()
+        candidates = self.complete(prefix.strip(), self.limit)
+        if not candidates:
+            self.hide()
+            return
+        self.listbox.delete(0, tk.END)
+        self.listbox.insert(tk.END, *candidates)
+        self.listbox.configure(height=len(candidates))
+        self.listbox.place(in_=self.entry, relx=0, rely=1.0, relwidth=1.0)
+        self.listbox.lift()
+    
+    def _focus_list(self, event):
+        if self.listbox.winfo_ismapped():
+            self.listbox.focus_set()
+            self.listbox.selection_clear(0, tk.END)
+            self.listbox.selection_set(0)
+            self.listbox.activate(0)
+            return 'break'
+    
+    def _accept(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            start, _ = self._current_term()
+            self.entry.delete(start, tk.END)
+            self.entry.insert(start, self.listbox.get(selection[0]))
+        self.hide()
+        self.entry.focus_set()
+        self.entry.icursor(tk.END)
+        return 'break'
+    
+    def _on_focus_out(self, event):
+        # 焦点移到下拉列表时不关闭
+        self.entry.after(100, lambda: self.entry.focus_get() is self.listbox or self.hide())
+    
+    def hide(self):
+        self.listbox.place_forget()
+
+
 class DBQueryGUI:
     """数据库查询GUI"""
     
@@ -133,16 +557,21 @@ class DBQueryGUI:
         
         # 配置参数
         self.separator_length = 30  # 分隔符长度
-        self.default_rows_per_page = 10  # 默认每页行数
-        self.max_value_length = 200  # 结果字段最大显示长度
+        self.max_value_length = 200  # 详情中字段最大显示长度
+        self.max_cell_length = 80  # 表格单元格最大显示长度
         
         self.db = None
-        self.current_results = []
-        self.current_index = 0
-        self.row_number = self.default_rows_per_page
+        self.tag_index = None  # TagIndex
+        self.current_results = None  # ResultSet
+        self.view_offset = 0  # 表格第一行在结果中的位置
+        self.visible_rows = 20  # 表格可见行数（随窗口高度变化）
+        self._view_dirty = False  # 后台查询期间视图位置变了，完成后再刷新
+        self._query_thread = None  # 正在执行的后台查询线程
         
         self._create_widgets()
         self._bind_events()
+        AutoComplete(self.tag_entry, lambda prefix, limit: self._complete(prefix, limit, folders_only=True))
+        AutoComplete(self.tags_entry, self._complete, multi=True)
         
         # 初始化数据库连接
         self.db_path_var.set(self.DEFAULT_DB_PATH)
@@ -163,6 +592,7 @@ class DBQueryGUI:
         self.db_path_entry = ttk.Entry(path_frame, textvariable=self.db_path_var, width=80)
         self.db_path_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
         ttk.Button(path_frame, text="连接", command=self._connect_db, width=8).pack(side=tk.LEFT)
+        ttk.Button(path_frame, text="快照", command=self._snapshot_db, width=8).pack(side=tk.LEFT, padx=(5, 0))
         
         # 分割线
         ttk.Separator(main_frame, orient=tk.HORIZONTAL).pack(fill=tk.X, pady=5)
@@ -213,7 +643,9 @@ class DBQueryGUI:
         self.tags_entry = ttk.Entry(row3, width=50)
         self.tags_entry.pack(side=tk.LEFT, padx=5)
         ttk.Button(row3, text="Search", command=self._search_by_tags, width=10).pack(side=tk.LEFT)
-        ttk.Label(row3, text="(逗号分隔)", foreground="gray").pack(side=tk.LEFT, padx=5)
+        self.match_all_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(row3, text="全部匹配", variable=self.match_all_var).pack(side=tk.LEFT, padx=5)
+        ttk.Label(row3, text="(逗号分隔，-tag 排除)", foreground="gray").pack(side=tk.LEFT, padx=5)
         
         # 分割线
         ttk.Separator(main_frame, orient=tk.HORIZONTAL).pack(fill=tk.X, pady=5)
@@ -235,13 +667,10 @@ class DBQueryGUI:
         result_control.pack(fill=tk.X, pady=5)
         
         ttk.Label(result_control, text="结果:").pack(side=tk.LEFT)
-        ttk.Label(result_control, text="每页行数:").pack(side=tk.LEFT, padx=(10, 0))
-        self.row_number_var = tk.StringVar(value=str(self.default_rows_per_page))
-        self.row_number_entry = ttk.Entry(result_control, textvariable=self.row_number_var, width=5)
-        self.row_number_entry.pack(side=tk.LEFT, padx=5)
-        
+        ttk.Button(result_control, text="上一页", command=self._prev_page).pack(side=tk.LEFT, padx=5)
         ttk.Button(result_control, text="下一页", command=self._next_page).pack(side=tk.LEFT, padx=5)
-        ttk.Button(result_control, text="所有结果", command=self._show_all).pack(side=tk.LEFT, padx=5)
+        self.cancel_button = ttk.Button(result_control, text="取消", command=self._cancel_query, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
         
         # Clear按钮（先pack，显示在最右边）
         ttk.Button(result_control, text="Clear", command=self._clear_display).pack(side=tk.RIGHT, padx=5)
@@ -250,11 +679,31 @@ class DBQueryGUI:
         self.result_label = ttk.Label(result_control, text="查询结果: 0/0")
         self.result_label.pack(side=tk.RIGHT)
         
-        # ===== 结果显示 =====
-        self.result_text = scrolledtext.ScrolledText(main_frame, wrap=tk.WORD)
-        self.result_text.pack(fill=tk.BOTH, expand=True, pady=5)
+        # ===== 状态栏 =====
+        self.status_var = tk.StringVar(value="就绪")
+        ttk.Label(main_frame, textvariable=self.status_var, foreground="gray").pack(fill=tk.X)
+        
+        # ===== 结果显示（上：虚拟表格，下：详情/消息）=====
+        paned = ttk.PanedWindow(main_frame, orient=tk.VERTICAL)
+        paned.pack(fill=tk.BOTH, expand=True, pady=5)
         
-        # 注意：已移除水平滚动条，因为 wrap=tk.WORD 会自动换行
+        # 表格只放可见的几十行，滚动条由结果总数换算，滚动时按位置取行
+        table_frame = ttk.Frame(paned)
+        self.table = ttk.Treeview(table_frame, show='headings', selectmode='browse')
+        self.table_scroll = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self._on_scrollbar)
+        table_xscroll = ttk.Scrollbar(table_frame, orient=tk.HORIZONTAL, command=self.table.xview)
+        self.table.configure(xscrollcommand=table_xscroll.set)
+        self.table_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        table_xscroll.pack(side=tk.BOTTOM, fill=tk.X)
+        self.table.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        paned.add(table_frame, weight=3)
+        
+        self.result_text = scrolledtext.ScrolledText(paned, wrap=tk.WORD, height=8)
+        paned.add(self.result_text, weight=1)
+        
+        style = ttk.Style()
+        self.row_height = int(style.lookup('Treeview', 'rowheight') or 0) or \
+            tkfont.nametofont('TkDefaultFont').metrics('linespace') + 4
     
     def _bind_events(self):
         """绑定事件"""
@@ -262,7 +711,13 @@ class DBQueryGUI:
         self.pic_id_entry.bind('<Return>', lambda e: self._search_by_pic_id())
         self.filename_entry.bind('<Return>', lambda e: self._search_by_filename())
         self.tags_entry.bind('<Return>', lambda e: self._search_by_tags())
-        self.row_number_entry.bind('<Return>', lambda e: self._update_row_number())
+        self.table.bind('<Configure>', self._on_table_resize)
+        self.table.bind('<<TreeviewSelect>>', self._on_row_select)
+        self.table.bind('<MouseWheel>', self._on_mousewheel)
+        self.table.bind('<Button-4>', lambda e: self._scroll_by(-3))
+        self.table.bind('<Button-5>', lambda e: self._scroll_by(3))
+        self.table.bind('<Prior>', lambda e: self._prev_page() or 'break')
+        self.table.bind('<Next>', lambda e: self._next_page() or 'break')
     
     def _connect_db(self):
         """连接数据库"""
@@ -275,46 +730,87 @@ class DBQueryGUI:
             messagebox.showerror("错误", f"数据库文件不存在: {db_path}")
             return
         
+        if self._query_thread is not None:
+            messagebox.showinfo("提示", "有查询正在执行，请等待完成或先取消")
+            return
+        
         try:
             if self.db:
                 self.db.close()
+            if self.tag_index:
+                self.tag_index.close()
+                self.tag_index = None
             self.db = DatabaseManager(db_path)
             # 测试连接
             self.db.get_all_tables()
+            self.tag_index = TagIndex(db_path)
+            self.tag_index.refresh()
             self._show_message(f"✓ 数据库连接成功: {db_path}")
         except Exception as e:
             messagebox.showerror("错误", f"连接失败: {e}")
     
+    def _snapshot_db(self):
+        """复制当前数据库的快照并改连快照（长查询不影响正在下载的主库）"""
+        if not self._check_db():
+            return
+        
+        stem, ext = os.path.splitext(self.db.db_path)
+        if stem.endswith('_snapshot'):
+            stem = stem[:-len('_snapshot')]
+        dest = f'{stem}_snapshot{ext or ".db"}'
+        if os.path.abspath(dest) == os.path.abspath(self.db.db_path):
+            messagebox.showinfo("提示", "当前已连接快照，请先连接主库再生成快照")
+            return
+        
+        def done(path):
+            self.db_path_var.set(path)
+            self._connect_db()
+        
+        self._run_query(lambda: self.db.snapshot(dest), done, "生成快照")
+    
     def _show_tables(self):
         """显示所有表名"""
         if not self._check_db():
             return
         
-        try:
-            tables = self.db.get_all_tables()
+        def done(tables):
             self._clear_results()
             self._append_message(f"数据库中的表 ({len(tables)} 个):\n" + "\n".join(f"  - {t}" for t in tables))
-        except Exception as e:
-            self._append_message(f"❌ 查询失败: {e}")
+        
+        self._run_query(self.db.get_all_tables, done, "显示所有表名")
     
     def _show_all_tags(self):
         """显示所有唯一的tag_name"""
         if not self._check_db():
             return
         
-        try:
-            tags = self.db.get_all_tags()
+        def done(tags):
             self._clear_results()
             if tags:
                 tags_str = ", ".join(tags)
                 self._append_message(f"数据库中的所有tag ({len(tags)} 个):\n\n{tags_str}")
             else:
                 self._append_message("数据库中没有任何tag记录")
-        except Exception as e:
-            self._append_message(f"❌ 查询失败: {e}")
+        
+        # 补全索引是最新的就直接用，不再查询
+        index = self.tag_index
+        if index and index.ready and not index.refresh() and not index.building:
+            done(index.folders)
+            return
+        self._run_query(self.db.get_all_tags, done, "显示所有tag")
+    
+    def _complete(self, prefix, limit, folders_only=False):
+        """输入补全的候选（数据库有变化时顺便触发后台重建）"""
+        if not self.tag_index:
+            return []
+        try:
+            self.tag_index.refresh()
+        except sqlite3.Error:
+            pass
+        return self.tag_index.complete(prefix, limit, folders_only)
     
     def _execute_query(self, query_func, input_value, title_prefix, error_msg="请输入查询内容"):
-        """通用查询执行方法"""
+        """通用查询执行方法（后台执行，先取第一页）"""
         if not self._check_db():
             return
         
@@ -322,11 +818,18 @@ class DBQueryGUI:
             messagebox.showwarning("提示", error_msg)
             return
         
-        try:
-            results = query_func(input_value)
-            self._display_results(results, f"{title_prefix}: {input_value}")
-        except Exception as e:
-            self._append_message(f"❌ 查询失败: {e}")
+        self._query_first_page(lambda: query_func(input_value), f"{title_prefix}: {input_value}")
+    
+    def _query_first_page(self, query, title):
+        """后台执行 query() 并取出第一页，完成后在主线程显示"""
+        count = self.visible_rows
+        
+        def work():
+            results = query()
+            results.rows(0, count)  # 预取第一页
+            return results
+        
+        self._run_query(work, lambda results: self._display_results(results, title), title)
     
     def _search_by_tag(self):
         """根据tag查询"""
@@ -359,20 +862,20 @@ class DBQueryGUI:
         
         # 处理输入：替换中文逗号，去除空格
         tags_input = tags_input.replace('，', ',').replace('、', ',')
-        tags = [t.strip() for t in tags_input.split(',') if t.strip()]
+        terms = [t.strip() for t in tags_input.split(',') if t.strip()]
+        tags = [t for t in terms if not t.startswith('-')]
+        exclude = [t[1:] for t in terms if t.startswith('-') and len(t) > 1]
         
-        if not tags:
+        if not tags and not exclude:
             messagebox.showwarning("提示", "请输入有效的标签")
             return
         
         if not self._check_db():
             return
         
-        try:
-            results = self.db.search_pictures_by_tags(tags)
-            self._display_results(results, f"Tags: {', '.join(tags)}")
-        except Exception as e:
-            self._append_message(f"❌ 查询失败: {e}")
+        match_all = self.match_all_var.get()
+        self._query_first_page(lambda: self.db.search_pictures_by_tags(tags, match_all, exclude),
+                               f"Tags: {', '.join(terms)}")
     
     def _execute_sql(self):
         """执行自定义SQL"""
@@ -384,14 +887,79 @@ class DBQueryGUI:
             messagebox.showwarning("提示", "请输入SQL语句")
             return
         
-        try:
-            columns, results = self.db.execute_sql(sql)
-            if results:
-                self._display_results(results, f"SQL查询")
+        count = self.visible_rows
+        
+        def work():
+            results = self.db.execute_sql(sql)
+            if results is not None:
+                results.rows(0, count)  # 预取第一页
+            return results
+        
+        def done(results):
+            if results is not None:
+                self._display_results(results, "SQL查询")
             else:
                 self._append_message("✓ SQL执行成功，无返回数据")
-        except Exception as e:
-            self._append_message(f"❌ SQL执行失败: {e}")
+        
+        self._run_query(work, done, "SQL查询")
+    
+    # ===== 后台查询 =====
+    
+    def _run_query(self, work, on_done, label):
+        """
+        在后台线程执行 work()，完成后在主线程调用 on_done(结果)
+        
+        同一时间只执行一个查询；后台线程不碰控件，结果经队列交回主线程
+        """
+        if self._query_thread is not None:
+            messagebox.showinfo("提示", "有查询正在执行，请等待完成或先取消")
+            return
+        
+        self.db.begin_query()
+        done_queue = queue.Queue(maxsize=1)
+        
+        def worker():
+            try:
+                done_queue.put((True, work()))
+            except Exception as e:
+                done_queue.put((False, e))
+        
+        self._query_thread = threading.Thread(target=worker, daemon=True)
+        self._query_thread.start()
+        self.cancel_button.config(state=tk.NORMAL)
+        self._poll_query(done_queue, on_done, label, time.perf_counter())
+    
+    def _poll_query(self, done_queue, on_done, label, start):
+        """定时检查后台查询，刷新状态栏"""
+        elapsed = time.perf_counter() - start
+        progress = f"{elapsed:.1f}s | 已取出 {self.db.rows_fetched} 行 | 已执行 {self.db.steps:,} 步"
+        try:
+            ok, value = done_queue.get_nowait()
+        except queue.Empty:
+            self.status_var.set(f"{label} 查询中... {progress}")
+            self.root.after(100, self._poll_query, done_queue, on_done, label, start)
+            return
+        
+        self._query_thread = None
+        self.cancel_button.config(state=tk.DISABLED)
+        view_dirty, self._view_dirty = self._view_dirty, False
+        if ok:
+            self.status_var.set(f"✓ {label} 完成: {progress}")
+            on_done(value)
+            if view_dirty:
+                self._refresh_view()
+        elif isinstance(value, sqlite3.OperationalError) and 'interrupted' in str(value):
+            self.status_var.set(f"{label} 已取消: {progress}")
+            self._append_message(f"⚠ 查询已取消: {label}")
+        else:
+            self.status_var.set(f"❌ {label} 失败: {progress}")
+            self._append_message(f"❌ 查询失败: {value}")
+    
+    def _cancel_query(self):
+        """取消正在执行的查询（sqlite 进度回调中断当前语句）"""
+        if self._query_thread is not None and self.db:
+            self.db.cancel()
+            self.status_var.set("正在取消...")
     
     def _check_db(self):
         """检查数据库连接"""
@@ -401,17 +969,18 @@ class DBQueryGUI:
         return True
     
     def _clear_results(self):
-        """清空分页状态（不清除显示）"""
-        self.current_results = []
-        self.current_index = 0
+        """清空表格和结果状态（不清除消息）"""
+        self.current_results = None
+        self.view_offset = 0
+        self.table.delete(*self.table.get_children())
+        self.table.configure(columns=())
+        self.table_scroll.set(0, 1)
         self.result_label.config(text="查询结果: 0/0")
     
     def _clear_display(self):
-        """清空结果显示框"""
+        """清空表格和消息框"""
+        self._clear_results()
         self.result_text.delete("1.0", tk.END)
-        self.current_results = []
-        self.current_index = 0
-        self.result_label.config(text="查询结果: 0/0")
     
     def _show_message(self, msg):
         """显示消息（覆盖模式，用于连接成功等提示）"""
@@ -426,94 +995,159 @@ class DBQueryGUI:
         self.result_text.insert(tk.END, msg)
         self.result_text.see(tk.END)
     
-    def _update_row_number(self):
-        """更新每页行数"""
-        try:
-            self.row_number = int(self.row_number_var.get())
-            if self.row_number < 1:
-                self.row_number = self.default_rows_per_page
-                self.row_number_var.set(str(self.default_rows_per_page))
-        except ValueError:
-            self.row_number = self.default_rows_per_page
-            self.row_number_var.set(str(self.default_rows_per_page))
-    
-    def _format_row(self, row_data: Dict) -> str:
+    def _format_row(self, row_data: sqlite3.Row) -> str:
         """格式化单行数据为字符串"""
         lines = []
-        for key, value in row_data.items():
+        for key, value in zip(row_data.keys(), row_data):
             str_value = str(value) if value is not None else "NULL"
             if len(str_value) > self.max_value_length:
                 str_value = str_value[:self.max_value_length] + "..."
             lines.append(f"  {key}: {str_value}")
         return "\n".join(lines)
     
+    def _format_cell(self, value) -> str:
+        """格式化表格单元格（单行，截断）"""
+        if value is None:
+            return "NULL"
+        text = str(value).replace("\n", " ")
+        if len(text) > self.max_cell_length:
+            text = text[:self.max_cell_length] + "..."
+        return text
+    
+    # ===== 虚拟表格 =====
+    
     def _display_results(self, results, title=""):
-        """显示查询结果（追加模式）"""
-        self._update_row_number()
-        self.current_results = results
-        self.current_index = 0
-        
+        """在表格中显示新的查询结果"""
+        self._clear_results()
         if not results:
             self._append_message(f"{title}\n\n❌ 未找到任何记录")
-            self.result_label.config(text="查询结果: 0/0")
             return
         
-        self._show_current_page(title)
+        self.current_results = results
+        self.table.configure(columns=[str(i) for i in range(len(results.columns))])
+        for i, column in enumerate(results.columns):
+            self.table.heading(str(i), text=column, command=lambda i=i: self._sort_by(i))
+            width = 400 if column in ('pic_tags', 'pic_url') else max(60, min(200, len(column) * 12))
+            self.table.column(str(i), width=width, minwidth=40, stretch=False)
+        self._update_headings()
+        self._append_message(f"=== {title} === 共 {len(results)} 条")
+        self._refresh_view()
     
-    def _show_current_page(self, title=""):
-        """显示当前页（追加模式）"""
-        total = len(self.current_results)
-        start = self.current_index
-        end = min(start + self.row_number, total)
-        
-        # 如果已有内容，先添加分隔
-        if self.result_text.get("1.0", tk.END).strip():
-            separator = "-" * self.separator_length
-            self.result_text.insert(tk.END, f"\n\n{separator}\n\n")
-        
-        # 显示标题和统计
-        if title:
-            self.result_text.insert(tk.END, f"=== {title} ===\n\n")
+    def _update_headings(self):
+        """在排序列标题上显示方向箭头"""
+        results = self.current_results
+        for i, column in enumerate(results.columns):
+            if i == results.order:
+                column += " ▼" if results.descending else " ▲"
+            self.table.heading(str(i), text=column)
+    
+    def _render(self):
+        """用缓存中的行重绘可见区域（只插入可见的行）"""
+        results = self.current_results
+        total = len(results)
+        count = self.visible_rows
+        rows = results.rows(self.view_offset, count)
         
-        # 显示当前页数据
-        for i, row in enumerate(self.current_results[start:end], start + 1):
-            self.result_text.insert(tk.END, f"[{i}] ----------------------------------------\n")
-            self.result_text.insert(tk.END, self._format_row(row) + "\n\n")
+        self.table.delete(*self.table.get_children())
+        for i, row in enumerate(rows, self.view_offset):
+            self.table.insert('', tk.END, iid=str(i), values=[self._format_cell(v) for v in row])
         
-        self.result_label.config(text=f"查询结果: {end}/{total}")
-        self.result_text.see(tk.END)
+        end = self.view_offset + len(rows)
+        self.result_label.config(text=f"查询结果: {self.view_offset + 1}-{end}/{total}")
+        self.table_scroll.set(self.view_offset / total, end / total)
     
-    def _next_page(self):
-        """下一页"""
+    def _request_view(self, offset):
+        """把表格移到第 offset 行"""
         if not self.current_results:
             return
+        self.view_offset = max(0, min(offset, len(self.current_results) - self.visible_rows))
+        self._refresh_view()
+    
+    def _refresh_view(self):
+        """
+        刷新可见区域：行都在缓存中时直接重绘，否则到后台取
         
-        self._update_row_number()
-        total = len(self.current_results)
+        后台查询期间不读缓存（连接同一时间只给一个线程用），只记下视图已变，查询完成后再刷新
+        """
+        results = self.current_results
+        if not results:
+            return
+        if self._query_thread is not None:
+            self._view_dirty = True
+            return
+        if results.is_cached(self.view_offset, self.visible_rows):
+            self._render()
+            return
         
-        if self.current_index + self.row_number < total:
-            self.current_index += self.row_number
-            self._show_current_page()
+        offset, count = self.view_offset, self.visible_rows
+        self._run_query(lambda: results.rows(offset, count), lambda _: self._refresh_view(), "取行")
+    
+    def _scroll_by(self, rows):
+        self._request_view(self.view_offset + rows)
+        return 'break'
     
-    def _show_all(self):
-        """显示所有结果（追加模式）"""
+    def _on_scrollbar(self, action, *args):
+        """滚动条：拖动(moveto)或点击箭头/空白(scroll)"""
         if not self.current_results:
             return
+        if action == 'moveto':
+            self._request_view(int(float(args[0]) * len(self.current_results)))
+        elif args[1] == 'pages':
+            self._scroll_by(int(args[0]) * self.visible_rows)
+        else:
+            self._scroll_by(int(args[0]))
+    
+    def _on_mousewheel(self, event):
+        return self._scroll_by(-3 if event.delta > 0 else 3)
+    
+    def _on_table_resize(self, event):
+        """窗口大小变化时重算可见行数"""
+        visible = max(1, (event.height - self.row_height - 4) // self.row_height)
+        if visible != self.visible_rows:
+            self.visible_rows = visible
+            self._request_view(self.view_offset)
+    
+    def _prev_page(self):
+        """上一页"""
+        self._scroll_by(-self.visible_rows)
+    
+    def _next_page(self):
+        """下一页"""
+        self._scroll_by(self.visible_rows)
+    
+    def _sort_by(self, column):
+        """点击列标题：在 SQL 中按该列排序（再次点击切换升降序）"""
+        results = self.current_results
+        if not results or self._query_thread is not None:
+            return
+        descending = results.order == column and not results.descending
+        sorted_results = results.sorted(column, descending)
+        count = self.visible_rows
         
-        # 如果已有内容，先添加分隔
-        if self.result_text.get("1.0", tk.END).strip():
-            separator = "-" * self.separator_length
-            self.result_text.insert(tk.END, f"\n\n{separator}\n=== 显示全部结果 ===\n{separator}\n\n")
-        
-        total = len(self.current_results)
+        def work():
+            sorted_results.rows(0, count)
+            return sorted_results
         
-        for i, row in enumerate(self.current_results, 1):
-            self.result_text.insert(tk.END, f"[{i}] ----------------------------------------\n")
-            self.result_text.insert(tk.END, self._format_row(row) + "\n\n")
+        def done(new_results):
+            if self.current_results is not results:
+                return
+            self.current_results = new_results
+            self.view_offset = 0
+            self._update_headings()
+            self._refresh_view()
         
-        self.result_label.config(text=f"查询结果: {total}/{total}")
-        self.current_index = total
-        self.result_text.see(tk.END)
+        self._run_query(work, done, f"排序 {results.columns[column]}")
+    
+    def _on_row_select(self, event):
+        """选中一行时在下方显示完整记录"""
+        selection = self.table.selection()
+        if not selection or not self.current_results or self._query_thread is not None:
+            return
+        index = int(selection[0])
+        if not self.current_results.is_cached(index, 1):
+            return
+        row = self.current_results.rows(index, 1)[0]
+        self._show_message(f"[{index + 1}]\n" + self._format_row(row))
 
 
 def main():
@@ -4,22 +4,28 @@
 
 目录导航:
     - Line 30:  配置加载 (load_config)
-    - Line 50:  正则表达式工具 (Regex)
-    - Line 115: 文件操作工具 (read_json, write_json, read_lines, etc.)
-    - Line 230: parse_exauthor (排除规则解析)
-    - Line 280: 网络客户端 (WebClient)
-    - Line 380: 数据库管理器 (DatabaseManager)
+    - Line 55:  正则表达式工具 (Regex)
+    - Line 120: 文件操作工具 (read_json, write_json, read_lines, parse_downtag_file, etc.)
+    - Line 240: 日志轮转 (rotate_log)
+    - Line 310: tag映射注册表 (TagMappingRegistry, load_tag_mapping)
+    - Line 420: parse_exauthor (排除规则解析)
+    - Line 470: 网络客户端 (RateLimiter, WebClient)
+    - Line 540: 数据库管理器 (表结构说明, picture_select, DatabaseManager)
 """
 import os
 import re
 import json
+import gzip
+import shutil
 import threading
 import sqlite3
 import requests
 import time
+from collections import namedtuple
 from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Tuple, Iterator
 from bs4 import BeautifulSoup
 
 
@@ -40,6 +46,7 @@ MAX_WORKERS = config['runtime']['MAX_WORKERS']
 DOWN_SKIP_THRESHOLD = config['runtime']['DOWN_SKIP_THRESHOLD']
 LOG_MAX_SIZE = config['runtime']['LOG_MAX_SIZE']
 LOG_BACKUP_COUNT = config['runtime']['LOG_BACKUP_COUNT']
+LOG_ROTATE_DAYS = config['runtime']['LOG_ROTATE_DAYS']
 SAMPLE_ENABLED = config['runtime']['SAMPLE_ENABLED']
 SAMPLE_COUNT = config['runtime']['SAMPLE_COUNT']
 THUMBNAIL_SIZE = tuple(config['runtime']['THUMBNAIL_SIZE'])
@@ -47,6 +54,16 @@ CHUNK_SIZE = config['runtime']['CHUNK_SIZE']
 RANDOM_DELAY_MIN = config['runtime']['RANDOM_DELAY_MIN']
 RANDOM_DELAY_MAX = config['runtime']['RANDOM_DELAY_MAX']
 FILE_COUNT_CHECK_INTERVAL = config['runtime']['FILE_COUNT_CHECK_INTERVAL']
+DB_CACHE_SIZE = config['runtime']['DB_CACHE_SIZE']  # 每个连接的页缓存（字节）
+DB_MMAP_SIZE = config['runtime']['DB_MMAP_SIZE']  # 内存映射读取的上限（字节，0=不用）
+DB_TEMP_STORE = config['runtime']['DB_TEMP_STORE']  # 临时表/排序的位置（DEFAULT/FILE/MEMORY）
+DB_WAL_MAX_SIZE = config['runtime']['DB_WAL_MAX_SIZE']  # WAL 超过此大小时检查点用 TRUNCATE
+DB_CHECKPOINT_INTERVAL = config['runtime']['DB_CHECKPOINT_INTERVAL']  # 后台检查点间隔（秒，0=不启用）
+DB_POOL_SIZE = config['runtime']['DB_POOL_SIZE']  # 数据库连接池大小（同时借出的连接数上限）
+FAILED_ARCHIVE_DAYS = config['runtime']['FAILED_ARCHIVE_DAYS']  # 失败记录多少天未更新后移入归档库
+DOWNLOAD_RATE = config['runtime']['DOWNLOAD_RATE']  # 共享限速：每秒请求数（0=不限速）
+FAILED_MAX_RETRIES = config['runtime']['FAILED_MAX_RETRIES']  # 失败记录重试多少次后放弃
+FAILED_RETRY_BACKOFF = config['runtime']['FAILED_RETRY_BACKOFF']  # 重试退避基数（秒），第 n 次失败后等待 基数×2^n
 
 
 # ==================== 正则表达式预编译 ====================
@@ -57,6 +74,7 @@ class Regex:
     POSTED_TIME = re.compile(r'Posted:.*')
     FILE_NUMBER = re.compile(r'(\d{1,4})_')
     ID_TEXT = re.compile(r'Id:.*')
+    THUMB_MD5 = re.compile(r'thumbnail_([0-9a-f]{32})\.')
     
     @classmethod
     def extract_image_id(cls, url: str) -> Optional[str]:
@@ -192,9 +210,240 @@ def format_size(size_bytes: int) -> str:
         return f"{size_bytes / 1024 / 1024 / 1024:.2f} Gb"
 
 
+DEFAULT_TAG_TIME = '2000-01-01 00:00:00'
+
+
+def parse_downtag_file(filepath: str) -> Dict[str, List[str]]:
+    """
+    解析 downtag.txt（支持新旧两种格式）
+    
+    新格式: tag {num}: {tag} |time1: {time}|time2: {time}|time3: {time}|time4: {time}
+    旧格式: tag {num}: {tag} time: {time}
+    
+    Returns:
+        {tag: [time1, time2, ...]}，time1 为最新，不含补齐用的默认时间
+    """
+    tag_times = {}
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or 'time' not in line or ': ' not in line:
+                    continue
+                parts = line.split(': ', 1)
+                
+                if '|time1:' in line:
+                    tag_name = parts[1].split('|')[0].strip()
+                    times = []
+                    for part in line.split('|'):
+                        if 'time' in part and ':' in part:
+                            time_str = part.split(':', 1)[1].strip()
+                            if len(time_str) == 19:  # YYYY-MM-DD HH:MM:SS
+                                times.append(time_str)
+                elif 'time:' in line:
+                    tag_name = parts[1].split('time:')[0].strip()
+                    times = [line.split('time:', 1)[1].strip()]
+                else:
+                    continue
+                
+                real_times = [t for t in times if t != DEFAULT_TAG_TIME]
+                tag_times[tag_name] = real_times or [DEFAULT_TAG_TIME]
+    except FileNotFoundError:
+        pass
+    return tag_times
+
+
+# ==================== 日志轮转 ====================
+
+# 归档段文件名: taglog1.2024-05-01_2024-05-07.txt.gz（同一日期范围重复时追加 .1/.2 序号），
+# 读取与过期清理见 analyze_log.log_segments / prune_segments
+
+
+def _log_line_day(line: str) -> Optional[str]:
+    """取日志行 'YYYY-MM-DD HH:MM:SS | ...' 的日期部分"""
+    day = line[:10]
+    if len(day) == 10 and day[4] == '-' and day[7] == '-' and day[:4].isdigit():
+        return day
+    return None
+
+
+def _log_day_range(path: str) -> Tuple[Optional[str], Optional[str]]:
+    """只读文件头尾各 4KB，得到日志覆盖的首末日期"""
+    with open(path, 'rb') as f:
+        head = f.read(4096).decode('utf-8', 'ignore').splitlines()
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 4096))
+        tail = f.read().decode('utf-8', 'ignore').splitlines()
+    first = next((d for d in map(_log_line_day, head) if d), None)
+    last = next((d for d in map(_log_line_day, reversed(tail)) if d), None)
+    return first, last
+
+
+def rotate_log(path: str, max_size: int = LOG_MAX_SIZE, max_days: int = LOG_ROTATE_DAYS) -> Optional[str]:
+    """
+    日志超过 max_size 字节或首行日期早于 max_days 天时，整体压缩为归档段并清空活动日志
+    
+    活动日志只追加、不改写；过期清理按段整体删除。
+    
+    Returns:
+        新归档段路径，未轮转时返回 None
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+    if size == 0:
+        return None
+    
+    today = datetime.now().strftime('%Y-%m-%d')
+    first, last = _log_day_range(path)
+    first = first or today
+    last = last or first
+    age_days = (datetime.now() - datetime.strptime(first, '%Y-%m-%d')).days
+    if size < max_size and age_days < max_days:
+        return None
+    
+    stem = os.path.splitext(path)[0]
+    target = f"{stem}.{first}_{last}.txt.gz"
+    seq = 0
+    while os.path.exists(target):
+        seq += 1
+        target = f"{stem}.{first}_{last}.{seq}.txt.gz"
+    
+    # 先写临时文件再改名，中途失败不会留下半个归档段
+    tmp_path = target + '.tmp'
+    with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp_path, target)
+    os.remove(path)
+    return target
+
+
+def rotate_yearly(path: str, year: Optional[str] = None) -> Optional[str]:
+    """
+    把只追加的文本文件（如 failed.txt）转存到按年份的 {stem}.{YYYY}.txt.gz 并清空
+    
+    同一年多次转存追加为新的 gzip 成员（gzip 可直接连续读取）；文件为空时不处理。
+    先改名再压缩，转存期间新写入的行进入新的 failed.txt，不会丢失。
+    
+    Returns:
+        归档文件路径；未转存时返回 None
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    year = year or datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y')
+    target = f"{os.path.splitext(path)[0]}.{year}.txt.gz"
+    
+    rotating = path + '.rotating'
+    os.replace(path, rotating)
+    with open(rotating, 'rb') as src, gzip.open(target, 'ab') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.remove(rotating)
+    return target
+
+
+# ==================== tag映射注册表 ====================
+
+class TagMappingRegistry:
+    """
+    tag映射注册表（单例，线程安全）
+    
+    - replace_taglist.txt 在进程内只读取一次，之后双向查询都走内存
+    - 新映射以追加方式写入文件（加锁），不再整体重写，避免多线程覆盖丢失
+    - 文件中同一个 original_tag 出现多次时，以最后一行为准
+    """
+    
+    _instance = None
+    _lock = threading.Lock()
+    
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super().__new__(cls)
+                    cls._instance._initialized = False
+        return cls._instance
+    
+    def __init__(self):
+        if self._initialized:
+            return
+        
+        self.path = config['path']['tag_replace']
+        self._forward = {}   # {original_tag: replace_tag}
+        self._reverse = {}   # {replace_tag: original_tag}
+        self._write_lock = threading.Lock()
+        self._initialized = True
+        self.reload()
+    
+    def reload(self):
+        """重新读取映射文件"""
+        forward = {}
+        reverse = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+                for line in lines[1:]:  # 跳过header
+                    line = line.strip()
+                    if ',' in line:
+                        parts = line.split(',', 1)
+                        if len(parts) == 2:
+                            original_tag, replace_tag = parts[0], parts[1]
+                            forward[original_tag] = replace_tag
+                            reverse[replace_tag] = original_tag
+        except FileNotFoundError:
+            pass  # 文件不存在，使用空映射
+        except Exception as e:
+            print(f"⚠️  读取tag映射文件失败: {e}")
+        
+        with self._write_lock:
+            self._forward = forward
+            self._reverse = reverse
+    
+    def get_replace(self, original_tag: str) -> Optional[str]:
+        """original_tag -> replace_tag，没有记录返回 None"""
+        return self._forward.get(original_tag)
+    
+    def get_original(self, tag: str) -> str:
+        """如果是 replace_tag 则转换为 original_tag，否则原样返回"""
+        return self._reverse.get(tag, tag)
+    
+    def as_dict(self, reverse: bool = False) -> dict:
+        """返回映射字典的副本"""
+        return dict(self._reverse if reverse else self._forward)
+    
+    def register(self, original_tag: str, replace_tag: str) -> bool:
+        """
+        记录映射关系（已存在且相同时不写文件）
+        
+        Returns:
+            bool: 是否写入了新映射
+        """
+        if self._forward.get(original_tag) == replace_tag:
+            return False
+        
+        with self._write_lock:
+            if self._forward.get(original_tag) == replace_tag:
+                return False
+            
+            need_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a', encoding='utf-8') as f:
+                if need_header:
+                    f.write('original_tag,replace_tag\n')
+                f.write(f'{original_tag},{replace_tag}\n')
+            
+            self._forward[original_tag] = replace_tag
+            self._reverse[replace_tag] = original_tag
+        return True
+
+
+def get_tag_mapping() -> TagMappingRegistry:
+    """获取tag映射注册表的便捷函数"""
+    return TagMappingRegistry()
+
+
 def load_tag_mapping(reverse: bool = False) -> dict:
     """
-    加载tag映射关系
+    加载tag映射关系（从注册表缓存读取，不再每次读文件）
     
     Args:
         reverse: False返回 {original_tag: replace_tag}
@@ -203,27 +452,7 @@ def load_tag_mapping(reverse: bool = False) -> dict:
     Returns:
         映射字典
     """
-    mapping = {}
-    try:
-        tag_replace_path = config['path']['tag_replace']
-        with open(tag_replace_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            for line in lines[1:]:  # 跳过header
-                line = line.strip()
-                if ',' in line:
-                    parts = line.split(',', 1)
-                    if len(parts) == 2:
-                        original_tag, replace_tag = parts[0], parts[1]
-                        if reverse:
-                            mapping[replace_tag] = original_tag
-                        else:
-                            mapping[original_tag] = replace_tag
-    except FileNotFoundError:
-        pass  # 文件不存在，返回空字典
-    except Exception as e:
-        print(f"⚠️  读取tag映射文件失败: {e}")
-    
-    return mapping
+    return get_tag_mapping().as_dict(reverse)
 
 
 def parse_exauthor(exauthor_lines: List[str]) -> tuple:
@@ -277,30 +506,85 @@ def get_max_file_number(directory: str, pattern: str = r'(\d{1,4})_') -> int:
 
 # ==================== 网络客户端 ====================
 
+class RateLimiter:
+    """
+    令牌桶限速器（线程安全）
+    
+    - rate: 每秒允许的请求数（<=0 不限速），burst: 空闲后允许连续发出的请求数
+    - 令牌不足时按预约排队：每个调用方在锁内记账，锁外睡眠自己的等待时间
+    """
+    
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0  # 累计等待秒数（统计用）
+    
+    def acquire(self):
+        """取一个令牌，不足时睡眠到轮到自己为止"""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
+
+
+_rate_limiter: Optional[RateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """进程内共享的限速器（DOWNLOAD_RATE），所有传入它的 WebClient 合计限速"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter(DOWNLOAD_RATE)
+    return _rate_limiter
+
+
 class WebClient:
     """网络客户端 - 整合下载和解析功能"""
     
-    def __init__(self, headers: dict, timeout: int = 10, max_retries: int = 50):
+    def __init__(self, headers: dict, timeout: int = 10, max_retries: int = 50,
+                 rate_limiter: Optional[RateLimiter] = None):
         self.headers = headers
         self.timeout = timeout
         self.max_retries = max_retries
+        self.rate_limiter = rate_limiter  # 每次请求前取令牌（None=不限速）
         self.session = requests.Session()
         self.session.headers.update(headers)
+        self.last_error: Optional[str] = None  # 最近一次下载失败的原因（写入失败记录）
     
-    def download_image(self, url: str, retries: Optional[int] = None) -> Optional[bytes]:
-        """下载图片到内存"""
+    def download_image(self, url: str, retries: Optional[int] = None,
+                       referer: Optional[str] = None) -> Optional[bytes]:
+        """下载图片到内存（失败返回 None，原因记在 last_error）"""
         max_attempts = retries if retries is not None else self.max_retries
+        headers = {'Referer': referer} if referer else None
         
         for attempt in range(max_attempts):
             try:
-                response = self.session.get(url, timeout=self.timeout)
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
+                response = self.session.get(url, timeout=self.timeout, headers=headers)
                 response.raise_for_status()
+                self.last_error = None
                 return response.content
-            except (requests.RequestException, requests.Timeout):
+            except (requests.RequestException, requests.Timeout) as e:
+                self.last_error = f'{type(e).__name__}: {e}'
                 if attempt < max_attempts - 1:
                     time.sleep(2 ** min(attempt, 5))
                 continue
-            except Exception:
+            except Exception as e:
+                self.last_error = f'{type(e).__name__}: {e}'
                 return None
         return None
     
@@ -310,6 +594,8 @@ class WebClient:
         
         for attempt in range(max_attempts):
             try:
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
                 response = self.session.get(url, timeout=self.timeout)
                 response.raise_for_status()
                 return BeautifulSoup(response.text, 'html.parser')
@@ -329,6 +615,20 @@ class WebClient:
         except Exception:
             return []
     
+    @staticmethod
+    def get_image_entries(soup: BeautifulSoup) -> List[Tuple[str, Optional[str]]]:
+        """从列表页提取 (详情URL, 文件md5)，md5 取自缩略图 thumbnail_{md5}.jpg，取不到为 None"""
+        entries = []
+        try:
+            for article in soup.find_all('article'):
+                link = article.find_all('a')[0]
+                img = link.find('img')
+                match = Regex.THUMB_MD5.search(img.get('src', '')) if img else None
+                entries.append((link['href'], match.group(1) if match else None))
+        except Exception:
+            return []
+        return entries
+    
     @staticmethod
     def get_image_ids(soup: BeautifulSoup) -> List[str]:
         """从列表页提取图片ID"""
@@ -344,6 +644,299 @@ class WebClient:
 
 
 # ==================== 数据库管理 ====================
+#
+# 图片数据结构（user_version = 1）:
+#   posts      (pic_id INTEGER PK, pic_url, pic_time, pic_date, tag_ids)   每个帖子一行，tag_ids 为
+#                                                                          tag_dict.id 的 JSON 数组（保持原顺序）
+#   tag_dict   (id INTEGER PK, tag UNIQUE)                                 tag文本只存一次
+#   post_tags  (tag_id, post_id) WITHOUT ROWID                             整数对，按tag搜索的索引
+#   pictures   (id, pic_id, tag_name, filename, ... )                      帖子 ↔ 本地文件夹/文件
+#   picture_view                                                    还原旧的 pictures 行结构（只读）
+
+SCHEMA_VERSION = 1
+
+# 旧 pictures 行结构中每一列对应的 SQL 表达式（pl = pictures，po = posts）
+PICTURE_COLUMNS = {
+    'id': 'pl.id',
+    'pic_id': 'CAST(pl.pic_id AS TEXT)',
+    'tag_name': 'pl.tag_name',
+    'filename': 'pl.filename',
+    'new_filename': 'pl.new_filename',
+    'file_path': 'pl.file_path',
+    'file_size': 'pl.file_size',
+    'pic_url': 'po.pic_url',
+    'pic_tags': """(SELECT group_concat(tag, ' ') FROM (
+                        SELECT d.tag FROM json_each(po.tag_ids) j JOIN tag_dict d ON d.id = j.value
+                        ORDER BY j.key))""",
+    'pic_time': 'po.pic_time',
+    'pic_date': 'po.pic_date',
+    'download_time': 'pl.download_time',
+    'status': 'pl.status',
+    'created_at': 'pl.created_at',
+}
+
+# 旧行结构的列（picture_view 和默认投影）
+PICTURE_FIELDS = tuple(PICTURE_COLUMNS)
+
+# 只用于投影的派生列（不在 picture_view 中）：字段是否有值，不取出文本本身
+PICTURE_COLUMNS['has_url'] = "COALESCE(po.pic_url, '') != ''"
+PICTURE_COLUMNS['has_time'] = "COALESCE(po.pic_time, '') != ''"
+PICTURE_COLUMNS['has_tags'] = 'COALESCE(json_array_length(po.tag_ids), 0) > 0'
+
+PICTURE_FROM = 'pictures pl LEFT JOIN posts po ON po.pic_id = pl.pic_id'
+
+# posts 表中的列（其余列在 pictures 表，pic_tags 在 posts.tag_ids）
+POST_FIELDS = ('pic_url', 'pic_time', 'pic_date')
+
+
+def picture_select(where: str, columns: Optional[List[str]] = None) -> str:
+    """构建按旧行结构返回图片的 SELECT（where 中用 pl./po. 引用基础表列）"""
+    columns = columns or PICTURE_FIELDS
+    projection = ', '.join(f'{PICTURE_COLUMNS[c]} AS {c}' for c in columns)
+    return f'SELECT {projection} FROM {PICTURE_FROM} WHERE {where}'
+
+
+_ROW_TYPES: Dict[Tuple[str, ...], type] = {}
+
+
+def picture_row_type(columns) -> type:
+    """按投影列生成轻量行类型（namedtuple，每行只是一个元组，没有 dict）"""
+    key = tuple(columns)
+    row_type = _ROW_TYPES.get(key)
+    if row_type is None:
+        row_type = _ROW_TYPES[key] = namedtuple('PictureRow', key)
+    return row_type
+
+
+TagProgress = namedtuple('TagProgress', ['tag', 'startpage', 'endpage', 'start_pic', 'end_pic', 'status'])
+
+# failed_downloads.status
+FAILED_PENDING = 0  # 待重试
+FAILED_RESOLVED = 1  # 已解决（图片已下载）
+FAILED_PERMANENT = 2  # 放弃重试
+
+# failed_downloads 的去重键：pic_id 为空（NULL 或 ''）时用 pic_url，与 tag_name 一起唯一
+FAILED_KEY = "COALESCE(NULLIF(pic_id, ''), pic_url)"
+
+# failed_downloads 的列（归档库中的表结构相同）
+FAILED_COLUMNS = ('id', 'tag_name', 'pic_url', 'pic_time', 'pic_id', 'pic_filename', 'pic_tags',
+                  'retry_count', 'last_error', 'status', 'created_at', 'updated_at')
+
+
+def to_pic_id(pic_id) -> Optional[int]:
+    """pic_id 转为整数（非数字返回 None）"""
+    try:
+        return int(str(pic_id).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def connect_readonly(db_path: str, timeout: float = 30.0) -> sqlite3.Connection:
+    """只读连接（mode=ro + query_only），用于统计和查询，不会拿写锁也不会建库"""
+    uri = Path(os.path.abspath(db_path)).as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, timeout=timeout, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA query_only=ON')
+    return conn
+
+
+def snapshot_path(db_path: str) -> str:
+    """数据库对应的快照文件路径（xxx.db -> xxx_snapshot.db）"""
+    stem, ext = os.path.splitext(db_path)
+    return f'{stem}_snapshot{ext or ".db"}'
+
+
+def snapshot_database(db_path: str, dest_path: Optional[str] = None) -> str:
+    """
+    用 sqlite 备份 API 复制一份一致的快照，返回快照路径
+    
+    一步复制完（pages=-1）：分步复制时只要其他连接在步与步之间提交，备份就会从头重来，
+    下载一直在写库时可能永远完不成。WAL 模式下这一个读事务不阻塞写入，只是复制期间
+    检查点无法回收 WAL（复制很快，几百MB的库不到1秒）。
+    先写临时文件，完成后再替换，复制中途失败不会留下半个快照。
+    
+    Args:
+        db_path: 源数据库
+        dest_path: 快照路径（默认 xxx_snapshot.db）
+    """
+    dest_path = dest_path or snapshot_path(db_path)
+    tmp_path = dest_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    
+    source = connect_readonly(db_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        source.backup(target, pages=-1)
+        target.execute('PRAGMA journal_mode=DELETE')  # 快照是单个文件，不带 -wal
+    except BaseException:
+        target.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        source.close()
+    target.close()
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+
+class ConnectionPool:
+    """
+    有上限的 sqlite 连接池
+    
+    - 连接按需创建，最多 size 个；创建时执行一次 configure（PRAGMA 等），之后复用
+    - connection() 上下文管理器借出/归还；同一线程嵌套借用时复用已借出的连接（可重入），
+      与原来的线程本地连接语义一致，嵌套的 get_cursor 仍在同一连接/事务上
+    - 借出前做健康检查，坏连接关闭后重建
+    - close_all() 关闭所有空闲连接，借出中的连接在归还时关闭；之后再借用会建新连接
+    - stats() 返回借出次数和等待时间（池满时的排队）
+    """
+    
+    def __init__(self, db_path: str, size: int = DB_POOL_SIZE, timeout: float = 30.0,
+                 configure=None, cached_statements: int = 256):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.configure = configure
+        self.cached_statements = cached_statements
+        
+        self._cond = threading.Condition()
+        self._idle: List[sqlite3.Connection] = []
+        self._generations: Dict[sqlite3.Connection, int] = {}  # 已打开的连接 -> 所属代
+        self._generation = 0
+        self._opening = 0  # 已占名额、正在创建的连接数
+        self._local = threading.local()
+        
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.replaced = 0
+    
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=self.timeout,
+                               cached_statements=self.cached_statements)
+        if self.configure:
+            self.configure(conn)
+        return conn
+    
+    @staticmethod
+    def _healthy(conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+    
+    def _discard(self, conn: sqlite3.Connection):
+        """关闭连接并让出名额（调用方持有 _cond）"""
+        self._generations.pop(conn, None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._cond.notify()
+    
+    def _checkout(self) -> sqlite3.Connection:
+        start = time.perf_counter()
+        deadline = start + self.timeout
+        waited = False
+        with self._cond:
+            while not self._idle and len(self._generations) + self._opening >= self.size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise TimeoutError(f"等待数据库连接超时（{self.size} 个连接都在使用中）")
+                waited = True
+                self._cond.wait(remaining)
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._opening += 1
+            generation = self._generation
+        
+        if conn is not None and not self._healthy(conn):
+            with self._cond:
+                self._discard(conn)
+                self._opening += 1
+                self.replaced += 1
+            conn = None
+        if conn is None:
+            try:
+                conn = self._open()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+                    if conn is not None:
+                        self._generations[conn] = generation
+                    else:
+                        self._cond.notify()
+        
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+                self.wait_seconds += elapsed
+                self.max_wait = max(self.max_wait, elapsed)
+        return conn
+    
+    def _checkin(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            if self._generations.get(conn) != self._generation:
+                self._discard(conn)
+            else:
+                self._idle.append(conn)
+                self._cond.notify()
+    
+    @contextmanager
+    def connection(self):
+        """借出连接（同一线程嵌套调用返回同一连接）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._checkin(conn)
+    
+    def close_all(self, before_close=None):
+        """
+        关闭所有连接：空闲的立即关闭，借出中的在归还时关闭
+        
+        Args:
+            before_close: 关闭前对其中一个空闲连接执行的回调（如 PRAGMA optimize）
+        """
+        with self._cond:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+            if idle and before_close:
+                try:
+                    before_close(idle[0])
+                except sqlite3.Error:
+                    pass
+            for conn in idle:
+                self._discard(conn)
+            self._cond.notify_all()
+    
+    def stats(self) -> Dict[str, Any]:
+        """连接池统计（等待时间单位：秒）"""
+        with self._cond:
+            return {
+                'size': self.size,
+                'open': len(self._generations),
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+                'max_wait': self.max_wait,
+                'replaced': self.replaced,
+            }
+
 
 class DatabaseManager:
     """线程安全的数据库管理器（单例模式）"""
@@ -367,36 +960,45 @@ class DatabaseManager:
             db_path = r'F:\Pic\Gelbooru\new\gelbooru_metadata.db'
         
         self.db_path = db_path
-        self._thread_local = threading.local()
+        self._pool = ConnectionPool(db_path, DB_POOL_SIZE, configure=self._configure)
+        self._checkpointer = None  # (线程, 停止事件)
         self._initialized = True
         self._init_database()
     
-    def _get_connection(self) -> sqlite3.Connection:
-        """获取线程本地连接"""
-        if not hasattr(self._thread_local, 'connection'):
-            self._thread_local.connection = sqlite3.connect(
-                self.db_path,
-                check_same_thread=False,
-                timeout=30.0
-            )
-            self._thread_local.connection.row_factory = sqlite3.Row
-            # 启用 WAL 模式提升并发性能
-            self._thread_local.connection.execute('PRAGMA journal_mode=WAL')
-            self._thread_local.connection.execute('PRAGMA synchronous=NORMAL')
-        return self._thread_local.connection
+    @staticmethod
+    def _configure(conn: sqlite3.Connection):
+        """新连接的一次性设置（连接池创建连接时调用）"""
+        conn.row_factory = sqlite3.Row
+        # 启用 WAL 模式提升并发性能
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        # 按运行时配置设置缓存、内存映射、临时存储和 WAL 截断上限
+        conn.execute(f'PRAGMA cache_size={-(DB_CACHE_SIZE // 1024)}')
+        conn.execute(f'PRAGMA mmap_size={int(DB_MMAP_SIZE)}')
+        conn.execute(f'PRAGMA temp_store={DB_TEMP_STORE}')
+        conn.execute(f'PRAGMA journal_size_limit={int(DB_WAL_MAX_SIZE)}')
+    
+    def connection(self):
+        """从连接池借出连接的上下文管理器（同一线程嵌套借用得到同一连接）"""
+        return self._pool.connection()
+    
+    def pool_stats(self) -> Dict[str, Any]:
+        """连接池统计（借出次数、池满等待次数和时间）"""
+        return self._pool.stats()
+    
     @contextmanager
     def get_cursor(self):
         """获取游标的上下文管理器"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        try:
-            yield cursor
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            cursor.close()
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cursor.close()
     
     def _init_database(self):
         """初始化数据库结构"""
@@ -406,26 +1008,8 @@ class DatabaseManager:
             os.makedirs(db_dir, exist_ok=True)
         
         with self.get_cursor() as cursor:
-            # 1. 图片信息表（保留所有原始元数据）
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS pictures (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    pic_id TEXT NOT NULL,
-                    tag_name TEXT NOT NULL,
-                    filename TEXT NOT NULL,
-                    new_filename TEXT,
-                    file_path TEXT NOT NULL,
-                    file_size INTEGER,
-                    pic_url TEXT,
-                    pic_tags TEXT,
-                    pic_time TEXT,
-                    pic_date TEXT,
-                    download_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    status TEXT DEFAULT 'downloaded',
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(pic_id, tag_name)
-                )
-            """)
+            # 新库使用增量 VACUUM（已有表的库需要 Mode 9 维护时 VACUUM 一次才生效）
+            cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
             
             # 2. 失败记录表
             cursor.execute("""
@@ -437,9 +1021,15 @@ class DatabaseManager:
                     pic_id TEXT,
                     pic_filename TEXT,
                     pic_tags TEXT,
-           created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    retry_count INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    status INTEGER NOT NULL DEFAULT 0,
+                    next_retry_at DATETIME,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            self._upgrade_failed_downloads(cursor)
             
             # 3. 标签下载进度表
             cursor.execute("""
@@ -456,10 +1046,6 @@ class DatabaseManager:
             """)
             
             # 创建索引
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_tag_name ON pictures(tag_name)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_pic_id ON pictures(pic_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_filename ON pictures(filename)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_download_time ON pictures(download_time)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_tag_progress_status ON tag_progress(status)')
             
             # 4. 每日查询统计表
@@ -471,50 +1057,578 @@ class DatabaseManager:
                 )
             """)
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_daily_query_date ON daily_query_stats(query_date)')
+            
+            # 5. 标签轮换目录（tags.txt 的数据库版本，按 last_checked 升序即为 Mode 3 轮换顺序）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS tag_catalog (
+                    tag TEXT PRIMARY KEY,
+                    last_checked INTEGER NOT NULL
+                )
+            """)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_tag_catalog_last_checked ON tag_catalog(last_checked)')
+            
+            # 6. 标签下载时间历史（替代 downtag.txt，保留全部时间戳）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS tag_time_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tag TEXT NOT NULL,
+                    tag_time TEXT NOT NULL,
+                    recorded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_tag_time_history_tag ON tag_time_history(tag, id)')
+            
+            # 7. 状态键值表（记录导出文件状态等）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS kv_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """)
+        
+        # 1. 图片信息（旧结构不自动迁移：迁移不可逆且耗时，只由 python main.py 9 migrate 执行）
+        self.legacy_schema = self._is_legacy_schema()
+        if self.legacy_schema:
+            print('⚠️  数据库仍是旧的 pictures 结构，请先运行: python main.py 9 migrate')
+            return
+        with self.get_cursor() as cursor:
+            self._create_picture_schema(cursor)
+        
+        # 8. 每日统计汇总（触发器随 pictures 写入增量维护）
+        with self.get_cursor() as cursor:
+            self._create_rollups(cursor)
+    
+    # ============ 每日统计汇总 ============
+    #
+    # daily_rollup     (day → files, bytes, tags, queried)   tags 为当天有下载的不同 tag_name 数
+    # tag_daily_rollup (day, tag_name → files, bytes)
+    # day = DATE(download_time)，与原来 analyze_log 的分组方式一致
+    
+    # pictures 行加入汇总（{r} 为 new 或 old）
+    _ROLLUP_ADD = """
+                INSERT INTO daily_rollup (day, files, bytes, tags, queried)
+                VALUES (DATE({r}.download_time), 0, 0, 0, 0)
+                ON CONFLICT(day) DO NOTHING;
+                UPDATE daily_rollup SET tags = tags + 1
+                WHERE day = DATE({r}.download_time) AND NOT EXISTS (
+                    SELECT 1 FROM tag_daily_rollup
+                    WHERE day = DATE({r}.download_time) AND tag_name = {r}.tag_name);
+                INSERT INTO tag_daily_rollup (day, tag_name, files, bytes)
+                VALUES (DATE({r}.download_time), {r}.tag_name, 1, COALESCE({r}.file_size, 0))
+                ON CONFLICT(day, tag_name) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;
+                UPDATE daily_rollup SET files = files + 1, bytes = bytes + COALESCE({r}.file_size, 0)
+                WHERE day = DATE({r}.download_time);"""
+    
+    # pictures 行移出汇总
+    _ROLLUP_REMOVE = """
+                UPDATE tag_daily_rollup SET files = files - 1, bytes = bytes - COALESCE({r}.file_size, 0)
+                WHERE day = DATE({r}.download_time) AND tag_name = {r}.tag_name;
+                UPDATE daily_rollup SET files = files - 1, bytes = bytes - COALESCE({r}.file_size, 0),
+                    tags = tags - (SELECT COUNT(*) FROM tag_daily_rollup
+                                   WHERE day = DATE({r}.download_time) AND tag_name = {r}.tag_name AND files <= 0)
+                WHERE day = DATE({r}.download_time);
+                DELETE FROM tag_daily_rollup
+                WHERE day = DATE({r}.download_time) AND tag_name = {r}.tag_name AND files <= 0;"""
+    
+    def _create_rollups(self, cursor):
+        """创建汇总表和触发器，首次创建时从 pictures 回填"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name='daily_rollup'")
+        existed = cursor.fetchone() is not None
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_rollup (
+                day TEXT PRIMARY KEY,
+                files INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                tags INTEGER NOT NULL DEFAULT 0,
+                queried INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tag_daily_rollup (
+                day TEXT NOT NULL,
+                tag_name TEXT NOT NULL,
+                files INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, tag_name)
+            ) WITHOUT ROWID
+        """)
+        
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS pictures_rollup_ai AFTER INSERT ON pictures BEGIN
+                {self._ROLLUP_ADD.format(r='new')}
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS pictures_rollup_ad AFTER DELETE ON pictures BEGIN
+                {self._ROLLUP_REMOVE.format(r='old')}
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS pictures_rollup_au
+            AFTER UPDATE OF download_time, tag_name, file_size ON pictures BEGIN
+                {self._ROLLUP_REMOVE.format(r='old')}
+                {self._ROLLUP_ADD.format(r='new')}
+            END
+        """)
+        
+        # 查询tag数同步到 daily_rollup.queried
+        for event in ('INSERT', 'UPDATE'):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS daily_query_rollup_{event.lower()}
+                AFTER {event} ON daily_query_stats BEGIN
+                    INSERT INTO daily_rollup (day, queried) VALUES (new.query_date, new.queried_count)
+                    ON CONFLICT(day) DO UPDATE SET queried = excluded.queried;
+                END
+            """)
+        
+        if not existed:
+            cursor.execute('SELECT 1 FROM pictures LIMIT 1')
+            if cursor.fetchone():
+                print('首次创建每日统计汇总，回填历史数据...')
+                self._fill_rollups(cursor)
+    
+    def _fill_rollups(self, cursor):
+        """从 pictures 和 daily_query_stats 重新计算汇总（调用方持有事务）"""
+        cursor.execute('DELETE FROM tag_daily_rollup')
+        cursor.execute('DELETE FROM daily_rollup')
+        cursor.execute("""
+            INSERT INTO tag_daily_rollup (day, tag_name, files, bytes)
+            SELECT DATE(download_time), tag_name, COUNT(*), SUM(COALESCE(file_size, 0))
+            FROM pictures
+            GROUP BY DATE(download_time), tag_name
+        """)
+        cursor.execute("""
+            INSERT INTO daily_rollup (day, files, bytes, tags, queried)
+            SELECT day, SUM(files), SUM(bytes), COUNT(*), 0
+            FROM tag_daily_rollup
+            GROUP BY day
+        """)
+        cursor.execute("""
+            INSERT INTO daily_rollup (day, queried)
+            SELECT query_date, queried_count FROM daily_query_stats WHERE true
+            ON CONFLICT(day) DO UPDATE SET queried = excluded.queried
+        """)
+    
+    def rebuild_rollups(self) -> Dict[str, Any]:
+        """重建每日统计汇总（修复或补历史数据）"""
+        start = time.time()
+        with self.get_cursor() as cursor:
+            self._fill_rollups(cursor)
+            cursor.execute('SELECT COUNT(*) FROM daily_rollup')
+            days = cursor.fetchone()[0]
+            cursor.execute('SELECT COUNT(*) FROM tag_daily_rollup')
+            tag_days = cursor.fetchone()[0]
+        return {'days': days, 'tag_days': tag_days, 'seconds': time.time() - start}
+    
+    # ============ 图片表结构 / 迁移 ============
+    
+    def _is_legacy_schema(self) -> bool:
+        """pictures 是否为旧结构（每行保存完整 pic_tags）"""
+        with self.get_cursor() as cursor:
+            cursor.execute('PRAGMA table_info(pictures)')
+            columns = {row[1] for row in cursor.fetchall()}
+        return 'pic_tags' in columns
+    
+    def _create_picture_schema(self, cursor):
+        """创建 posts / tag_dict / post_tags / pictures 及 picture_view"""
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS posts (
+                pic_id INTEGER PRIMARY KEY,
+                pic_url TEXT,
+                pic_time TEXT,
+                pic_date TEXT,
+                tag_ids TEXT
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tag_dict (
+                id INTEGER PRIMARY KEY,
+                tag TEXT NOT NULL UNIQUE
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS post_tags (
+                tag_id INTEGER NOT NULL,
+                post_id INTEGER NOT NULL,
+                PRIMARY KEY (tag_id, post_id)
+            ) WITHOUT ROWID
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pictures (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pic_id INTEGER NOT NULL,
+                tag_name TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                new_filename TEXT,
+                file_path TEXT NOT NULL,
+                file_size INTEGER,
+                download_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+                status TEXT DEFAULT 'downloaded',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(pic_id, tag_name)
+            )
+        """)
+        # UNIQUE(pic_id, tag_name) 已覆盖按 pic_id 查询，不再单独建 pic_id 索引
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_tag_name ON pictures(tag_name)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_filename ON pictures(filename)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pictures_download_time ON pictures(download_time)')
+        
+        cursor.execute('DROP VIEW IF EXISTS picture_view')
+        cursor.execute(f"""
+            CREATE VIEW picture_view AS
+            {picture_select('1')}
+        """)
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    
+    def _db_size(self) -> int:
+        """数据库文件大小（含 WAL）"""
+        total = 0
+        for path in (self.db_path, self.db_path + '-wal'):
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+    
+    def migrate_schema(self) -> Dict[str, Any]:
+        """
+        将旧 pictures 表迁移为 posts / tag_dict / post_tags / pictures 结构
+        
+        - pic_id 转为整数；非数字 pic_id 的行保留在 pictures_unmigrated 表
+        - 同一帖子有多行时，帖子元数据和tag取最新的一行
+        - 删除旧的 pictures_fts 全文索引（tag搜索改用 post_tags 索引）
+        - 完成后 VACUUM，并报告迁移前后的数据库大小
+        
+        Returns:
+            dict: {migrated, size_before, size_after, posts, tags, post_tags, pictures, unmigrated, seconds}
+        """
+        if not self._is_legacy_schema():
+            size = self._db_size()
+            return {'migrated': False, 'size_before': size, 'size_after': size}
+        
+        print('迁移图片表结构（posts / tag_dict / post_tags）...')
+        start = time.time()
+        size_before = self._db_size()
+        numeric = "pic_id GLOB '[0-9]*' AND pic_id NOT GLOB '*[^0-9]*' AND length(pic_id) < 19"
+        latest = f'SELECT MAX(id) FROM pictures_legacy WHERE {numeric} GROUP BY CAST(pic_id AS INTEGER)'
+        stats = {}
+        
+        with self.get_cursor() as cursor:
+            for trigger in ('pictures_fts_ai', 'pictures_fts_ad', 'pictures_fts_au'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            cursor.execute('DROP TABLE IF EXISTS pictures_fts')
+            for index in ('idx_pictures_tag_name', 'idx_pictures_pic_id',
+                          'idx_pictures_filename', 'idx_pictures_download_time'):
+                cursor.execute(f'DROP INDEX IF EXISTS {index}')
+            cursor.execute('ALTER TABLE pictures RENAME TO pictures_legacy')
+            self._create_picture_schema(cursor)
+            
+            # 帖子元数据 + tag_ids（每个 pic_id 一行，按 pic_id 顺序写入）
+            tag_ids = {}
+            batch = []
+            stats['posts'] = 0
+            reader = cursor.connection.cursor()
+            reader.execute(f"""
+                SELECT CAST(pic_id AS INTEGER) AS post_id, pic_url, pic_time, pic_date, pic_tags
+                FROM pictures_legacy WHERE id IN ({latest})
+                ORDER BY post_id
+            """)
+            for post_id, pic_url, pic_time, pic_date, pic_tags in reader:
+                ids = []
+                for tag in (pic_tags or '').split():
+                    tag_id = tag_ids.get(tag)
+                    if tag_id is None:
+                        tag_id = tag_ids[tag] = len(tag_ids) + 1
+                    ids.append(tag_id)
+                batch.append((post_id, pic_url, pic_time, pic_date, json.dumps(ids) if pic_tags else None))
+                if len(batch) >= 50000:
+                    cursor.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?)', batch)
+                    stats['posts'] += len(batch)
+                    batch = []
+            reader.close()
+            if batch:
+                cursor.executemany('INSERT INTO posts VALUES (?, ?, ?, ?, ?)', batch)
+                stats['posts'] += len(batch)
+            cursor.executemany('INSERT INTO tag_dict (id, tag) VALUES (?, ?)',
+                               ((tag_id, tag) for tag, tag_id in tag_ids.items()))
+            stats['tags'] = len(tag_ids)
+            
+            # tag 索引（按主键顺序排序后写入）
+            cursor.execute("""
+                INSERT OR IGNORE INTO post_tags (tag_id, post_id)
+                SELECT j.value, p.pic_id FROM posts p, json_each(p.tag_ids) j
+                ORDER BY 1, 2
+            """)
+            stats['post_tags'] = cursor.rowcount
+            
+            # 文件链接（重复的 pic_id+tag_name 保留最新一行）
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO pictures
+                (id, pic_id, tag_name, filename, new_filename, file_path, file_size,
+                 download_time, status, created_at)
+                SELECT id, CAST(pic_id AS INTEGER), tag_name, filename, new_filename, file_path, file_size,
+                       download_time, status, created_at
+                FROM pictures_legacy WHERE {numeric}
+                ORDER BY id DESC
+            """)
+            stats['pictures'] = cursor.rowcount
+            
+            cursor.execute(f'SELECT COUNT(*) FROM pictures_legacy WHERE NOT ({numeric})')
+            stats['unmigrated'] = cursor.fetchone()[0]
+            if stats['unmigrated']:
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS pictures_unmigrated AS
+                    SELECT * FROM pictures_legacy WHERE NOT ({numeric})
+                """)
+            cursor.execute('DROP TABLE pictures_legacy')
+        
+        with self.connection() as conn:
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        
+        # 打开数据库时旧结构跳过了汇总表，迁移后补建（从 pictures 回填）
+        self.legacy_schema = False
+        with self.get_cursor() as cursor:
+            self._create_rollups(cursor)
+        
+        stats.update({
+            'migrated': True,
+            'size_before': size_before,
+            'size_after': self._db_size(),
+            'seconds': time.time() - start,
+        })
+        print(f"迁移完成: {stats['posts']} 个帖子, {stats['tags']} 个tag, "
+              f"{stats['pictures']} 个文件记录, 未迁移 {stats['unmigrated']} 行, 耗时 {stats['seconds']:.1f} 秒")
+        print(f"数据库大小: {format_size(size_before)} -> {format_size(stats['size_after'])}")
+        return stats
+    
+    def rebuild_tag_index(self) -> Dict[str, Any]:
+        """
+        从 posts.tag_ids 重建 tag 搜索索引 post_tags，并删除没有帖子引用的 tag_dict 条目
+        
+        post_tags 由写入时同步维护，这里用于修复（中断的批量写入、手动改库后两者不一致），完成后 ANALYZE
+        
+        Returns:
+            dict: {'post_tags', 'tags', 'removed_tags', 'seconds'}
+        """
+        start = time.time()
+        with self.get_cursor() as cursor:
+            cursor.execute('DELETE FROM post_tags')
+            cursor.execute("""
+                INSERT OR IGNORE INTO post_tags (tag_id, post_id)
+                SELECT j.value, p.pic_id FROM posts p, json_each(p.tag_ids) j
+                ORDER BY 1, 2
+            """)
+            post_tags = cursor.rowcount
+            cursor.execute('DELETE FROM tag_dict WHERE id NOT IN (SELECT tag_id FROM post_tags)')
+            removed_tags = cursor.rowcount
+            cursor.execute('SELECT COUNT(*) FROM tag_dict')
+            tags = cursor.fetchone()[0]
+            cursor.execute('ANALYZE post_tags')
+            cursor.execute('ANALYZE tag_dict')
+        return {'post_tags': post_tags, 'tags': tags, 'removed_tags': removed_tags,
+                'seconds': time.time() - start}
+    
+    def _intern_tags(self, cursor, tags: List[str]) -> Dict[str, int]:
+        """tag 文本 -> tag_dict.id（不存在的自动添加）"""
+        unique = list(dict.fromkeys(tags))
+        if not unique:
+            return {}
+        payload = json.dumps(unique, ensure_ascii=False)
+        cursor.execute('INSERT OR IGNORE INTO tag_dict (tag) SELECT value FROM json_each(?)', (payload,))
+        cursor.execute('SELECT tag, id FROM tag_dict WHERE tag IN (SELECT value FROM json_each(?))', (payload,))
+        return {row[0]: row[1] for row in cursor.fetchall()}
+    
+    def _set_post_tag_ids(self, cursor, post_id: int, ids: List[int]):
+        """写入帖子的 tag_ids，并同步 post_tags 索引"""
+        cursor.execute('SELECT tag_ids FROM posts WHERE pic_id=?', (post_id,))
+        row = cursor.fetchone()
+        if row and row[0]:
+            cursor.execute('DELETE FROM post_tags WHERE post_id=? AND tag_id IN (SELECT value FROM json_each(?))',
+                           (post_id, row[0]))
+        cursor.execute('UPDATE posts SET tag_ids=? WHERE pic_id=?', (json.dumps(ids), post_id))
+        cursor.executemany('INSERT OR IGNORE INTO post_tags (tag_id, post_id) VALUES (?, ?)',
+                           [(tag_id, post_id) for tag_id in set(ids)])
+    
+    def _set_post_tags(self, cursor, post_id: int, pic_tags: str):
+        """用空格分隔的 pic_tags 替换帖子的tag列表"""
+        tags = pic_tags.split()
+        tag_ids = self._intern_tags(cursor, tags)
+        self._set_post_tag_ids(cursor, post_id, [tag_ids[tag] for tag in tags])
+    
+    def _upsert_post(self, cursor, post_id: int, pic_data: Dict[str, Any]):
+        """写入帖子元数据（空值不覆盖已有值）"""
+        cursor.execute("""
+            INSERT INTO posts (pic_id, pic_url, pic_time, pic_date)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(pic_id) DO UPDATE SET
+                pic_url=COALESCE(NULLIF(excluded.pic_url, ''), pic_url),
+                pic_time=COALESCE(NULLIF(excluded.pic_time, ''), pic_time),
+                pic_date=COALESCE(NULLIF(excluded.pic_date, ''), pic_date)
+        """, (post_id, pic_data.get('pic_url'), pic_data.get('pic_time'), pic_data.get('pic_date')))
+        if pic_data.get('pic_tags'):
+            self._set_post_tags(cursor, post_id, pic_data['pic_tags'])
     
     # ============ 图片操作 ============
     
     def add_picture(self, pic_data: Dict[str, Any]) -> int:
-        """添加图片记录"""
+        """添加图片记录（帖子元数据写入 posts/post_tags，文件信息写入 pictures）"""
+        post_id = to_pic_id(pic_data['pic_id'])
+        if post_id is None:
+            return 0
         with self.get_cursor() as cursor:
+            self._upsert_post(cursor, post_id, pic_data)
             cursor.execute("""
-                INSERT OR REPLACE INTO pictures 
-                (pic_id, tag_name, filename, new_filename, file_path, 
-                 file_size, pic_url, pic_tags, pic_time, pic_date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                INSERT INTO pictures 
+                (pic_id, tag_name, filename, new_filename, file_path, file_size)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(pic_id, tag_name) DO UPDATE SET
+                    filename=excluded.filename,
+                    new_filename=excluded.new_filename,
+                    file_path=excluded.file_path,
+                    file_size=excluded.file_size,
+                    download_time=CURRENT_TIMESTAMP,
+                    status='downloaded',
+                    created_at=CURRENT_TIMESTAMP
             """, (
-                pic_data['pic_id'],
+                post_id,
                 pic_data['tag_name'],
                 pic_data['filename'],
                 pic_data.get('new_filename'),
                 pic_data['file_path'],
-                pic_data.get('file_size'),
-                pic_data.get('pic_url'),
-                pic_data.get('pic_tags'),
-                pic_data.get('pic_time'),
-                pic_data.get('pic_date')
+                pic_data.get('file_size')
             ))
-            return cursor.lastrowid
+            cursor.execute('SELECT id FROM pictures WHERE pic_id=? AND tag_name=?',
+                           (post_id, pic_data['tag_name']))
+            return cursor.fetchone()[0]
+    
+    def add_pictures_bulk(self, pics: List[Dict[str, Any]]) -> int:
+        """
+        批量添加图片记录（Mode 7专用，字段与 add_picture 相同）
+        
+        全部行在一个事务中用 executemany 写入，tag 一次性批量登记。
+        
+        Returns:
+            int: 写入的记录数
+        """
+        rows = []
+        for pic_data in pics:
+            post_id = to_pic_id(pic_data['pic_id'])
+            if post_id is not None:
+                rows.append((post_id, pic_data))
+        if not rows:
+            return 0
+        
+        with self.get_cursor() as cursor:
+            cursor.executemany("""
+                INSERT INTO posts (pic_id, pic_url, pic_time, pic_date)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(pic_id) DO UPDATE SET
+                    pic_url=COALESCE(NULLIF(excluded.pic_url, ''), pic_url),
+                    pic_time=COALESCE(NULLIF(excluded.pic_time, ''), pic_time),
+                    pic_date=COALESCE(NULLIF(excluded.pic_date, ''), pic_date)
+            """, [(post_id, d.get('pic_url'), d.get('pic_time'), d.get('pic_date')) for post_id, d in rows])
+            
+            # 帖子tag: 先统一登记 tag_dict，再批量替换 tag_ids 和 post_tags
+            # 同一帖子出现多次时以最后一行为准（与逐行 add_picture 的结果一致）
+            tagged = {post_id: d['pic_tags'].split() for post_id, d in rows if d.get('pic_tags')}
+            if tagged:
+                tag_ids = self._intern_tags(cursor, [tag for tags in tagged.values() for tag in tags])
+                id_lists = [(post_id, [tag_ids[tag] for tag in tags]) for post_id, tags in tagged.items()]
+                cursor.executemany("""
+                    DELETE FROM post_tags WHERE post_id=? AND tag_id IN
+                        (SELECT value FROM json_each((SELECT tag_ids FROM posts WHERE pic_id=?)))
+                """, [(post_id, post_id) for post_id, _ in id_lists])
+                cursor.executemany('UPDATE posts SET tag_ids=? WHERE pic_id=?',
+                                   [(json.dumps(ids), post_id) for post_id, ids in id_lists])
+                cursor.executemany('INSERT OR IGNORE INTO post_tags (tag_id, post_id) VALUES (?, ?)',
+                                   [(tag_id, post_id) for post_id, ids in id_lists for tag_id in set(ids)])
+            
+            cursor.executemany("""
+                INSERT INTO pictures 
+                (pic_id, tag_name, filename, new_filename, file_path, file_size)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(pic_id, tag_name) DO UPDATE SET
+                    filename=excluded.filename,
+                    new_filename=excluded.new_filename,
+                    file_path=excluded.file_path,
+                    file_size=excluded.file_size,
+                    download_time=CURRENT_TIMESTAMP,
+                    status='downloaded',
+                    created_at=CURRENT_TIMESTAMP
+            """, [(post_id, d['tag_name'], d['filename'], d.get('new_filename'), d['file_path'], d.get('file_size'))
+                  for post_id, d in rows])
+            return len(rows)
     
     def picture_exists(self, pic_id: str, tag_name: Optional[str] = None) -> bool:
         """检查图片是否存在"""
+        post_id = to_pic_id(pic_id)
+        if post_id is None:
+            return False
         with self.get_cursor() as cursor:
             if tag_name:
                 cursor.execute(
                     'SELECT 1 FROM pictures WHERE pic_id=? AND tag_name=? LIMIT 1',
-                    (pic_id, tag_name)
+                    (post_id, tag_name)
                 )
             else:
                 cursor.execute(
                     'SELECT 1 FROM pictures WHERE pic_id=? LIMIT 1',
-            (pic_id,)
+                    (post_id,)
                 )
             return cursor.fetchone() is not None
     
+    def iter_pictures(self, where: str = '1', params: Tuple = (), columns: Optional[List[str]] = None,
+                      order_by_time: bool = False, page_size: int = 1000) -> Iterator[tuple]:
+        """
+        流式遍历图片（键集分页：每页一个短查询，从上一页最后一行的位置继续）
+        
+        Args:
+            where: 筛选条件（用 pl./po. 引用基础表列）
+            params: 条件参数
+            columns: 投影列（PICTURE_COLUMNS 的键，默认旧行结构全部列）
+            order_by_time: True=按 pic_time 降序，False=按 id 升序（走主键，最快）
+            page_size: 每页行数
+        
+        Yields:
+            namedtuple 行，字段即 columns
+        """
+        columns = tuple(columns or PICTURE_FIELDS)
+        row_type = picture_row_type(columns)
+        width = len(columns)
+        projection = ', '.join(f'{PICTURE_COLUMNS[c]} AS {c}' for c in columns)
+        
+        if order_by_time:
+            keys = "COALESCE(po.pic_time, ''), pl.id"
+            seek = f'({keys}) < (?, ?)'
+            order = "COALESCE(po.pic_time, '') DESC, pl.id DESC"
+        else:
+            keys = 'pl.id'
+            seek = 'pl.id > ?'
+            order = 'pl.id'
+        base = f'SELECT {projection}, {keys} FROM {PICTURE_FROM} WHERE ({where})'
+        
+        last = ()
+        while True:
+            query = base + (f' AND {seek}' if last else '') + f' ORDER BY {order} LIMIT ?'
+            with self.get_cursor() as cursor:
+                cursor.execute(query, (*params, *last, page_size))
+                rows = cursor.fetchall()
+            for row in rows:
+                yield row_type._make(row[:width])
+            if len(rows) < page_size:
+                return
+            last = tuple(rows[-1][width:])
+    
+    def iter_pictures_by_tag(self, tag_name: str, columns: Optional[List[str]] = None,
+                             order_by_time: bool = False, page_size: int = 1000) -> Iterator[tuple]:
+        """流式遍历标签下的图片（见 iter_pictures）"""
+        return self.iter_pictures('pl.tag_name=?', (tag_name,), columns, order_by_time, page_size)
+    
     def get_pictures_by_tag(self, tag_name: str, limit: Optional[int] = None) -> List[Dict]:
         """获取标签下的所有图片"""
         with self.get_cursor() as cursor:
-            query = 'SELECT * FROM pictures WHERE tag_name=? ORDER BY pic_time DESC'
+            query = picture_select('pl.tag_name=?') + ' ORDER BY pic_time DESC'
             if limit:
                 query += f' LIMIT {limit}'
             cursor.execute(query, (tag_name,))
@@ -523,47 +1637,290 @@ class DatabaseManager:
     def get_picture_by_filename(self, filename: str) -> Optional[Dict]:
         """根据文件名查询图片信息"""
         with self.get_cursor() as cursor:
-            cursor.execute('SELECT * FROM pictures WHERE filename=? LIMIT 1', (filename,))
+            cursor.execute(picture_select('pl.filename=?') + ' LIMIT 1', (filename,))
             row = cursor.fetchone()
             return dict(row) if row else None
     
-    def search_pictures_by_tags(self, tags: List[str], match_all: bool = False) -> List[Dict]:
+    def search_pictures_by_tags(self, tags: List[str], match_all: bool = False,
+                                exclude: Optional[List[str]] = None) -> List[Dict]:
         """
-        根据标签搜索图片
+        根据标签搜索图片（精确匹配整个tag，使用 post_tags(tag_id, post_id) 主键）
         
         Args:
             tags: 标签列表，例如 ['tag1', 'tag_2']
             match_all: True=必须包含所有标签，False=包含任意标签
+            exclude: 不能包含的标签列表
         
         Returns:
             图片列表
         """
+        where, params = self._tag_filter(tags, match_all, exclude)
         with self.get_cursor() as cursor:
+            cursor.execute(picture_select(where) + ' ORDER BY pic_time DESC', params)
+            return [dict(row) for row in cursor.fetchall()]
+    
+    @staticmethod
+    def _tag_filter(tags: List[str], match_all: bool, exclude: Optional[List[str]]) -> Tuple[str, Tuple]:
+        """标签搜索条件 -> (where, params)"""
+        posts_with = ('SELECT post_id FROM post_tags WHERE tag_id IN '
+                      '(SELECT id FROM tag_dict WHERE tag IN (SELECT value FROM json_each(?)))')
+        clauses = []
+        params = []
+        if tags:
+            tags = list(dict.fromkeys(tags))
             if match_all:
-                # 必须包含所有标签
-                conditions = ' AND '.join(['pic_tags LIKE ?' for _ in tags])
-                params = [f'%{tag}%' for tag in tags]
-                query = f'SELECT * FROM pictures WHERE {conditions} ORDER BY pic_time DESC'
+                clauses.append(f'pl.pic_id IN ({posts_with} GROUP BY post_id HAVING COUNT(*) = ?)')
+                params.extend([json.dumps(tags, ensure_ascii=False), len(tags)])
             else:
-                # 包含任意标签
-                conditions = ' OR '.join(['pic_tags LIKE ?' for _ in tags])
-                params = [f'%{tag}%' for tag in tags]
-                query = f'SELECT * FROM pictures WHERE {conditions} ORDER BY pic_time DESC'
-            
-            cursor.execute(query, params)
-            return [dict(row) for row in cursor.fetchall()]
+                clauses.append(f'pl.pic_id IN ({posts_with})')
+                params.append(json.dumps(tags, ensure_ascii=False))
+        if exclude:
+            clauses.append(f'pl.pic_id NOT IN ({posts_with})')
+            params.append(json.dumps(exclude, ensure_ascii=False))
+        return ' AND '.join(clauses) or '1', tuple(params)
     
     # ============ 失败记录操作 ============
+    #
+    # 每个 (FAILED_KEY, tag_name) 只有一行：重复失败累加 retry_count、更新 last_error；
+    # Mode 10 重试失败后按 FAILED_RETRY_BACKOFF×2^retry_count 推迟 next_retry_at，超过 FAILED_MAX_RETRIES 次放弃；
+    # 已解决/放弃的以及长期未更新的行由 archive_failed_downloads 移入按年份的 archive_YYYY.db
+    
+    def _upgrade_failed_downloads(self, cursor):
+        """旧表加上 retry_count / last_error / status / updated_at / next_retry_at，并按 (FAILED_KEY, tag_name) 去重"""
+        cursor.execute('PRAGMA table_info(failed_downloads)')
+        columns = {row[1] for row in cursor.fetchall()}
+        if 'next_retry_at' not in columns:
+            cursor.execute('ALTER TABLE failed_downloads ADD COLUMN next_retry_at DATETIME')
+        if 'status' not in columns:
+            for column in ('retry_count INTEGER NOT NULL DEFAULT 0', 'last_error TEXT',
+                           'status INTEGER NOT NULL DEFAULT 0', 'updated_at DATETIME'):
+                cursor.execute(f'ALTER TABLE failed_downloads ADD COLUMN {column}')
+            cursor.execute('UPDATE failed_downloads SET updated_at = created_at')
+        
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_failed_key'")
+        if not cursor.fetchone():
+            # 同一去重键+tag 保留最新一行，合并掉的行数加到重试次数上
+            # （旧版的 (pic_id, tag_name) 唯一索引不管 pic_id 为 NULL 的行，这里一并去重）
+            cursor.execute('DROP INDEX IF EXISTS idx_failed_pic_tag')
+            cursor.execute('CREATE TEMP TABLE failed_latest (id INTEGER PRIMARY KEY, retries INTEGER)')
+            cursor.execute(f"""
+                INSERT INTO failed_latest
+                SELECT MAX(id), SUM(retry_count) + COUNT(*) - 1 FROM failed_downloads
+                GROUP BY {FAILED_KEY}, tag_name
+            """)
+            cursor.execute('DELETE FROM failed_downloads WHERE id NOT IN (SELECT id FROM failed_latest)')
+            cursor.execute("""
+                UPDATE failed_downloads SET
+                    retry_count = (SELECT retries FROM failed_latest l WHERE l.id = failed_downloads.id)
+            """)
+            cursor.execute('DROP TABLE failed_latest')
+            cursor.execute(f'CREATE UNIQUE INDEX idx_failed_key ON failed_downloads({FAILED_KEY}, tag_name)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_failed_status ON failed_downloads(status, updated_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_failed_retry ON failed_downloads(status, next_retry_at)')
     
     def add_failed_download(self, tag_name: str, pic_url: str, pic_time: str, 
-                           pic_id: str, pic_filename: str, pic_tags: str):
-        """记录失败的下载"""
+                           pic_id: str, pic_filename: str, pic_tags: str, error: Optional[str] = None) -> bool:
+        """记录失败的下载，返回是否为首次失败"""
+        return bool(self.add_failed_downloads([{
+            'tag': tag_name, 'url': pic_url, 'time': pic_time, 'id': pic_id,
+            'filename': pic_filename, 'tags': pic_tags, 'error': error,
+        }]))
+    
+    def add_failed_downloads(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        批量记录失败的下载（单个事务，按 (FAILED_KEY, tag_name) 去重，pic_id 为空时按 pic_url）
+        
+        Args:
+            records: Downloader 收集的失败记录（tag/url/time/id/filename/tags/error）
+        
+        Returns:
+            首次失败的记录（已有记录的只累加重试次数，不再写入 failed.txt）
+        """
+        new_records = []
+        with self.get_cursor() as cursor:
+            for record in records:
+                cursor.execute(f"""
+                    INSERT INTO failed_downloads
+                    (tag_name, pic_url, pic_time, pic_id, pic_filename, pic_tags, last_error, status, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 0, CURRENT_TIMESTAMP)
+                    ON CONFLICT({FAILED_KEY}, tag_name) DO UPDATE SET
+                        pic_url = excluded.pic_url,
+                        pic_time = excluded.pic_time,
+                        pic_filename = excluded.pic_filename,
+                        pic_tags = excluded.pic_tags,
+                        retry_count = retry_count + 1,
+                        last_error = COALESCE(excluded.last_error, last_error),
+                        status = 0,
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING retry_count
+                """, (record['tag'], record['url'], record['time'], record['id'],
+                      record['filename'], record['tags'], record.get('error')))
+                if cursor.fetchone()[0] == 0:
+                    new_records.append(record)
+        return new_records
+    
+    def resolve_failed_downloads(self) -> int:
+        """图片已在库中的待重试记录标记为已解决，返回条数"""
         with self.get_cursor() as cursor:
             cursor.execute("""
-                INSERT INTO failed_downloads 
-                (tag_name, pic_url, pic_time, pic_id, pic_filename, pic_tags)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (tag_name, pic_url, pic_time, pic_id, pic_filename, pic_tags))
+                UPDATE failed_downloads SET status = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE status = ? AND EXISTS (
+                    SELECT 1 FROM pictures WHERE pictures.pic_id = CAST(failed_downloads.pic_id AS INTEGER)
+                )
+            """, (FAILED_RESOLVED, FAILED_PENDING))
+            return cursor.rowcount
+    
+    def iter_due_failures(self, limit: Optional[int] = None, page_size: int = 500) -> Iterator[Dict[str, Any]]:
+        """
+        流式读取到期的待重试记录（status=0 且 next_retry_at 为空或已过），按 id 分页
+        
+        每页用一次短游标取出（不跨 yield 占用连接），调用方可以边读边写库
+        
+        Args:
+            limit: 最多返回条数（None=全部）
+            page_size: 每页行数
+        """
+        last_id = 0
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            with self.get_cursor() as cursor:
+                cursor.execute("""
+                    SELECT id, tag_name, pic_url, pic_time, pic_id, pic_filename, pic_tags, retry_count
+                    FROM failed_downloads
+                    WHERE id > ? AND status = ?
+                      AND (next_retry_at IS NULL OR next_retry_at <= datetime('now'))
+                    ORDER BY id LIMIT ?
+                """, (last_id, FAILED_PENDING, size))
+                rows = [dict(row) for row in cursor.fetchall()]
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            if remaining is not None:
+                remaining -= len(rows)
+            yield from rows
+    
+    def count_failures(self) -> Dict[str, int]:
+        """失败记录按状态计数: {'due', 'waiting', 'resolved', 'permanent'}"""
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT
+                    COALESCE(SUM(status = ? AND (next_retry_at IS NULL OR next_retry_at <= datetime('now'))), 0),
+                    COALESCE(SUM(status = ? AND next_retry_at > datetime('now')), 0),
+                    COALESCE(SUM(status = ?), 0),
+                    COALESCE(SUM(status = ?), 0)
+                FROM failed_downloads
+            """, (FAILED_PENDING, FAILED_PENDING, FAILED_RESOLVED, FAILED_PERMANENT))
+            due, waiting, resolved, permanent = cursor.fetchone()
+        return {'due': due, 'waiting': waiting, 'resolved': resolved, 'permanent': permanent}
+    
+    def resolve_failed_download(self, failed_id: int):
+        """单条失败记录标记为已解决（重试下载成功）"""
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                UPDATE failed_downloads SET status = ?, last_error = NULL, next_retry_at = NULL,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (FAILED_RESOLVED, failed_id))
+    
+    def reschedule_failed_download(self, failed_id: int, error: Optional[str] = None,
+                                   max_retries: int = FAILED_MAX_RETRIES,
+                                   backoff: int = FAILED_RETRY_BACKOFF) -> Optional[Tuple[int, int, str]]:
+        """
+        重试仍失败：retry_count+1，下次重试推迟 backoff×2^retry_count 秒；达到 max_retries 次标记为放弃
+        
+        Returns:
+            (status, retry_count, next_retry_at)，记录不存在返回 None
+        """
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                UPDATE failed_downloads SET
+                    retry_count = retry_count + 1,
+                    last_error = COALESCE(?, last_error),
+                    status = CASE WHEN retry_count + 1 >= ? THEN ? ELSE ? END,
+                    next_retry_at = datetime('now', '+' || (? << MIN(retry_count + 1, 20)) || ' seconds'),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+                RETURNING status, retry_count, next_retry_at
+            """, (error, max_retries, FAILED_PERMANENT, FAILED_PENDING, int(backoff), failed_id))
+            row = cursor.fetchone()
+        return tuple(row) if row else None
+    
+    def archive_path(self, year: str) -> str:
+        """按年份的归档库路径（与主库同目录）"""
+        return os.path.join(os.path.dirname(os.path.abspath(self.db_path)), f'archive_{year}.db')
+    
+    @contextmanager
+    def attach_archive(self, year: str):
+        """
+        把 archive_YYYY.db 附加为 archive（按需附加，用完分离），产出连接
+        
+        用法: with db.attach_archive('2024') as conn: conn.execute('SELECT ... FROM archive.failed_downloads')
+        """
+        with self.connection() as conn:
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path(year),))
+            try:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS archive.failed_downloads (
+                        id INTEGER PRIMARY KEY,
+                        tag_name TEXT NOT NULL,
+                        pic_url TEXT NOT NULL,
+                        pic_time TEXT,
+                        pic_id TEXT,
+                        pic_filename TEXT,
+                        pic_tags TEXT,
+                        retry_count INTEGER NOT NULL DEFAULT 0,
+                        last_error TEXT,
+                        status INTEGER NOT NULL DEFAULT 0,
+                        created_at DATETIME,
+                        updated_at DATETIME,
+                        archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_failed_pic ON failed_downloads(pic_id)')
+                conn.commit()
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute('DETACH DATABASE archive')
+    
+    def archive_failed_downloads(self, max_age_days: int = FAILED_ARCHIVE_DAYS) -> Dict[str, Any]:
+        """
+        归档失败记录：已解决/放弃的，以及超过 max_age_days 天未更新的，按创建年份移入 archive_YYYY.db
+        
+        先把图片已在库中的记录标记为已解决；移走后做一次 incremental_vacuum 回收空间
+        
+        Returns:
+            {'resolved': int, 'moved': {year: rows}, 'remaining': int}
+        """
+        resolved = self.resolve_failed_downloads()
+        where = "(status != 0 OR COALESCE(updated_at, created_at, '') < datetime('now', ?))"
+        age = f'-{int(max_age_days)} days'
+        year_expr = "strftime('%Y', COALESCE(created_at, updated_at, CURRENT_TIMESTAMP))"
+        
+        with self.get_cursor() as cursor:
+            cursor.execute(f'SELECT DISTINCT {year_expr} FROM failed_downloads WHERE {where}', (age,))
+            years = sorted(row[0] for row in cursor.fetchall())
+        
+        columns = ', '.join(FAILED_COLUMNS)
+        moved = {}
+        for year in years:
+            with self.attach_archive(year) as conn:
+                with conn:
+                    conn.execute(f"""
+                        INSERT OR REPLACE INTO archive.failed_downloads ({columns})
+                        SELECT {columns} FROM main.failed_downloads WHERE {where} AND {year_expr} = ?
+                    """, (age, year))
+                    moved[year] = conn.execute(
+                        f'DELETE FROM main.failed_downloads WHERE {where} AND {year_expr} = ?', (age, year)
+                    ).rowcount
+        
+        with self.connection() as conn:
+            if moved:
+                conn.execute('PRAGMA incremental_vacuum').fetchall()
+            remaining = conn.execute('SELECT COUNT(*) FROM failed_downloads').fetchone()[0]
+        return {'resolved': resolved, 'moved': moved, 'remaining': remaining}
     
     # ============ 标签进度操作 ============
     
@@ -576,6 +1933,23 @@ class DatabaseManager:
                 (tag, startpage, endpage, start_pic, end_pic, status, updated_at)
                 VALUES (?, 1, ?, ?, ?, ?, CURRENT_TIMESTAMP)
             """, (tag, endpage, start_pic, end_pic, status))
+    
+    def init_tag_progress_many(self, rows: List[Tuple]):
+        """
+        批量初始化标签下载进度（单个事务）
+        
+        Args:
+            rows: [(tag, endpage, start_pic, end_pic, status), ...]
+        """
+        if not rows:
+            return
+        with self.get_cursor() as cursor:
+            cursor.executemany("""
+                INSERT OR REPLACE INTO tag_progress 
+                (tag, startpage, endpage, start_pic, end_pic, status, updated_at)
+                VALUES (?, 1, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            """, rows)
+    
     def get_tag_progress(self, tag: str) -> Optional[Dict]:
         """获取标签下载进度"""
         with self.get_cursor() as cursor:
@@ -583,29 +1957,35 @@ class DatabaseManager:
             row = cursor.fetchone()
             return dict(row) if row else None
     
+    def iter_tag_progress(self, status_filter: Optional[List[int]] = None,
+                          page_size: int = 1000) -> Iterator[TagProgress]:
+        """流式遍历标签进度（按 tag 主键键集分页）"""
+        where = 'tag > ?'
+        params: Tuple = ()
+        if status_filter:
+            where += f" AND status IN ({','.join('?' * len(status_filter))})"
+            params = tuple(status_filter)
+        last = ''
+        while True:
+            with self.get_cursor() as cursor:
+                cursor.execute(f'SELECT {", ".join(TagProgress._fields)} FROM tag_progress '
+                               f'WHERE {where} ORDER BY tag LIMIT ?', (last, *params, page_size))
+                rows = cursor.fetchall()
+            for row in rows:
+                yield TagProgress._make(row)
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+    
     def get_all_tag_progress(self, status_filter: Optional[List[int]] = None) -> Dict[str, Dict]:
         """获取所有标签进度"""
-        with self.get_cursor() as cursor:
-            if status_filter:
-                placeholders = ','.join('?' * len(status_filter))
-                cursor.execute(
-                    f'SELECT * FROM tag_progress WHERE status IN ({placeholders})',
-                    status_filter
-                )
-            else:
-                cursor.execute('SELECT * FROM tag_progress')
-            
-            result = {}
-            for row in cursor.fetchall():
-                tag = row['tag']
-                result[tag] = {
-                    'startpage': row['startpage'],
-                    'endpage': row['endpage'],
-                    'start_pic': row['start_pic'],
-                    'end_pic': row['end_pic'],
-                    'status': row['status']
-                }
-            return result
+        return {progress.tag: {
+                    'startpage': progress.startpage,
+                    'endpage': progress.endpage,
+                    'start_pic': progress.start_pic,
+                    'end_pic': progress.end_pic,
+                    'status': progress.status
+                } for progress in self.iter_tag_progress(status_filter)}
     
     def update_tag_progress(self, tag: str, startpage: Optional[int] = None,
                            start_pic: Optional[int] = None, status: Optional[int] = None):
@@ -640,9 +2020,23 @@ class DatabaseManager:
         with self.get_cursor() as cursor:
             cursor.execute('DELETE FROM tag_progress WHERE tag=?', (tag,))
     
+    def delete_tag_progress_many(self, tags: List[str]):
+        """批量删除标签进度（单个事务）"""
+        if not tags:
+            return
+        with self.get_cursor() as cursor:
+            cursor.executemany('DELETE FROM tag_progress WHERE tag=?', [(t,) for t in tags])
+    
     # ============ Mode 5: 更新图片tag_name ============
     
-    def update_picture_tag_name(self, old_tag: str, new_tag: str, gelbooru_path: str) -> int:
+    def count_pictures_by_tag(self, tag_name: str) -> int:
+        """统计tag下的图片数（只走 tag_name 索引，不取行）"""
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM pictures WHERE tag_name=?', (tag_name,))
+            return cursor.fetchone()[0]
+    
+    def update_picture_tag_name(self, old_tag: str, new_tag: str, gelbooru_path: str,
+                                move_folder: bool = False) -> int:
         """
         更新图片的tag_name（Mode 5专用）
         
@@ -650,6 +2044,7 @@ class DatabaseManager:
             old_tag: 旧的tag名称
             new_tag: 新的tag名称
             gelbooru_path: Gelbooru基础路径（如 F:\\Pic\\Gelbooru）
+            move_folder: 同时把 {gelbooru_path}\\{old_tag} 文件夹改名为 new_tag
         
         Returns:
             int: 更新的记录数
@@ -657,64 +2052,103 @@ class DatabaseManager:
         更新内容:
             - tag_name: old_tag -> new_tag
             - file_path: 替换路径中的old_tag为new_tag
-            - pic_tags: 追加new_tag，旧tag加_old后缀
+            - 帖子tag: 旧tag换成 旧tag_old，追加新tag到最后
+        
+        全部是整表集合语句，在同一个事务中完成；文件夹改名在提交前执行，
+        改名失败则回滚，提交失败则把文件夹改回去。
         """
-        with self.get_cursor() as cursor:
-            # 获取所有需要更新的记录
-            cursor.execute('SELECT pic_id, file_path, pic_tags FROM pictures WHERE tag_name=?', (old_tag,))
-            rows = cursor.fetchall()
-            
-            if not rows:
-                return 0
-            
-            updated_count = 0
-            for row in rows:
-                pic_id = row['pic_id']
-                old_path = row['file_path']
-                old_pic_tags = row['pic_tags'] or ''
+        old_prefix = f'{gelbooru_path}\\{old_tag}\\'
+        new_prefix = f'{gelbooru_path}\\{new_tag}\\'
+        old_dir = os.path.join(gelbooru_path, old_tag)
+        new_dir = os.path.join(gelbooru_path, new_tag)
+        moved = False
+        
+        try:
+            with self.get_cursor() as cursor:
+                # 受影响的帖子
+                cursor.execute('CREATE TEMP TABLE IF NOT EXISTS mode5_posts (pic_id INTEGER PRIMARY KEY)')
+                cursor.execute('DELETE FROM temp.mode5_posts')
+                cursor.execute('INSERT OR IGNORE INTO temp.mode5_posts SELECT pic_id FROM pictures WHERE tag_name=?',
+                               (old_tag,))
+                if cursor.rowcount <= 0:
+                    return 0
                 
-                # 更新file_path: 替换路径中的tag文件夹名
-                new_path = old_path.replace(f'{gelbooru_path}\\{old_tag}\\', f'{gelbooru_path}\\{new_tag}\\')
+                tag_ids = self._intern_tags(cursor, [old_tag, f'{old_tag}_old', new_tag])
+                params = {
+                    'old': tag_ids[old_tag],
+                    'old_old': tag_ids[f'{old_tag}_old'],
+                    'new': tag_ids[new_tag],
+                    'old_tag': old_tag,
+                    'new_tag': new_tag,
+                    'old_prefix': old_prefix,
+                    'new_prefix': new_prefix,
+                }
                 
-                # 更新pic_tags: 旧tag加_old后缀，追加新tag到最后
-                if old_pic_tags:
-                    # 替换旧tag为旧tag_old
-                    new_pic_tags = old_pic_tags.replace(old_tag, f'{old_tag}_old')
-                    # 追加新tag到最后
-                    new_pic_tags = f'{new_pic_tags} {new_tag}'
-                else:
-                    new_pic_tags = new_tag
+                # 帖子tag: 按 tag id 精确替换（不会误伤包含旧tag子串的其他tag），新tag不重复追加
+                cursor.execute('INSERT OR IGNORE INTO posts (pic_id) SELECT pic_id FROM temp.mode5_posts')
+                cursor.execute("""
+                    UPDATE posts SET tag_ids = (
+                        SELECT json_group_array(CASE WHEN j.value = :old THEN :old_old ELSE j.value END)
+                        FROM (SELECT value FROM json_each(posts.tag_ids) ORDER BY key) j)
+                    WHERE pic_id IN (SELECT pic_id FROM temp.mode5_posts)
+                      AND EXISTS (SELECT 1 FROM json_each(posts.tag_ids) WHERE value = :old)
+                """, params)
+                cursor.execute("""
+                    UPDATE posts SET tag_ids = json_insert(COALESCE(tag_ids, '[]'), '$[#]', :new)
+                    WHERE pic_id IN (SELECT pic_id FROM temp.mode5_posts)
+                      AND NOT EXISTS (SELECT 1 FROM json_each(posts.tag_ids) WHERE value = :new)
+                """, params)
                 
-                # 执行更新
+                # post_tags 索引同步
                 cursor.execute("""
-                    UPDATE pictures 
-                    SET tag_name=?, file_path=?, pic_tags=?
-                    WHERE pic_id=? AND tag_name=?
-                """, (new_tag, new_path, new_pic_tags, pic_id, old_tag))
+                    INSERT OR IGNORE INTO post_tags (tag_id, post_id)
+                    SELECT :old_old, post_id FROM post_tags
+                    WHERE tag_id = :old AND post_id IN (SELECT pic_id FROM temp.mode5_posts)
+                """, params)
+                cursor.execute("""
+                    DELETE FROM post_tags
+                    WHERE tag_id = :old AND post_id IN (SELECT pic_id FROM temp.mode5_posts)
+                """, params)
+                cursor.execute("""
+                    INSERT OR IGNORE INTO post_tags (tag_id, post_id)
+                    SELECT :new, pic_id FROM temp.mode5_posts
+                """, params)
+                
+                # 图片记录: tag_name 和 file_path 前缀
+                cursor.execute("""
+                    UPDATE pictures SET
+                        tag_name = :new_tag,
+                        file_path = CASE WHEN substr(file_path, 1, length(:old_prefix)) = :old_prefix
+                                         THEN :new_prefix || substr(file_path, length(:old_prefix) + 1)
+                                         ELSE file_path END
+                    WHERE tag_name = :old_tag
+                """, params)
+                updated_count = cursor.rowcount
+                cursor.execute('DELETE FROM temp.mode5_posts')
                 
-                updated_count += cursor.rowcount
+                if move_folder and os.path.isdir(old_dir):
+                    if os.path.exists(new_dir):
+                        raise FileExistsError(f"目标文件夹已存在: {new_dir}")
+                    os.rename(old_dir, new_dir)
+                    moved = True
             
             return updated_count
+        except Exception:
+            if moved:
+                os.rename(new_dir, old_dir)
+            raise
     
     def get_all_pic_ids_by_tag(self, tag_name: str) -> List[str]:
         """获取tag下所有图片的pic_id列表"""
         with self.get_cursor() as cursor:
             cursor.execute('SELECT pic_id FROM pictures WHERE tag_name=?', (tag_name,))
-            return [row['pic_id'] for row in cursor.fetchall()]
+            return [str(row['pic_id']) for row in cursor.fetchall()]
     
-    def get_local_filenames_by_tag(self, tag_name: str) -> Dict[str, Dict]:
-        """
-        获取tag下所有本地图片的文件名和信息（Mode 6专用）
-        
-        Returns:
-            Dict[filename, {pic_id, file_path, ...}]
-        """
+    def get_filenames_by_tag(self, tag_name: str) -> set:
+        """获取tag下DB中已有的文件名集合（只读 filename 列）"""
         with self.get_cursor() as cursor:
-            cursor.execute('SELECT * FROM pictures WHERE tag_name=?', (tag_name,))
-            result = {}
-            for row in cursor.fetchall():
-                result[row['filename']] = dict(row)
-            return result
+            cursor.execute('SELECT filename FROM pictures WHERE tag_name=?', (tag_name,))
+            return {row[0] for row in cursor}
     
     def update_picture(self, pic_id: str, tag_name: str, update_data: Dict[str, Any]) -> bool:
         """
@@ -723,33 +2157,40 @@ class DatabaseManager:
         Args:
             pic_id: 图片ID
             tag_name: 标签名
-            update_data: 要更新的字段
+            update_data: 要更新的字段（帖子字段写入 posts/post_tags，其余写入 pictures）
         
         Returns:
             bool: 是否更新成功
         """
-        if not update_data:
+        post_id = to_pic_id(pic_id)
+        if not update_data or post_id is None:
             return False
         
-        # 构建更新语句
-        set_clauses = []
-        values = []
-        for key, value in update_data.items():
-            if value is not None:  # 只更新非空值
-                set_clauses.append(f"{key}=?")
-                values.append(value)
-        
-        if not set_clauses:
+        # 只更新非空值
+        values = {key: value for key, value in update_data.items() if value is not None}
+        if not values:
             return False
         
-        values.extend([pic_id, tag_name])
-        
         with self.get_cursor() as cursor:
-            cursor.execute(f"""
-                UPDATE pictures SET {', '.join(set_clauses)}
-                WHERE pic_id=? AND tag_name=?
-            """, values)
-            return cursor.rowcount > 0
+            cursor.execute('SELECT 1 FROM pictures WHERE pic_id=? AND tag_name=?', (post_id, tag_name))
+            if cursor.fetchone() is None:
+                return False
+            
+            post_values = {key: values.pop(key) for key in POST_FIELDS if key in values}
+            if post_values:
+                set_clauses = ', '.join(f'{key}=?' for key in post_values)
+                cursor.execute('INSERT OR IGNORE INTO posts (pic_id) VALUES (?)', (post_id,))
+                cursor.execute(f'UPDATE posts SET {set_clauses} WHERE pic_id=?',
+                               list(post_values.values()) + [post_id])
+            
+            if 'pic_tags' in values:
+                self._set_post_tags(cursor, post_id, values.pop('pic_tags'))
+            
+            if values:
+                set_clauses = ', '.join(f'{key}=?' for key in values)
+                cursor.execute(f'UPDATE pictures SET {set_clauses} WHERE pic_id=? AND tag_name=?',
+                               list(values.values()) + [post_id, tag_name])
+            return True
     
         # ============ 每日查询统计 ============
     
@@ -802,12 +2243,290 @@ class DatabaseManager:
             row = cursor.fetchone()
             return row['queried_count'] if row else 0
     
+    # ============ 标签轮换目录 ============
+    #
+    # last_checked 是单调递增的序号（不是时间），越小越靠前：
+    # - 移到末尾：last_checked = MAX + 1 + 序号
+    # - 插到开头：last_checked = MIN - 数量 + 序号
+    # 两者都是按主键的单条 UPSERT，不需要重写整个列表
+    
+    def get_catalog_tags(self) -> List[str]:
+        """按轮换顺序返回所有标签"""
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT tag FROM tag_catalog ORDER BY last_checked')
+            return [row[0] for row in cursor.fetchall()]
+    
+    def get_catalog_count(self) -> int:
+        """标签目录中的标签数"""
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM tag_catalog')
+            return cursor.fetchone()[0]
+    
+    def replace_catalog(self, tags: List[str]):
+        """用给定顺序整体替换标签目录（tags 需已去重）"""
+        with self.get_cursor() as cursor:
+            cursor.execute('DELETE FROM tag_catalog')
+            cursor.executemany(
+                'INSERT OR IGNORE INTO tag_catalog (tag, last_checked) VALUES (?, ?)',
+                ((tag, i) for i, tag in enumerate(tags))
+            )
+    
+    def _catalog_upsert(self, cursor, tags: List[str], base: int, overwrite: bool):
+        """按 base + 序号写入标签（overwrite=False 时已存在的标签保持原位置）"""
+        conflict = 'DO UPDATE SET last_checked = excluded.last_checked' if overwrite else 'DO NOTHING'
+        cursor.execute(f"""
+            INSERT INTO tag_catalog (tag, last_checked)
+            SELECT value, ? + key FROM json_each(?) WHERE true
+            ON CONFLICT(tag) {conflict}
+        """, (base, json.dumps(tags, ensure_ascii=False)))
+        return cursor.rowcount
+    
+    def catalog_move_to_end(self, tags: List[str]) -> int:
+        """将标签移到末尾（不存在的追加），单条语句完成"""
+        if not tags:
+            return 0
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(last_checked), 0) FROM tag_catalog')
+            return self._catalog_upsert(cursor, list(dict.fromkeys(tags)), cursor.fetchone()[0] + 1, True)
+    
+    def catalog_prepend(self, tags: List[str]) -> int:
+        """将标签插到开头（已存在的移到开头），单条语句完成"""
+        if not tags:
+            return 0
+        tags = list(dict.fromkeys(tags))
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT COALESCE(MIN(last_checked), 0) FROM tag_catalog')
+            return self._catalog_upsert(cursor, tags, cursor.fetchone()[0] - len(tags), True)
+    
+    def catalog_append_missing(self, tags: List[str]) -> int:
+        """追加目录中不存在的标签（已存在的保持原位置）"""
+        if not tags:
+            return 0
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(last_checked), 0) FROM tag_catalog')
+            return self._catalog_upsert(cursor, tags, cursor.fetchone()[0] + 1, False)
+    
+    # ============ 标签下载时间历史 ============
+    
+    def _ensure_downtag_imported(self):
+        """首次使用时导入现有 downtag.txt（只执行一次）"""
+        if getattr(self, '_downtag_imported', False):
+            return
+        with self._lock:
+            if getattr(self, '_downtag_imported', False):
+                return
+            if self.get_state('downtag_imported') is None:
+                tag_times = parse_downtag_file(config['path']['downtag'])
+                rows = []
+                for tag, times in tag_times.items():
+                    # 旧到新插入，id 顺序即时间顺序
+                    rows.extend((tag, t) for t in reversed(times))
+                with self.get_cursor() as cursor:
+                    cursor.executemany(
+                        'INSERT INTO tag_time_history (tag, tag_time) VALUES (?, ?)', rows
+                    )
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO kv_state (key, value) VALUES ('downtag_imported', CURRENT_TIMESTAMP)"
+                    )
+                if rows:
+                    print(f'已从 downtag.txt 导入 {len(tag_times)} 个标签的时间记录')
+            self._downtag_imported = True
+    
+    def record_tag_times(self, tag_times: Dict[str, str]) -> int:
+        """
+        记录标签的最新下载时间（与该标签上一条记录相同时不插入）
+        
+        Args:
+            tag_times: {tag: 'YYYY-MM-DD HH:MM:SS'}
+        
+        Returns:
+            新增的记录数
+        """
+        if not tag_times:
+            return 0
+        self._ensure_downtag_imported()
+        with self.get_cursor() as cursor:
+            cursor.executemany("""
+                INSERT INTO tag_time_history (tag, tag_time)
+                SELECT ?1, ?2
+                WHERE COALESCE((SELECT tag_time FROM tag_time_history
+                                WHERE tag = ?1 ORDER BY id DESC LIMIT 1), '') != ?2
+            """, list(tag_times.items()))
+            return cursor.rowcount
+    
+    def get_tag_time_history(self, tag: str, limit: Optional[int] = None) -> List[str]:
+        """获取标签的下载时间历史（最新在前）"""
+        self._ensure_downtag_imported()
+        with self.get_cursor() as cursor:
+            query = 'SELECT tag_time FROM tag_time_history WHERE tag=? ORDER BY id DESC'
+            if limit:
+                query += f' LIMIT {int(limit)}'
+            cursor.execute(query, (tag,))
+            return [row[0] for row in cursor.fetchall()]
+    
+    def get_recent_tag_times(self, slots: int = 4) -> Dict[str, List[str]]:
+        """
+        获取每个标签最近的 slots 个下载时间
+        
+        Returns:
+            {tag: [time1, time2, ...]}，time1 为最新
+        """
+        self._ensure_downtag_imported()
+        with self.get_cursor() as cursor:
+            cursor.execute("""
+                SELECT tag, tag_time FROM (
+                    SELECT tag, tag_time,
+                           ROW_NUMBER() OVER (PARTITION BY tag ORDER BY id DESC) AS rn
+                    FROM tag_time_history
+                )
+                WHERE rn <= ?
+                ORDER BY tag, rn
+            """, (slots,))
+            result = {}
+            for row in cursor.fetchall():
+                result.setdefault(row[0], []).append(row[1])
+            return result
+    
+    # ============ 数据库维护 ============
+    
+    def checkpoint(self, mode: Optional[str] = None) -> Tuple[int, int, int]:
+        """
+        WAL 检查点，返回 (busy, WAL 页数, 已写回页数)
+        
+        默认 PASSIVE（不等读写）；WAL 超过 DB_WAL_MAX_SIZE 时用 TRUNCATE 把 WAL 清空
+        """
+        if mode is None:
+            wal_path = self.db_path + '-wal'
+            too_big = os.path.exists(wal_path) and os.path.getsize(wal_path) > DB_WAL_MAX_SIZE
+            mode = 'TRUNCATE' if too_big else 'PASSIVE'
+        with self.connection() as conn:
+            return tuple(conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone())
+    
+    def start_checkpointer(self, interval: int = DB_CHECKPOINT_INTERVAL):
+        """启动后台检查点线程（长时间下载时防止 WAL 无限增长）"""
+        if self._checkpointer is not None or interval <= 0:
+            return
+        stop = threading.Event()
+        
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.checkpoint()
+                except (sqlite3.Error, TimeoutError) as e:
+                    print(f"WAL 检查点失败: {e}")
+        
+        thread = threading.Thread(target=run, name='db-checkpointer', daemon=True)
+        self._checkpointer = (thread, stop)
+        thread.start()
+    
+    def stop_checkpointer(self):
+        """停止后台检查点线程"""
+        if self._checkpointer is None:
+            return
+        thread, stop = self._checkpointer
+        self._checkpointer = None
+        stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+    
+    def _benchmark_queries(self) -> Dict[str, float]:
+        """几条典型查询的耗时（毫秒，取 3 次中最快的一次）"""
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT tag_name FROM pictures ORDER BY id DESC LIMIT 1')
+            row = cursor.fetchone()
+            tag_name = row[0] if row else ''
+            cursor.execute('SELECT tag FROM tag_dict ORDER BY id LIMIT 1')
+            row = cursor.fetchone()
+            tag = row[0] if row else ''
+        
+        queries = {
+            'tag计数': ('SELECT COUNT(*) FROM pictures WHERE tag_name=?', (tag_name,)),
+            'tag图片': (picture_select('pl.tag_name=?') + ' ORDER BY po.pic_time DESC LIMIT 500', (tag_name,)),
+            '标签搜索': ('SELECT COUNT(*) FROM post_tags pt JOIN tag_dict d ON d.id = pt.tag_id '
+                        'WHERE d.tag=?', (tag,)),
+            '帖子总数': ('SELECT COUNT(*) FROM posts', ()),
+        }
+        timings = {}
+        with self.connection() as conn:
+            for name, (sql, params) in queries.items():
+                best = None
+                for _ in range(3):
+                    start = time.perf_counter()
+                    conn.execute(sql, params).fetchall()
+                    elapsed = (time.perf_counter() - start) * 1000
+                    best = elapsed if best is None else min(best, elapsed)
+                timings[name] = best
+        return timings
+    
+    def _maintenance_stats(self) -> Dict[str, Any]:
+        """数据库/WAL 大小、空闲空间和查询耗时"""
+        wal_path = self.db_path + '-wal'
+        with self.connection() as conn:
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            return {
+                'db_size': os.path.getsize(self.db_path),
+                'wal_size': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+                'free_size': conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size,
+                'auto_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0],
+                'latency': self._benchmark_queries(),
+            }
+    
+    def maintain(self) -> Dict[str, Any]:
+        """
+        数据库维护：检查点 + 回收空间 + 更新统计信息，返回维护前后的对比
+        
+        - wal_checkpoint(TRUNCATE) 把 WAL 写回并清空
+        - 还不是 auto_vacuum=INCREMENTAL 的库切换过去（需要一次完整 VACUUM），之后只做 incremental_vacuum
+        - ANALYZE + PRAGMA optimize 更新查询规划用的统计信息
+        
+        Returns:
+            {'before': {...}, 'after': {...}, 'vacuumed': bool, 'seconds': float}
+        """
+        start = time.time()
+        before = self._maintenance_stats()
+        vacuumed = before['auto_vacuum'] != 2
+        
+        with self.connection() as conn:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+            if vacuumed:
+                conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.execute('VACUUM')
+            else:
+                conn.execute('PRAGMA incremental_vacuum').fetchall()
+            conn.execute('ANALYZE')
+            conn.execute('PRAGMA optimize')
+            conn.commit()
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        
+        return {
+            'before': before,
+            'after': self._maintenance_stats(),
+            'vacuumed': vacuumed,
+            'seconds': time.time() - start,
+        }
+    
+    # ============ 状态键值 ============
+    
+    def get_state(self, key: str) -> Optional[str]:
+        """读取状态值"""
+        with self.get_cursor() as cursor:
+            cursor.execute('SELECT value FROM kv_state WHERE key=?', (key,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    
+    def set_state(self, key: str, value: Optional[str]):
+        """写入状态值"""
+        with self.get_cursor() as cursor:
+            cursor.execute('INSERT OR REPLACE INTO kv_state (key, value) VALUES (?, ?)', (key, value))
 
     def close_all_connections(self):
-        """关闭所有连接"""
-        if hasattr(self._thread_local, 'connection'):
-            self._thread_local.connection.close()
-            delattr(self._thread_local, 'connection')
+        """
+        关闭连接池中的所有连接（包括其他线程用过的），关闭前 PRAGMA optimize
+        
+        借出中的连接在归还时关闭；之后再访问数据库会重新建连接
+        """
+        self.stop_checkpointer()
+        self._pool.close_all(before_close=lambda conn: conn.execute('PRAGMA optimize'))
 
 
 def get_database(db_path: Optional[str] = None) -> DatabaseManager:
@@ -5,13 +5,17 @@ import os
 import time
 import random
 import queue
+import threading
+import concurrent.futures
 from win32file import CreateFile, SetFileTime, CloseHandle
 from win32file import GENERIC_READ, GENERIC_WRITE, OPEN_EXISTING
 from pywintypes import Time
 
 # 导入配置和工具
-from core import config, DOWN_SKIP_THRESHOLD, FILE_COUNT_CHECK_INTERVAL, RANDOM_DELAY_MIN, RANDOM_DELAY_MAX
-from core import Regex, read_lines, get_max_file_number, format_size, get_database, WebClient, load_tag_mapping, parse_exauthor
+from core import config, DOWN_SKIP_THRESHOLD, FILE_COUNT_CHECK_INTERVAL, RANDOM_DELAY_MIN, RANDOM_DELAY_MAX, LOG_MAX_SIZE
+from core import rotate_log
+from core import Regex, read_lines, get_max_file_number, format_size, get_database, WebClient, get_tag_mapping, parse_exauthor
+from core import MAX_WORKERS, FAILED_MAX_RETRIES, FAILED_PERMANENT, get_rate_limiter
 import set_tag
 import sampletag
 
@@ -35,6 +39,7 @@ class Downloader:
         self.gelbooru_path = config['path']['Gelbooru']
         self.new_path = config['path']['new']
         self.base_url = config['url']
+        self.rotate_logs = False  # 只有批量模式的 taglog{i}.txt 需要轮转
         
         # 初始化数据库连接
         self.db = get_database()
@@ -69,27 +74,14 @@ class Downloader:
         """
         标准化标签名（替换特殊字符）
         
-        同时记录 original_tag -> replace_tag 的映射关系到 tag-replace.txt
+        同时记录 original_tag -> replace_tag 的映射关系到 tag-replace.txt（追加写入）
         """
         replace_tag = tag.replace(":", "_").replace(".", "_").replace("+", "_")
         
-        # 如果 tag 被替换了，记录到文件
+        # 如果 tag 被替换了，记录映射（注册表在内存中判重，只有新映射才追加写入文件）
         if replace_tag != tag:
             try:
-                tag_replace_path = config['path']['tag_replace']
-                
-                # 读取现有映射
-                existing_mappings = load_tag_mapping()
-                
-                # 添加新映射
-                if tag not in existing_mappings or existing_mappings[tag] != replace_tag:
-                    existing_mappings[tag] = replace_tag
-                    
-                    # 写回文件
-                    with open(tag_replace_path, 'w', encoding='utf-8') as f:
-                        f.write('original_tag,replace_tag\n')
-                        for orig, repl in sorted(existing_mappings.items()):
-                            f.write(f'{orig},{repl}\n')
+                get_tag_mapping().register(tag, replace_tag)
             except Exception as e:
                 # 记录失败不影响主流程
                 print(f"⚠️  记录tag映射失败: {e}")
@@ -112,18 +104,33 @@ class Downloader:
         self.startfile = config['path']['startfile'] + str(offset) + '.start'
         self.result['logpath'] = self.logpath
         self.result['offset'] = offset
+        self.rotate_logs = True
+        self._rotate_log()
     
     def log(self, msg):
         """实时写入日志（每个线程独立logpath，无冲突风险）"""
         current_time = time.strftime('%Y-%m-%d %H:%M:%S')
         formatted_msg = f"{current_time} | {msg}"
         
-        # 立即写入日志文件
+        # 立即写入日志文件（追加后的位置就是文件大小，无需额外 stat）
         with open(self.logpath, 'a', encoding='utf-8') as f:
             f.write(formatted_msg + '\n')
+            log_size = f.tell()
         
         # 打印到控制台
         print(formatted_msg)
+        
+        if self.rotate_logs and log_size >= LOG_MAX_SIZE:
+            self._rotate_log()
+    
+    def _rotate_log(self):
+        """按大小/日期把活动日志滚动为 gzip 归档段"""
+        try:
+            segment = rotate_log(self.logpath)
+            if segment:
+                print(f"日志已归档: {os.path.basename(segment)}")
+        except OSError as e:
+            print(f"⚠️  日志轮转失败: {e}")
     
     def _create_folder(self, path):
         """创建文件夹"""
@@ -144,6 +151,16 @@ class Downloader:
         else:
             self.result['tag_time'][tag] = max(self.result['tag_time'][tag], tag_time)
     
+    def _record_tag_time(self, tag):
+        """tag 处理结束时立即写入下载时间历史（进程中断也不丢失）"""
+        tag_time = self.result['tag_time'].get(tag)
+        if not tag_time:
+            return
+        try:
+            self.db.record_tag_times({get_tag_mapping().get_original(tag): tag_time})
+        except Exception as e:
+            self.log(f'记录tag时间失败: {e}')
+    
     def _should_skip_tag(self, tag):
         """检查tag是否应该跳过（在exauthor中但没有逗号的tag）"""
         return tag in self.skip_tags
@@ -231,7 +248,8 @@ class Downloader:
             'time': pic_time,
             'id': pic_id,
             'filename': pic_filename,
-            'tags': pic_tags
+            'tags': pic_tags,
+            'error': self.web.last_error
         })
     
     def download_single(self, tag, tag_config):
@@ -301,6 +319,7 @@ class Downloader:
             
             if not image_urls:
                 if page == 1 and tag not in self.dead_tag:
+                    # 只记录到内存，由主线程在运行结束时统一写入
                     set_tag.add_expire_tag(tag)
                 break
             
@@ -433,6 +452,9 @@ class Downloader:
             'elapsed_minutes': elapsed_minutes
         }
         
+        # 记录下载时间历史
+        self._record_tag_time(tag)
+        
         # 检查过期标签
         self._check_expire()
         
@@ -577,6 +599,9 @@ class Downloader:
         # 整理tags.txt - 直接在线程中执行
         set_tag.update_tags(self.replace_tag, None, 'u')
         
+        # 记录下载时间历史
+        self._record_tag_time(tag)
+        
         #记录每日查询数量
         from datetime import datetime
         today = datetime.now().strftime('%Y-%m-%d')
@@ -599,14 +624,8 @@ class Downloader:
         return downloaded_this_tag > 0
     
     def _check_expire(self):
-        """检查过期标签数量（收集数据不写入）"""
-        nulltag = 0
-        nulltag_path = config['path'].get('nulltag', config['path'].get('deadtag'))
-        if nulltag_path and os.path.exists(nulltag_path):
-            with open(nulltag_path, 'r') as fd:
-                for line in fd:
-                    nulltag += 1
-            self.log(f'expired tag: {nulltag}')
+        """检查过期标签数量（读取收集器计数，不读文件）"""
+        self.log(f'expired tag: {set_tag.get_expire_collector().count()}')
 
 
 def down_single(tag, tagjs):
@@ -710,6 +729,7 @@ def down_batch_mode3_queue(task_queue, offset=0, result_queue=None):
                         'failed_records': downloader.result['failed_records'].copy(),
                         'downloaded_files': downloader.result['downloaded_files'].copy(),
                         'done_tags': done_tags.copy(),
+                        'expire_tags': downloader.result['expire_tags'].copy(),
                         'statistics': {
                             'downloaded': downloader.downed_cnt,
                             'failed': downloader.failed_cnt,
@@ -722,6 +742,7 @@ def down_batch_mode3_queue(task_queue, offset=0, result_queue=None):
                     downloader.result['tag_time'] = {}
                     downloader.result['failed_records'] = []
                     downloader.result['downloaded_files'] = []
+                    downloader.result['expire_tags'] = []
                     done_tags = []
                     batch_submit_count = 0
                     
@@ -781,12 +802,12 @@ def down_batch_mode3_queue(task_queue, offset=0, result_queue=None):
 
 def _batch_queue_worker(task_queue, offset, result_queue, mode_name, tag_processor, stat_keys):
     """
-    通用批量队列工作函数（Mode 6/7 公共逻辑）
+    通用批量队列工作函数（Mode 6 使用）
     
     Args:
         task_queue: 任务队列
         offset: 线程编号
-        result_queue: 结果队列（Mode 6/7不使用，保持签名一致）
+        result_queue: 结果队列（Mode 6不使用，保持签名一致）
         mode_name: 模式名称（用于日志）
         tag_processor: 处理单个tag的函数 (downloader, tag) -> tuple of stats
         stat_keys: 统计键名列表，如 ['added', 'updated', 'skipped']
@@ -891,52 +912,44 @@ def update_batch_mode6_queue(task_queue, offset, result_queue=None):
 
 
 
-def update_batch_mode7_queue(task_queue, offset, result_queue=None):
-    """Mode 7: 从本地 tags.txt 读取信息写入数据库（不联网）"""
-    return _batch_queue_worker(
-        task_queue, offset, result_queue,
-        mode_name="Import",
-        tag_processor=_import_from_tags_txt,
-        stat_keys=['added', 'skipped', 'not_found']
-    )
-
-
-def _import_from_tags_txt(downloader, tag):
+def _scan_tags_txt(job):
     """
-    从 tags.txt 导入图片信息到数据库
+    进程池任务：解析一个tag文件夹的 tags.txt（Mode 7）
+    
+    文件夹只 scandir 一次得到 文件名 -> 大小，不再逐行 exists/getsize。
     
     Args:
-        downloader: Downloader实例
-        tag: 标签名
+        job: (replace_tag, local_path)
     
     Returns:
-        tuple: (added_count, skipped_count, not_found_count)
+        tuple: (pics, not_found_count, error)
+            pics: 本地存在的图片记录列表（是否已在DB由调用方判断）
     """
-    replace_tag = downloader._normalize_tag(tag)
-    added_count = 0
-    skipped_count = 0
-    not_found_count = 0
-    
-    # 检查本地文件夹是否存在
-    local_path = os.path.join(downloader.gelbooru_path, replace_tag)
-    if not os.path.exists(local_path):
-        return 0, 0, 0
-    
-    # 读取 tags.txt
-    tags_txt_path = os.path.join(local_path, 'tags.txt')
-    if not os.path.exists(tags_txt_path):
-        return 0, 0, 0
+    replace_tag, local_path = job
     
-    # 获取DB中已有的记录
-    db_records = downloader.db.get_local_filenames_by_tag(replace_tag)
+    # 检查本地文件夹和 tags.txt 是否存在
+    try:
+        with os.scandir(local_path) as it:
+            sizes = {}
+            for entry in it:
+                try:
+                    sizes[os.path.normcase(entry.name)] = entry.stat().st_size
+                except OSError:
+                    sizes[os.path.normcase(entry.name)] = 0
+    except OSError:
+        return [], 0, None
+    if os.path.normcase('tags.txt') not in sizes:
+        return [], 0, None
     
     try:
-        with open(tags_txt_path, 'r', encoding='utf-8') as f:
+        # 逐行读取原始内容（不去重：not_found 等计数与逐行统计保持一致；清单头不含 '|'，会被跳过）
+        with open(os.path.join(local_path, 'tags.txt'), 'r', encoding='utf-8') as f:
             lines = f.readlines()
     except Exception as e:
-        downloader.log(f'Failed to read tags.txt: {e}')
-        return 0, 0, 0
+        return [], 0, f'Failed to read tags.txt: {e}'
     
+    pics = []
+    not_found_count = 0
     for line in lines:
         line = line.strip()
         if not line or '|' not in line:
@@ -948,7 +961,6 @@ def _import_from_tags_txt(downloader, tag):
         
         # 格式: tag_name|pic_time|filename|pic_id|pic_tags
         # 或者: tag_name|pic_time|filename|pic_id (旧格式，无pic_tags)
-        original_tag = parts[0]
         pic_time = parts[1]
         pic_filename = parts[2]
         pic_id = parts[3]
@@ -959,22 +971,11 @@ def _import_from_tags_txt(downloader, tag):
             continue
         
         # 检查本地文件是否存在
-        file_path = os.path.join(local_path, pic_filename)
-        if not os.path.exists(file_path):
+        file_size = sizes.get(os.path.normcase(pic_filename))
+        if file_size is None:
             not_found_count += 1
             continue
         
-        # 检查DB是否已有记录
-        if pic_filename in db_records:
-            skipped_count += 1
-            continue
-        
-        # 计算文件大小
-        try:
-            file_size = os.path.getsize(file_path)
-        except:
-            file_size = 0
-        
         # 提取日期
         pic_date = pic_time[:10] if len(pic_time) >= 10 else None
         
@@ -982,29 +983,156 @@ def _import_from_tags_txt(downloader, tag):
         ext = os.path.splitext(pic_filename)[1]
         new_filename = f"0_{replace_tag}_{pic_date}_{pic_id}{ext}"
         
-        pic_data = {
+        pics.append({
             'pic_id': pic_id,
             'tag_name': replace_tag,
             'filename': pic_filename,
             'new_filename': new_filename,
-            'file_path': file_path,
+            'file_path': os.path.join(local_path, pic_filename),
             'file_size': file_size,
             'pic_url': '',  # 从 tags.txt 导入没有 pic_url
             'pic_tags': pic_tags,
             'pic_time': pic_time,
             'pic_date': pic_date
-        }
-        
-        downloader.db.add_picture(pic_data)
-        added_count += 1
+        })
+    
+    return pics, not_found_count, None
+
+
+def import_tags_txt_bulk(taglist, max_workers=None):
+    """
+    Mode 7: 从本地 tags.txt 批量导入图片信息（不联网）
+    
+    各文件夹的 tags.txt 在进程池中解析，主进程按文件夹过滤掉DB中已有的文件名，
+    剩余记录每个文件夹一个事务 executemany 写入。
+    
+    Args:
+        taglist: 标签列表
+        max_workers: 进程数（默认CPU核心数）
+    
+    Returns:
+        dict: {'added', 'skipped', 'not_found', 'processed', 'interrupted'}
+    """
+    downloader = Downloader()
+    downloader.init_batch('import')  # 独立的日志和启动文件，不与 Mode 3/6 的线程1共用
+    downloader.log('Import Start')
+    
+    # 创建启动文件（删除即可中断）
+    with open(downloader.startfile, 'w') as f:
+        f.write('')
+    
+    jobs = []
+    job_tags = []
+    for tag in taglist:
+        if downloader._should_skip_tag(tag):
+            downloader.log(f'Skip tag {tag}')
+            continue
+        replace_tag = downloader._normalize_tag(tag)
+        jobs.append((replace_tag, os.path.join(downloader.gelbooru_path, replace_tag)))
+        job_tags.append(tag)
+    
+    stats = {'added': 0, 'skipped': 0, 'not_found': 0, 'processed': 0, 'interrupted': False}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_scan_tags_txt, jobs, chunksize=16)
+        for tag, (replace_tag, _), (pics, not_found_count, error) in zip(job_tags, jobs, results):
+            if not downloader._chk_start():
+                downloader.log(f'Interrupted at tag: {tag}')
+                stats['interrupted'] = True
+                executor.shutdown(wait=True, cancel_futures=True)
+                break
+            
+            stats['processed'] += 1
+            if error:
+                downloader.log(error)
+                continue
+            
+            # 检查DB是否已有记录
+            existing = downloader.db.get_filenames_by_tag(replace_tag) if pics else set()
+            new_pics = [pic for pic in pics if pic['filename'] not in existing]
+            if new_pics:
+                downloader.db.add_pictures_bulk(new_pics)
+            
+            result_stats = (len(new_pics), len(pics) - len(new_pics), not_found_count)
+            stats['added'] += result_stats[0]
+            stats['skipped'] += result_stats[1]
+            stats['not_found'] += result_stats[2]
+            if any(result_stats):
+                downloader.log(f'Tag {tag}: added={result_stats[0]}, skipped={result_stats[1]}, '
+                               f'not_found={result_stats[2]}')
+    
+    # 删除启动文件
+    if downloader._chk_start():
+        os.remove(downloader.startfile)
+    
+    downloader.log(f"Total: added={stats['added']}, skipped={stats['skipped']}, not_found={stats['not_found']}")
+    downloader.log(f"End processed:{stats['processed']}")
+    downloader.log('End')
+    return stats
+
+
+# Mode 6 判断记录是否完整所需的列（只取是否有值的标志，不取文本）
+MODE6_COLUMNS = ('filename', 'pic_id', 'has_url', 'has_time', 'has_tags')
+
+
+def _find_incomplete_files(downloader, replace_tag, local_files):
+    """
+    计算需要联网补全的本地文件（Mode 6）
+    
+    本地有文件、但DB无记录或缺少 pic_url/pic_tags/pic_time 的才需要访问详情页。
+    文件名 -> pic_id 先查DB记录，再查 tags.txt 清单，都查不到的只能逐个详情页比对。
+    DB记录流式遍历，完整的记录只留下文件名和ID。
     
-    return added_count, skipped_count, not_found_count
+    Returns:
+        tuple: (records, complete, wanted, unknown, known_ids)
+            records: {filename: row} 不完整的DB记录
+            complete: 已完整的DB记录文件名集合
+            wanted: {pic_id: filename} 已知ID的待补全文件
+            unknown: 不知道ID的待补全文件名集合
+            known_ids: 本tag所有已知ID（不在 wanted 中的无需访问详情页）
+    """
+    records = {}
+    complete = set()
+    known_ids = set()
+    for row in downloader.db.iter_pictures_by_tag(replace_tag, MODE6_COLUMNS):
+        known_ids.add(row.pic_id)
+        if row.has_url and row.has_time and row.has_tags:
+            complete.add(row.filename)
+        else:
+            records[row.filename] = row
+    
+    # 清单只用来补全DB中没有记录的本地文件的ID
+    manifest_ids = {}
+    try:
+        for line in set_tag.read_tag_manifest(replace_tag):
+            parts = line.split('|', 4)
+            if len(parts) >= 4 and parts[3].isdigit():
+                known_ids.add(parts[3])
+                if parts[2] in local_files:
+                    manifest_ids[parts[2]] = parts[3]
+    except Exception as e:
+        downloader.log(f'Failed to read tags.txt: {e}')
+    
+    wanted = {}
+    unknown = set()
+    for filename in local_files:
+        if filename in complete:
+            continue
+        record = records.get(filename)
+        pic_id = record.pic_id if record else manifest_ids.get(filename)
+        if pic_id:
+            wanted[pic_id] = filename
+        else:
+            unknown.add(filename)
+    
+    return records, complete, wanted, unknown, known_ids
 
 
 def _update_tag_info(downloader, tag):
     """
     更新单个tag的图片信息
     
+    只访问不完整记录对应的详情页；列表页按ID筛选，待补全的文件全部处理完就停止翻页。
+    
     Args:
         downloader: Downloader实例
         tag: 标签名
@@ -1035,14 +1163,19 @@ def _update_tag_info(downloader, tag):
         downloader.log(f'No image files in {local_path}')
         return 0, 0, 0
     
-    # 获取DB中已有的记录
-    db_records = downloader.db.get_local_filenames_by_tag(replace_tag)
+    # 先算出需要补全的文件，全部完整则不联网
+    db_records, complete, wanted, unknown, known_ids = _find_incomplete_files(downloader, replace_tag, local_files)
+    unknown_md5 = {os.path.splitext(filename)[0].lower() for filename in unknown}
+    skipped_count = len(local_files) - len(wanted) - len(unknown)
+    if not wanted and not unknown:
+        return 0, 0, skipped_count
+    downloader.log(f'Tag {tag}: {len(wanted) + len(unknown)}/{len(local_files)} local files incomplete')
     
     # 遍历网站上的图片
     page = 0
     base_tag_url = downloader.base_url + tag + downloader._exclude_url(tag)
     
-    while True:
+    while wanted or unknown:
         page += 1
         url = base_tag_url + downloader._get_page_url(page)
         soup = downloader.web.get_soup(url, retries=50)
@@ -1050,12 +1183,22 @@ def _update_tag_info(downloader, tag):
         if not soup:
             break
         
-        image_urls = downloader.web.get_image_list(soup)
-        if not image_urls:
+        entries = downloader.web.get_image_entries(soup)
+        if not entries:
             break
         
-        # 遍历图片
-        for img_url in image_urls:
+        # 遍历图片（只打开待补全的详情页：ID在 wanted 中，或缩略图md5与ID未知的文件名一致；
+        # 列表页取不到md5时，ID未知的文件只能逐个打开未知ID的详情页比对）
+        for img_url, md5 in entries:
+            list_id = Regex.extract_image_id(img_url)
+            if list_id not in wanted:
+                if not unknown:
+                    continue
+                if md5 is not None and md5 not in unknown_md5:
+                    continue
+                if md5 is None and list_id in known_ids:
+                    continue
+            
             # 获取详情页
             detail_soup = downloader.web.get_soup(img_url, retries=50)
             if not detail_soup:
@@ -1064,29 +1207,34 @@ def _update_tag_info(downloader, tag):
             pic_time, pic_date, pic_id, pic_url, pic_tags, pic_filename = downloader._extract_metadata(detail_soup)
             if not pic_filename:
                 continue
+            wanted.pop(list_id, None)
             
             # 检查本地是否存在该文件
             if pic_filename not in local_files:
                 skipped_count += 1
                 continue
+            unknown.discard(pic_filename)
             
             # 检查DB是否已有记录
+            if pic_filename in complete:
+                skipped_count += 1
+                continue
             if pic_filename in db_records:
                 # 已有记录，检查是否需要更新（例如 pic_url 为空）
                 existing = db_records[pic_filename]
                 update_data = {}
                 
                 # 检查哪些字段需要更新
-                if not existing.get('pic_url') and pic_url:
+                if not existing.has_url and pic_url:
                     update_data['pic_url'] = pic_url
-                if not existing.get('pic_tags') and pic_tags:
+                if not existing.has_tags and pic_tags:
                     update_data['pic_tags'] = pic_tags
-                if not existing.get('pic_time') and pic_time:
+                if not existing.has_time and pic_time:
                     update_data['pic_time'] = pic_time
                     update_data['pic_date'] = pic_date
                 
                 if update_data:
-                    if downloader.db.update_picture(existing['pic_id'], replace_tag, update_data):
+                    if downloader.db.update_picture(existing.pic_id, replace_tag, update_data):
                         updated_count += 1
                         downloader.log(f'Tag {tag} db update: {pic_filename} (ID: {pic_id})')
                 continue
@@ -1111,9 +1259,215 @@ def _update_tag_info(downloader, tag):
             downloader.db.add_picture(pic_data)
             added_count += 1
             downloader.log(f'Tag {tag} db insert: {pic_filename} (ID: {pic_id})')
+            
+            if not wanted and not unknown:
+                break
         
         # 每页处理完后检查是否中断
         if not downloader._chk_start():
             break
     
     return added_count, updated_count, skipped_count
+
+
+# ==================== Mode 10: 失败记录重试 ====================
+
+# 单次运行内每张图的下载尝试次数（再失败的交给跨运行的指数退避）
+RETRY_ATTEMPTS = 3
+
+
+def _detail_page_url(base_url, pic_id):
+    """帖子详情页url（下载原图时作为Referer）"""
+    return f"{base_url.split('?')[0]}?page=post&s=view&id={pic_id}"
+
+
+def _init_retry_worker(local, limiter):
+    """线程池初始化：每个工作线程创建一个 Downloader，线程内所有任务复用（共用限速器）"""
+    local.downloader = Downloader()
+    local.downloader.web = WebClient(config['headers'], rate_limiter=limiter)
+
+
+def _retry_failed_one(record, local, next_file_num, tag_lock):
+    """
+    重试下载一条失败记录（线程池中执行，不写数据库）
+    
+    Args:
+        record: failed_downloads 记录
+        local: 线程本地存储（_init_retry_worker 创建的 Downloader）
+        next_file_num: 分配 new 文件夹序号（各线程共享计数）
+        tag_lock: tag -> 锁，同一tag的 tags.txt 追加串行执行
+    
+    Returns:
+        (outcome, payload): ('recovered', 文件信息，本地已有文件时 new_filename 为 None) / ('failed'|'invalid', 错误原因)
+    """
+    worker = local.downloader
+    
+    tag = record['tag_name']
+    pic_id = record['pic_id']
+    pic_time = record['pic_time']
+    pic_filename = record['pic_filename']
+    if not (record['pic_url'] and pic_filename and pic_time):
+        return 'invalid', '缺少url/文件名/时间'
+    
+    replace_tag = worker._normalize_tag(tag)
+    original_save_path = os.path.join(worker.gelbooru_path, replace_tag, pic_filename)
+    pic_date = pic_time[:10]
+    pic_data = {
+        'pic_id': pic_id,
+        'tag_name': replace_tag,
+        'filename': pic_filename,
+        'new_filename': None,
+        'file_path': original_save_path,
+        'file_size': 0,
+        'pic_url': record['pic_url'],
+        'pic_tags': record['pic_tags'],
+        'pic_time': pic_time,
+        'pic_date': pic_date
+    }
+    
+    # 本地已有文件但DB无记录（resolve_failed_downloads 已处理DB有记录的）：
+    # 之前手动重下过，或 _save_image 中途失败留下的文件，按本地文件补写 pictures
+    if os.path.exists(original_save_path):
+        pic_data['file_size'] = os.path.getsize(original_save_path)
+        with tag_lock(replace_tag):
+            set_tag.update_tags(replace_tag, f"{tag}|{pic_time}|{pic_filename}|{pic_id}|{record['pic_tags']}")
+        return 'recovered', pic_data
+    
+    image_content = worker.web.download_image(record['pic_url'], retries=RETRY_ATTEMPTS,
+                                              referer=_detail_page_url(worker.base_url, pic_id))
+    if not image_content:
+        return 'failed', worker.web.last_error
+    
+    # 下载成功后才分配序号（各线程共享计数，不会重号）
+    file_counter = next_file_num()
+    pic_data['new_filename'] = f"{file_counter}_{replace_tag}_{pic_date}_{pic_id}.{pic_filename.split('.')[-1]}"
+    pic_data['file_size'] = len(image_content)
+    pic_data['save_path'] = original_save_path
+    pic_data['new_path'] = os.path.join(worker.new_path, pic_data['new_filename'])
+    os.makedirs(os.path.dirname(original_save_path), exist_ok=True)
+    worker._save_image(pic_data, image_content)
+    with tag_lock(replace_tag):
+        set_tag.update_tags(replace_tag, f"{tag}|{pic_time}|{pic_filename}|{pic_id}|{record['pic_tags']}")
+    return 'recovered', worker.result['downloaded_files'].pop()
+
+
+def retry_failed_downloads(max_workers=None, limit=None):
+    """
+    Mode 10: 并发重试 failed_downloads 中到期的失败记录
+    
+    主线程从数据库按 id 流式读取到期记录，提交给线程池（在途任务不超过 2×线程数）；
+    所有线程共用 DOWNLOAD_RATE 限速。下载成功的走正常保存流程（tag文件夹 + new文件夹 + tags.txt），
+    本地已有文件的按文件补记录，都由主线程写入 pictures 并标记已解决；失败的按指数退避推迟下次重试，达到 FAILED_MAX_RETRIES 次标记为放弃。
+    删除启动文件即可中断（已提交的任务会完成）。
+    
+    Args:
+        max_workers: 线程数（默认 MAX_WORKERS）
+        limit: 本次最多重试条数（None=全部到期记录）
+    
+    Returns:
+        dict: {'recovered', 'existed'(recovered 中本地已有文件、只补写DB的条数), 'rescheduled', 'permanent',
+               'bytes', 'processed', 'already_resolved', 'interrupted', 'elapsed'}
+    """
+    max_workers = max_workers or MAX_WORKERS
+    downloader = Downloader()
+    downloader.init_batch('retry')
+    downloader.log('Retry Start')
+    db = downloader.db
+    
+    # 创建启动文件（删除即可中断）
+    with open(downloader.startfile, 'w') as f:
+        f.write('')
+    
+    stats = {'recovered': 0, 'existed': 0, 'rescheduled': 0, 'permanent': 0, 'bytes': 0,
+             'processed': 0, 'already_resolved': db.resolve_failed_downloads(), 'interrupted': False}
+    if stats['already_resolved']:
+        downloader.log(f"Already in db, resolved: {stats['already_resolved']}")
+    
+    limiter = get_rate_limiter()
+    local = threading.local()
+    counter_lock = threading.Lock()
+    counter = [downloader._get_max_file_num()]
+    
+    def next_file_num():
+        with counter_lock:
+            counter[0] += 1
+            return counter[0] - 1
+    
+    # 同一tag的多条失败记录可能在不同线程中同时完成，tags.txt 追加按tag加锁
+    tag_locks = {}
+    tag_locks_lock = threading.Lock()
+    
+    def tag_lock(tag):
+        with tag_locks_lock:
+            return tag_locks.setdefault(tag, threading.Lock())
+    
+    touched_tags = set()
+    
+    def handle(future, record):
+        """主线程处理一个完成的任务（写库和统计）"""
+        try:
+            outcome, payload = future.result()
+        except Exception as e:
+            outcome, payload = 'failed', f'{type(e).__name__}: {e}'
+        
+        stats['processed'] += 1
+        label = f"{record['tag_name']} {record['pic_filename']} (ID: {record['pic_id']})"
+        if outcome == 'recovered':
+            db.add_picture(payload)
+            db.resolve_failed_download(record['id'])
+            stats['recovered'] += 1
+            touched_tags.add(payload['tag_name'])
+            if payload['new_filename']:
+                stats['bytes'] += payload['file_size']
+                downloader.log(f"recovered {label} {payload['new_filename']} {format_size(payload['file_size'])}")
+            else:
+                stats['existed'] += 1
+                downloader.log(f"recovered {label} from local file {format_size(payload['file_size'])}")
+        else:
+            # 记录本身不完整的无法重试，直接放弃
+            max_retries = 0 if outcome == 'invalid' else FAILED_MAX_RETRIES
+            rescheduled = db.reschedule_failed_download(record['id'], payload, max_retries)
+            if rescheduled is None:
+                return
+            status, retry_count, next_retry_at = rescheduled
+            if status == FAILED_PERMANENT:
+                stats['permanent'] += 1
+                downloader.log(f'give up {label} after {retry_count} retries: {payload}')
+            else:
+                stats['rescheduled'] += 1
+                downloader.log(f'failed {label} retry#{retry_count} next {next_retry_at} UTC: {payload}')
+    
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, initializer=_init_retry_worker,
+                                               initargs=(local, limiter)) as executor:
+        in_flight = {}
+        for record in db.iter_due_failures(limit):
+            if not downloader._chk_start():
+                downloader.log(f"Interrupted at failed id: {record['id']}")
+                stats['interrupted'] = True
+                break
+            if len(in_flight) >= max_workers * 2:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    handle(future, in_flight.pop(future))
+            future = executor.submit(_retry_failed_one, record, local, next_file_num, tag_lock)
+            in_flight[future] = record
+        
+        for future in concurrent.futures.as_completed(list(in_flight)):
+            handle(future, in_flight.pop(future))
+    stats['elapsed'] = time.time() - start_time
+    
+    # 整理 tags.txt 并重建有新图的tag缩略图（与正常下载结束时相同）
+    for replace_tag in sorted(touched_tags):
+        set_tag.update_tags(replace_tag, None, 'u')
+        _run_sample_sync(replace_tag)
+    
+    # 删除启动文件
+    if downloader._chk_start():
+        os.remove(downloader.startfile)
+    
+    downloader.log(f"Total: recovered={stats['recovered']}, exists={stats['existed']}, "
+                   f"rescheduled={stats['rescheduled']}, permanent={stats['permanent']}, "
+                   f"size={format_size(stats['bytes'])}, rate wait={limiter.waited:.1f}s")
+    downloader.log('End')
+    return stats
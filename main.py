@@ -15,27 +15,29 @@ import queue
 import atexit
 import concurrent.futures
 import datetime
-import glob
 from operator import itemgetter
 import set_tag
 from downloader import down_single, down_batch_mode3_queue
-from core import config, get_database, load_tag_mapping, format_size
+from core import (config, get_database, get_tag_mapping, format_size, snapshot_database, rotate_yearly,
+                  DEFAULT_TAG_TIME)
 
 
 def _cleanup_on_exit():
     """程序退出时清理资源"""
+    # 写入尚未落盘的完成标记、过期标签和 tags.txt
+    set_tag.flush_input()
+    set_tag.flush_expire_tags()
+    set_tag.flush_tags()
+    
     # 关闭数据库连接
     try:
         get_database().close_all_connections()
     except Exception:
         pass
 
-# 注册退出清理钩子
-atexit.register(_cleanup_on_exit)
-
 
 def write_failed_records(failed_records):
-    """写入失败记录"""
+    """写入失败记录到 failed.txt（只写首次失败的，重复失败只在数据库累加重试次数）"""
     if not failed_records:
         return
     
@@ -47,100 +49,43 @@ def write_failed_records(failed_records):
 
 def write_tag_time(tag_time_dict):
     """
-    写入downtag文件（支持4个历史时间戳）
+    记录标签下载时间，并导出 downtag.txt
     
-    新格式: tag {num}: {tag} |time1: {time}|time2: {time}|time3: {time}|time4: {time}
-    - time1: 最新的下载时间
-    - time2-4: 历史下载时间（依次向后推移）
-    - 如果新的time1和当前time1相同，不更新
-    - 按time1倒序排列（最新在最下，number最小）
-    - 使用 tag-replace.txt 将 replace_tag 转换为 original_tag
+    时间历史保存在数据库 tag_time_history 表中（worker 在每个tag结束时已写入），
+    这里补写一次（与最新记录相同时不会重复插入），然后导出文件。
+    使用 tag-replace.txt 将 replace_tag 转换为 original_tag。
     """
     if not tag_time_dict:
         return
     
-    file_path = config['path']['downtag']
-    DEFAULT_TIME = '2000-01-01 00:00:00'
-    
-    # 加载 tag 映射关系（replace_tag -> original_tag）
-    tag_mapping = load_tag_mapping(reverse=True)
-    
-    # 转换 tag_time_dict 中的 replace_tag 为 original_tag
+    # 转换 tag_time_dict 中的 replace_tag 为 original_tag（映射注册表已缓存在内存中）
+    tag_mapping = get_tag_mapping()
     normalized_tag_time = {}
     for tag, time_val in tag_time_dict.items():
-        # 如果是 replace_tag，转换为 original_tag
-        original_tag = tag_mapping.get(tag, tag)
-        normalized_tag_time[original_tag] = time_val
+        normalized_tag_time[tag_mapping.get_original(tag)] = time_val
     
-    # 读取现有数据（支持新旧两种格式）
-    tag_times = {}  # {tag_name: [time1, time2, time3, time4]}
+    get_database().record_tag_times(normalized_tag_time)
+    export_tag_time()
+
+
+def export_tag_time():
+    """
+    从数据库导出 downtag 文件（每个tag保留最近4个时间戳）
+    
+    格式: tag {num}: {tag} |time1: {time}|time2: {time}|time3: {time}|time4: {time}
+    - time1: 最新的下载时间
+    - time2-4: 历史下载时间（依次向后推移）
+    - 按time1倒序排列（最新在最下，number最小）
+    """
+    file_path = config['path']['downtag']
     
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line or 'time' not in line:
-                    continue
-                
-                # 解析tag名
-                if ': ' not in line:
-                    continue
-                parts = line.split(': ', 1)
-                if len(parts) != 2:
-                    continue
- # 解析时间（支持新旧格式）
-                if '|time1:' in line:
-                    # 新格式: |time1: xxx|time2: xxx|time3: xxx|time4: xxx
-                    # 一次性解析完成
-                    tag_name = parts[1].split('|')[0].strip()
-                    time_parts = line.split('|')
-                    times = []
-                    for part in time_parts:
-                        if 'time' in part and ':' in part:
-                            time_str = part.split(':', 1)[1].strip()
-                            if len(time_str) == 19:  # YYYY-MM-DD HH:MM:SS
-                                times.append(time_str)
-                    # 补齐到4个时间戳
-                    times = (times + [DEFAULT_TIME] * 4)[:4]
-                    tag_times[tag_name] = times
-                
-                elif 'time:' in line:
-                    # 旧格式: time: xxx
-                    time_str = line.split('time:', 1)[1].strip()
-                    tag_name = parts[1].split('time:')[0].strip()
-                    tag_times[tag_name] = [time_str, DEFAULT_TIME, DEFAULT_TIME, DEFAULT_TIME]
-    except FileNotFoundError:
-        pass  # 文件不存在，使用空字典
-    
-    # 更新新的时间
-    def parse_time(time_str):
-        return datetime.datetime.strptime(time_str, "%Y-%m-%d %H:%M:%S")
-    
-    for tag, new_time in normalized_tag_time.items():
-        if tag not in tag_times:
-            # 新tag，初始化
-            tag_times[tag] = [new_time, DEFAULT_TIME, DEFAULT_TIME, DEFAULT_TIME]
-        else:
-            current_times = tag_times[tag]
-            # 如果新时间和time1相同，不更新
-            if new_time != current_times[0]:
-                # 新时间不同，向后推移
-                tag_times[tag] = [
-                    new_time,           # time1: 新时间
-                    current_times[0],   # time2: 原time1
-                    current_times[1],   # time3: 原time2
-                    current_times[2]    # time4: 原time3（原time4丢弃）
-                ]
-    
-    # 按time1排序（倒序，最新在最下）
     entries = []
-    for tag, times in tag_times.items():
-        time1_dt = parse_time(times[0])
-        entries.append((tag, time1_dt, times))
+    for tag, times in get_database().get_recent_tag_times(4).items():
+        times = (times + [DEFAULT_TAG_TIME] * 4)[:4]
+        entries.append((tag, times[0], times))
     
-    entries.sort(key=itemgetter(1), reverse=False)
+    entries.sort(key=itemgetter(1))
     
-    # 写入新格式
     content = []
     for idx, (tag, _, times) in enumerate(entries, 1):
         entry_id = len(entries) - idx + 1
@@ -148,10 +93,23 @@ def write_tag_time(tag_time_dict):
         line = f"tag {entry_id:4}: {tag.ljust(50)} {time_str}\n"
         content.append(line)
     
-    with open(file_path, 'w') as f:
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as f:
         f.writelines(content)
+    os.replace(tmp_path, file_path)
 
 
+def print_pool_stats():
+    """打印数据库连接池统计（池满时借连接的等待次数和时间）"""
+    stats = get_database().pool_stats()
+    line = (f"数据库连接池: {stats['open']}/{stats['size']} 个连接, 借出 {stats['checkouts']} 次, "
+            f"等待 {stats['waits']} 次")
+    if stats['waits']:
+        line += f" (共 {stats['wait_seconds']:.2f} 秒, 最长 {stats['max_wait'] * 1000:.0f} ms)"
+    if stats['replaced']:
+        line += f", 重建坏连接 {stats['replaced']} 个"
+    print(line)
+
 
 def print_summary_statistics(total_downloaded, total_failed, total_size):
     """
@@ -197,15 +155,9 @@ def handle_result(result):
     """
     db = get_database()
     
-    # 1. 写入失败记录（同时写入txt和数据库）
+    # 1. 写入失败记录（数据库按图片+tag去重，首次失败的同时写入txt）
     if result.get('failed_records'):
-        write_failed_records(result['failed_records'])
-        # 同时写入数据库
-        for record in result['failed_records']:
-            db.add_failed_download(
-                record['tag'], record['url'], record['time'],
-                record['id'], record['filename'], record['tags']
-            )
+        write_failed_records(db.add_failed_downloads(result['failed_records']))
     
     # 2. 写入下载成功的图片记录到数据库
     if result.get('downloaded_files'):
@@ -232,9 +184,9 @@ def handle_result(result):
         if not startfile.endswith('zzztag.start'):
             os.remove(startfile)
     
-    # 7. 添加过期tag
+    # 7. 添加过期tag（只记录到内存，在进度检查点和运行结束时写入nulltag）
     if result.get('expire_tags'):
-       for expire_tag in result['expire_tags']:
+        for expire_tag in result['expire_tags']:
             set_tag.add_expire_tag(expire_tag)
     
     # 注意：缩略图已在downloader中异步提交，此处无需处理
@@ -242,7 +194,7 @@ def handle_result(result):
 
 def _run_batch_queue_mode(mode_name, worker_func, result_handler=None, collect_tag_time=False):
     """
-    通用批量队列处理模式（Mode 3/6/7 公共逻辑）
+    通用批量队列处理模式（Mode 3/6 公共逻辑）
     
     Args:
         mode_name: 模式名称（用于日志）
@@ -272,7 +224,7 @@ def _run_batch_queue_mode(mode_name, worker_func, result_handler=None, collect_t
         if mode_name.startswith("Mode 3"):
             unified_start = os.path.join(config['path']['new'], 'zzztag.start')
             if os.path.exists(unified_start):
-                print(f"已有Mode 3任务运行中（zzztag.start存在），无法启动新任务")
+                print("已有Mode 3任务运行中（zzztag.start存在），无法启动新任务")
                 return {}
             # 创建统一启动文件
             with open(unified_start, 'w') as f:
@@ -321,10 +273,12 @@ def _run_batch_queue_mode(mode_name, worker_func, result_handler=None, collect_t
             completed_threads = 0
             while completed_threads < available:
                 # 先处理增量结果
+                checkpoint = False
                 while not result_queue.empty():
                     try:
                         intermediate = result_queue.get_nowait()
                         if intermediate.get('type') == 'intermediate':
+                            checkpoint = True
                             # 处理增量数据
                             if result_handler:
                                 result_handler(intermediate, stats_collector)
@@ -339,6 +293,11 @@ def _run_batch_queue_mode(mode_name, worker_func, result_handler=None, collect_t
                     except queue.Empty:
                         break
                 
+                # 增量提交即进度检查点：上面 result_handler 已把增量结果中的过期tag加入收集器，
+                # 这里写入 nulltag，长时间运行中途崩溃不会丢失
+                if checkpoint:
+                    set_tag.flush_expire_tags()
+                
                 # 检查是否有线程完成
                 done_futures = [f for f in futures if f.done()]
                 for future in done_futures:
@@ -421,7 +380,12 @@ def _run_batch_queue_mode(mode_name, worker_func, result_handler=None, collect_t
         return stats_collector
         
     finally:
+        # 统一写入本次运行收集的完成标记、过期标签和 tags.txt
+        set_tag.flush_input()
+        set_tag.flush_expire_tags()
+        set_tag.flush_tags()
         try:
+            print_pool_stats()
             get_database().close_all_connections()
         except Exception as e:
             print(f"⚠️  关闭数据库连接失败: {e}")
@@ -565,7 +529,11 @@ def mode_1():
                     except Exception as e:
                         print(f"✗ {tag} 出错: {e}")
                 
-                # 每次循环都检查新tag（不管是否有任务完成）
+                # 本轮完成的tag统一写入 input.txt / tags.txt，过期tag写入 nulltag（中途崩溃不丢失）
+                set_tag.flush_input()
+                set_tag.flush_expire_tags()
+                
+                # 每次循环都检查新tag（不管是否有任务完成，文件未变化时只stat一次）
                 new_tags = _scan_new_tags(processed_tags)
                 for new_tag, new_config in new_tags:
                     task_queue.put((new_tag, new_config))
@@ -586,72 +554,65 @@ def mode_1():
             print_summary_statistics(total_downloaded, total_failed, total_size)
     
     finally:
+        # 统一写入本次运行收集的完成标记、过期标签和 tags.txt
+        set_tag.flush_input()
+        set_tag.flush_expire_tags()
+        set_tag.flush_tags()
+        
         # 关闭数据库连接
         try:
+            print_pool_stats()
             get_database().close_all_connections()
         except Exception as e:
             print(f"⚠️  关闭数据库连接失败: {e}")
 
 
+_scanned_input_generation = None
+
+
 def _scan_new_tags(processed_tags):
     """
     扫描input.txt，查找新增的tag
     
+    input 文件未变化时只做一次 stat，不重新解析
+    
     Args:
         processed_tags: 已处理的tag集合
     
     Returns:
         list: [(tag, config), ...] 新tag列表
     """
+    global _scanned_input_generation
     new_tags = []
     
     try:
-        input_lines = set_tag.readfile(config['path']['input'])
+        engine = set_tag.get_input_file()
+        engine.refresh()
+        if engine.generation == _scanned_input_generation:
+            return new_tags
+        _scanned_input_generation = engine.generation
         
-        for line in input_lines:
-            line = line.strip()
-            if not line or line.startswith('TAG') or line.startswith('done '):
-                continue
-            
-            # 解析标签配置
-            parts = line.split()
-            if not parts:
-                continue
-            
-            tag_name = parts[0]
-            
+        for tag_name, (endpage, start_pic, end_pic) in engine.active_entries():
             # 跳过已处理的tag
             if tag_name in processed_tags:
                 continue
             
-            # 补全参数：tag [endpage] [start_pic] [end_pic]
-            if len(parts) == 1:
-                parts.extend(['1', '0', '0'])
-            elif len(parts) == 2:
-                parts.extend(['0', '0'])
-            elif len(parts) == 3:
-                parts.append('0')
-            
             # 构建配置
             tag_config = {
                 'startpage': 1,
-                'endpage': int(parts[1]),
-                'start_pic': int(parts[2]),
-                'end_pic': str(parts[3]),
+                'endpage': endpage,
+                'start_pic': start_pic,
+                'end_pic': end_pic,
                 'status': 0
             }
-            
-            # 添加到数据库
-            db = get_database()
-            db.init_tag_progress(
-                tag=tag_name,
-                endpage=tag_config['endpage'],
-                start_pic=tag_config['start_pic'],
-                end_pic=tag_config['end_pic'],
-                status=0
-            )
-            
             new_tags.append((tag_name, tag_config))
+        
+        # 批量添加到数据库
+        if new_tags:
+            get_database().init_tag_progress_many([
+                (tag, cfg['endpage'], cfg['start_pic'], cfg['end_pic'], 0)
+                for tag, cfg in new_tags
+            ])
     
     except Exception as e:
         print(f"扫描新标签失败: {e}")
@@ -678,7 +639,9 @@ def mode_3():
         print(f"\n已更新 {len(stats['all_tag_time'])} 个tag到 downtag.txt")
     
     if stats['all_done_tags']:
+        # 单条 UPSERT 移到轮换队列末尾，随即导出 tags.txt（不依赖退出钩子，进程被强杀也不丢轮换进度）
         set_tag.add_tags(stats['all_done_tags'])
+        set_tag.flush_tags()
         print(f"已添加 {len(stats['all_done_tags'])} 个tag到 tags.txt")
     
     # 输出汇总日志
@@ -698,12 +661,7 @@ def mode_3():
         print_summary_log(f'Total download: {total_downloaded} failed: {total_failed}')
     
     # 输出 expired tag 统计
-    nulltag_count = 0
-    nulltag_path = config['path'].get('nulltag', config['path'].get('deadtag'))
-    if nulltag_path and os.path.exists(nulltag_path):
-        with open(nulltag_path, 'r') as fd:
-            nulltag_count = sum(1 for _ in fd)
-    print_summary_log(f'expired tag: {nulltag_count}')
+    print_summary_log(f'expired tag: {set_tag.get_expire_collector().count()}')
     
     print_summary_log(f'End tags:{len(stats["all_done_tags"])}')
     print_summary_log('End')
@@ -724,7 +682,7 @@ def mode_4():
     print("已完成标签清理完毕")
 
 
-def mode_5(old_tag: str, new_tag: str):
+def mode_5(old_tag: str, new_tag: str, move_folder: bool = False):
     """
     模式5: 修改图片的tag_name
     
@@ -733,6 +691,7 @@ def mode_5(old_tag: str, new_tag: str):
     Args:
         old_tag: 旧的tag名称
         new_tag: 新的tag名称
+        move_folder: 同时把文件夹 old_tag 改名为 new_tag（与数据库更新同进同退）
     
     更新内容:
         - tag_name: old_tag -> new_tag
@@ -741,7 +700,7 @@ def mode_5(old_tag: str, new_tag: str):
     """
     from core import get_database
     
-    print(f"\n=== Mode 5: 修改图片tag_name ===")
+    print("\n=== Mode 5: 修改图片tag_name ===")
     print(f"  旧tag: {old_tag}")
     print(f"  新tag: {new_tag}\n")
     
@@ -749,23 +708,27 @@ def mode_5(old_tag: str, new_tag: str):
     gelbooru_path = config['path']['Gelbooru']
     
     try:
-        # 检查旧tag是否存在
-        existing = db.get_pictures_by_tag(old_tag)
-        if not existing:
+        # 检查旧tag是否存在（只计数，不取行）
+        count = db.count_pictures_by_tag(old_tag)
+        if not count:
             print(f"❌ 数据库中没有找到tag: {old_tag}")
             return
         
-        print(f"找到 {len(existing)} 张图片需要更新")
+        print(f"找到 {count} 张图片需要更新")
         
         # 执行更新
-        updated_count = db.update_picture_tag_name(old_tag, new_tag, gelbooru_path)
+        start = time.time()
+        updated_count = db.update_picture_tag_name(old_tag, new_tag, gelbooru_path, move_folder=move_folder)
         
-        print(f"✓ 成功更新 {updated_count} 条记录")
-        print(f"\n注意: 请手动将文件夹从 {old_tag} 重命名为 {new_tag}")
-        print(f"  路径: {gelbooru_path}\\{old_tag} -> {gelbooru_path}\\{new_tag}")
+        print(f"✓ 成功更新 {updated_count} 条记录（{time.time() - start:.2f} 秒）")
+        if move_folder:
+            print(f"✓ 文件夹已改名: {gelbooru_path}\\{old_tag} -> {gelbooru_path}\\{new_tag}")
+        else:
+            print(f"\n注意: 请手动将文件夹从 {old_tag} 重命名为 {new_tag}（或加 move 参数自动改名）")
+            print(f"  路径: {gelbooru_path}\\{old_tag} -> {gelbooru_path}\\{new_tag}")
         
     except Exception as e:
-        print(f"❌ 更新失败: {e}")
+        print(f"❌ 更新失败（已回滚）: {e}")
     finally:
         try:
             db.close_all_connections()
@@ -795,23 +758,177 @@ def mode_6():
 
 
 def mode_7():
-    """模式7: 从本地tags.txt导入图片信息到DB（不联网）"""
-    from downloader import update_batch_mode7_queue
-    
-    stats = _run_batch_queue_mode(
-        mode_name="Mode 7: 从本地tags.txt导入图片信息",
-        worker_func=update_batch_mode7_queue
-    )
+    """模式7: 从本地tags.txt导入图片信息到DB（不联网，多进程解析 + 批量写入）"""
+    from downloader import import_tags_txt_bulk
     
-    if not stats:
-        return
+    try:
+        print("\n=== Mode 7: 从本地tags.txt导入图片信息 ===\n")
+        
+        # 初始化标签列表
+        set_tag.add_folder_tag()
+        set_tag.init_input(1)
+        set_tag.add_dead_tag()
+        taglist = set_tag.read_tags()
+        
+        if not taglist:
+            print("没有可处理的标签")
+            return
+        
+        print(f"总标签数: {len(taglist)}\n")
+        start_time = time.time()
+        stats = import_tags_txt_bulk(taglist)
+        elapsed_minutes = (time.time() - start_time) / 60
+    finally:
+        set_tag.flush_input()
+        set_tag.flush_expire_tags()
+        set_tag.flush_tags()
+        try:
+            print_pool_stats()
+            get_database().close_all_connections()
+        except Exception as e:
+            print(f"⚠️  关闭数据库连接失败: {e}")
     
     # 输出汇总统计
     print(f"\n{'='*50}")
-    print(f"  总耗时: {stats['elapsed_minutes']:.1f} 分钟")
-    print(f"  新增记录: {stats['total_added']}")
-    print(f"  跳过(已存在): {stats['total_skipped']}")
-    print(f"  未找到(无tags.txt): {stats['total_not_found']}")
+    print(f"  总耗时: {elapsed_minutes:.1f} 分钟")
+    print(f"  新增记录: {stats['added']}")
+    print(f"  跳过(已存在): {stats['skipped']}")
+    print(f"  未找到(无tags.txt): {stats['not_found']}")
+    if stats['interrupted']:
+        print(f"  已中断（处理了 {stats['processed']} 个tag）")
+    print(f"{'='*50}\n")
+
+
+def mode_8(force: bool = False):
+    """
+    模式8: 批量重建所有tag的缩略图拼接（多进程）
+    
+    - 进程池大小为CPU核心数
+    - 最新图片列表和缩略图参数都没有变化的tag直接跳过
+    - 修改缩略图参数或修复 sample 目录后使用
+    
+    Args:
+        force: True 忽略指纹，全部重建
+    """
+    import sampletag
+    
+    print("\n=== Mode 8: 批量重建缩略图 ===\n")
+    
+    stats = sampletag.regenerate_all(force=force)
+    
+    print(f"\n{'='*50}")
+    print(f"  总耗时: {stats['elapsed'] / 60:.1f} 分钟")
+    print(f"  重建: {stats['rebuilt']}  跳过(未变化): {stats['skipped']}  失败: {stats['failed']}")
+    print(f"  速度: {stats['tags_per_sec']:.1f} tags/s  {stats['images_per_sec']:.1f} 张/s (解码 {stats['decoded']} 张)")
+    print(f"{'='*50}\n")
+
+
+def mode_9(action: str = ''):
+    """
+    模式9: 数据库维护
+    
+    子命令:
+        (无)/maintain - 日常维护：WAL 检查点、回收空间、ANALYZE/optimize，报告前后的大小和查询耗时
+        migrate - 迁移到 posts / tag_dict / post_tags 结构（旧结构的数据库必须先手动迁移，其他模式会拒绝运行）
+        rollup  - 重建每日统计汇总（daily_rollup / tag_daily_rollup）
+        reindex - 从 posts 重建tag搜索索引（post_tags），清理不再使用的 tag_dict 条目
+        archive - 归档失败记录（已解决/放弃/长期未更新的移入 archive_YYYY.db），failed.txt 转存为按年份的 gz
+        snapshot - 生成只读查询用的一致快照（xxx_snapshot.db，备份 API 一步复制，下载可以同时写库）
+    
+    Args:
+        action: 子命令
+    """
+    db = get_database()
+    
+    if action == 'migrate':
+        print("\n=== Mode 9: 数据库结构迁移 ===\n")
+        result = db.migrate_schema()
+        if not result['migrated']:
+            print(f"已是新结构，无需迁移（数据库大小: {format_size(result['size_after'])}）")
+    elif action == 'rollup':
+        print("\n=== Mode 9: 重建每日统计汇总 ===\n")
+        result = db.rebuild_rollups()
+        print(f"已汇总 {result['days']} 天 / {result['tag_days']} 个 tag·天，耗时 {result['seconds']:.1f} 秒")
+    elif action == 'reindex':
+        print("\n=== Mode 9: 重建tag搜索索引 ===\n")
+        result = db.rebuild_tag_index()
+        print(f"post_tags: {result['post_tags']} 条, tag_dict: {result['tags']} 个tag"
+              f"（清理未使用 {result['removed_tags']} 个），耗时 {result['seconds']:.1f} 秒")
+    elif action in ('', 'maintain'):
+        print("\n=== Mode 9: 数据库维护 ===\n")
+        result = db.maintain()
+        before, after = result['before'], result['after']
+        if result['vacuumed']:
+            print("已切换为 auto_vacuum=INCREMENTAL（执行了一次完整 VACUUM）")
+        for label, key in (('数据库', 'db_size'), ('WAL', 'wal_size'), ('空闲空间', 'free_size')):
+            print(f"  {label}: {format_size(before[key])} -> {format_size(after[key])}")
+        print("  查询耗时:")
+        for name, ms in before['latency'].items():
+            print(f"    {name:<6}: {ms:.2f} ms -> {after['latency'][name]:.2f} ms")
+        print(f"维护完成，耗时 {result['seconds']:.1f} 秒")
+    elif action == 'archive':
+        print("\n=== Mode 9: 归档失败记录 ===\n")
+        result = db.archive_failed_downloads()
+        print(f"图片已在库中，标记为已解决: {result['resolved']}")
+        for year, rows in result['moved'].items():
+            print(f"  -> {db.archive_path(year)}: {rows} 条")
+        print(f"热库剩余失败记录: {result['remaining']}")
+        try:
+            archived = rotate_yearly(config['path']['failed'])
+            if archived:
+                print(f"failed.txt -> {archived}")
+        except OSError as e:
+            print(f"⚠️  转存 failed.txt 失败: {e}")
+    elif action == 'snapshot':
+        print("\n=== Mode 9: 生成数据库快照 ===\n")
+        start = time.time()
+        path = snapshot_database(db.db_path)
+        print(f"快照: {path} ({format_size(os.path.getsize(path))})，耗时 {time.time() - start:.1f} 秒")
+    else:
+        print("Mode 9 子命令: python main.py 9 [maintain|migrate|rollup|reindex|archive|snapshot]")
+
+
+def mode_10(limit: int = 0):
+    """
+    模式10: 并发重试失败的下载（failed_downloads 中到期的记录）
+    
+    - 线程池大小为 MAX_WORKERS，所有线程共用 DOWNLOAD_RATE 限速
+    - 成功的写入 tag文件夹 + new文件夹 + pictures，并标记失败记录为已解决
+    - 仍失败的按指数退避推迟到以后的运行，达到 FAILED_MAX_RETRIES 次后放弃
+    
+    Args:
+        limit: 本次最多重试条数（0=全部到期记录）
+    """
+    from downloader import retry_failed_downloads
+    
+    db = get_database()
+    try:
+        print("\n=== Mode 10: 重试失败的下载 ===\n")
+        counts = db.count_failures()
+        print(f"待重试: {counts['due']} 条到期, {counts['waiting']} 条退避中, 已放弃: {counts['permanent']}\n")
+        if not counts['due']:
+            print("没有到期的失败记录")
+            return
+        stats = retry_failed_downloads(limit=limit or None)
+        counts = db.count_failures()
+    finally:
+        set_tag.flush_tags()
+        try:
+            print_pool_stats()
+            db.close_all_connections()
+        except Exception as e:
+            print(f"⚠️  关闭数据库连接失败: {e}")
+    
+    print(f"\n{'='*50}")
+    print(f"  总耗时: {stats['elapsed'] / 60:.1f} 分钟")
+    print(f"  重试: {stats['processed']}  恢复: {stats['recovered']} (下载 {format_size(stats['bytes'])}, "
+          f"其中本地已有文件补写DB: {stats['existed']})")
+    print(f"  仍失败(退避后重试): {stats['rescheduled']}  放弃: {stats['permanent']}")
+    if stats['already_resolved']:
+        print(f"  图片已在库中，直接标记为已解决: {stats['already_resolved']}")
+    if stats['interrupted']:
+        print("  已中断（未处理的记录下次继续）")
+    print(f"  剩余: {counts['due']} 条到期, {counts['waiting']} 条退避中")
     print(f"{'='*50}\n")
 
 
@@ -864,7 +981,7 @@ def mode_0(tag: str):
         
         # 2. 测试第一页（pid=0）
         page_url = f"{base_url}{tag}"
-        log(f"==== 第 1 页 ====")
+        log("==== 第 1 页 ====")
         log(f"URL: {page_url}")
         log("-" * 40)
         
@@ -1002,19 +1119,37 @@ def mode_0(tag: str):
 
 def main():
     """主函数"""
+    # 注册退出清理钩子（只在主进程注册：Windows 下进程池的子进程会以 __mp_main__ 重新导入本模块，
+    # 模块级注册会让每个子进程退出时都去打开数据库、用空的内存数据覆盖 tags.txt）
+    atexit.register(_cleanup_on_exit)
+    
     if len(sys.argv) < 2:
-        print("使用方法: python main.py [0|1|3|4|5|6|7]")
+        print("使用方法: python main.py [0|1|3|4|5|6|7|8|9|10]")
         print("  0 - 调试模式（分析下载问题，不下载文件）")
         print("  1 - 下载新标签（自动恢复中断）")
         print("  3 - 下载所有旧标签")
         print("  4 - 清理已完成记录")
-        print("  5 old_tag new_tag - 修改图片tag_name")
+        print("  5 old_tag new_tag [move] - 修改图片tag_name（move=同时改名文件夹）")
         print("  6 - 更新图片信息（不下载，联网获取）")
         print("  7 - 从本地tags.txt导入图片信息（不联网）")
+        print("  8 [force] - 批量重建所有tag的缩略图（多进程，force=忽略指纹全部重建）")
+        print("  9 [migrate|rollup|reindex|archive|snapshot] - 数据库维护（默认=检查点/回收空间/ANALYZE，"
+              "migrate=迁移到规范化表结构，rollup=重建每日统计汇总，reindex=重建tag搜索索引，"
+              "archive=归档失败记录，snapshot=生成查询用快照）")
+        print("  10 [limit] - 并发重试失败的下载（到期的失败记录，失败的按指数退避推迟）")
         return
     
     mode = sys.argv[1]
     
+    # 旧结构的数据库只允许手动迁移（迁移不可逆，不在打开数据库时自动执行）
+    if mode not in ('0', '8') and sys.argv[1:] != ['9', 'migrate'] and get_database().legacy_schema:
+        print("数据库仍是旧的 pictures 结构，请先运行: python main.py 9 migrate")
+        return
+    
+    # 长时间写库的模式：后台定期做 WAL 检查点（退出清理时停止）
+    if mode in ('1', '3', '6', '7', '10'):
+        get_database().start_checkpointer()
+    
     try:
         if mode == '0':
             if len(sys.argv) < 3:
@@ -1029,16 +1164,22 @@ def main():
             mode_4()
         elif mode == '5':
             if len(sys.argv) < 4:
-                print("Mode 5 需要两个参数: python main.py 5 old_tag new_tag")
+                print("Mode 5 需要两个参数: python main.py 5 old_tag new_tag [move]")
                 return
-            mode_5(sys.argv[2], sys.argv[3])
+            mode_5(sys.argv[2], sys.argv[3], move_folder=len(sys.argv) > 4 and sys.argv[4] == 'move')
         elif mode == '6':
             mode_6()
         elif mode == '7':
             mode_7()
+        elif mode == '8':
+            mode_8(force=len(sys.argv) > 2 and sys.argv[2] == 'force')
+        elif mode == '9':
+            mode_9(sys.argv[2] if len(sys.argv) > 2 else '')
+        elif mode == '10':
+            mode_10(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
         else:
             print(f"未知模式: {mode}")
-            print("可用模式: 0, 1, 3, 4, 5, 6, 7")
+            print("可用模式: 0, 1, 3, 4, 5, 6, 7, 8, 9, 10")
     finally:
         print("\n所有任务完成")
 
@@ -1,18 +1,39 @@
 import os
+import time
+import math
 import heapq
+import hashlib
+import concurrent.futures
+from collections import namedtuple
 from PIL import Image
-from core import config
+from core import config, read_json, write_json
+
+
+# 指纹记录文件（位于 sample 目录，记录每个tag上次生成拼接图时的输入和生成的文件名）
+FINGERPRINT_FILE = '.fingerprints.json'
+
+# 流式拼接使用的图片头信息（只读取尺寸，不解码像素）
+ImageHeader = namedtuple('ImageHeader', ['path', 'name', 'width', 'height'])
 
 
 class ThumbnailMaker:
     """缩略图制作和拼接类（优化版）"""
     
-    def __init__(self, tag, thumbnail_size=None, row_width=2400, rows_per_montage=3, max_images=90):
+    def __init__(self, tag, thumbnail_size=None, row_width=2400, rows_per_montage=3, max_images=90,
+                 streaming=None):
         self.tag = tag
         # 从配置读取缩略图尺寸
         if thumbnail_size is None:
             thumbnail_size = tuple(config.get('runtime', {}).get('THUMBNAIL_SIZE', [400, 400]))
+        # 流式拼接：逐行解码粘贴，内存上限为一张拼接图 + 一行缩略图
+        if streaming is None:
+            streaming = config.get('runtime', {}).get('SAMPLE_STREAMING', True)
         self.thumbnail_size = thumbnail_size
+        self.streaming = streaming
+        # 拼接过程中同时持有的像素内存峰值估算（按 宽×高×3 计算，不是实测值：Pillow 的像素缓冲不经过 Python 分配器）
+        self.est_peak_bytes = 0
+        self.decoded = 0  # 实际解码成功的图片数
+        self.outputs = []  # 本次生成的拼接图文件名
         self.row_width = row_width
         self.rows_per_montage = rows_per_montage
         self.max_images = max_images
@@ -20,10 +41,10 @@ class ThumbnailMaker:
         self.target_dir = os.path.join(config['path']['Gelbooru'], 'sample')
         os.makedirs(self.target_dir, exist_ok=True)
     
-    def get_images_sorted_by_time(self):
-        """获取目录下最新的N张图片路径和文件名（优化：减少stat调用）"""
+    def get_newest_images(self):
+        """获取目录下最新的N张图片 [(mtime, path, name, size), ...]（按时间倒序）"""
         if not os.path.exists(self.source_dir):
-            return [], []
+            return []
         
         image_list = []
         valid_extensions = {'.png', '.jpg', '.jpeg'}
@@ -35,15 +56,13 @@ class ThumbnailMaker:
                         ext = os.path.splitext(entry.name)[1].lower()
                         if ext in valid_extensions:
                             try:
-                                image_list.append((entry.stat().st_mtime, entry.path, entry.name))
+                                st = entry.stat()
+                                image_list.append((st.st_mtime, entry.path, entry.name, st.st_size))
                             except Exception:
                                 pass
         except Exception as e:
             print(f'无法扫描目录 {self.source_dir}: {e}')
-            return [], []
-        
-        if not image_list:
-            return [], []
+            return []
         
         # 使用heapq.nlargest更高效地获取最新的N张
         if len(image_list) > self.max_images:
@@ -51,8 +70,29 @@ class ThumbnailMaker:
         else:
             image_list.sort(reverse=True)
         
+        return image_list
+    
+    def get_images_sorted_by_time(self):
+        """获取目录下最新的N张图片路径和文件名（优化：减少stat调用）"""
+        image_list = self.get_newest_images()
         return [item[1] for item in image_list], [item[2] for item in image_list]
     
+    def fingerprint(self, image_list=None):
+        """
+        计算拼接图输入指纹：最新N张图片列表 + 缩略图参数 + 拼接方式
+        
+        指纹不变说明重新生成的拼接图与上次完全相同，可以跳过
+        """
+        if image_list is None:
+            image_list = self.get_newest_images()
+        
+        h = hashlib.sha1()
+        h.update(repr((self.thumbnail_size, self.row_width,
+                       self.rows_per_montage, self.max_images, self.streaming)).encode('utf-8'))
+        for mtime, _, name, size in image_list:
+            h.update(f'\n{name}|{mtime}|{size}'.encode('utf-8'))
+        return h.hexdigest()
+    
     def create_thumbnail(self, image_path):
         """创建缩略图并转换为RGB格式"""
         try:
@@ -63,10 +103,39 @@ class ThumbnailMaker:
                 # 只在需要时转换
                 if img.mode != 'RGB':
                     img = img.convert('RGB')
-                return img.copy()
+                thumb = img.copy()
+            self.decoded += 1
+            return thumb
         except Exception:
             return None
     
+    def predict_thumbnail_size(self, width, height):
+        """根据原图尺寸计算缩略图尺寸（与 Image.thumbnail 的保持宽高比算法一致）"""
+        box_w, box_h = self.thumbnail_size
+        if width <= box_w and height <= box_h:
+            return width, height
+        
+        aspect = width / height
+        if box_w / box_h >= aspect:
+            candidates = (math.floor(box_h * aspect), math.ceil(box_h * aspect))
+            x = max(min(candidates, key=lambda n: abs(aspect - n / box_h)), 1)
+            return x, box_h
+        candidates = (math.floor(box_w / aspect), math.ceil(box_w / aspect))
+        y = max(min(candidates, key=lambda n: 0 if n == 0 else abs(aspect - box_w / n)), 1)
+        return box_w, y
+    
+    def read_image_headers(self, image_list):
+        """读取图片头得到缩略图尺寸（Image.open 是惰性的，不会解码像素）"""
+        headers = []
+        for _, path, name, _ in image_list:
+            try:
+                with Image.open(path) as img:
+                    width, height = self.predict_thumbnail_size(img.width, img.height)
+            except Exception:
+                continue
+            headers.append(ImageHeader(path, name, width, height))
+        return headers
+    
     def split_into_rows(self, thumbnails, start_idx=0):
         """将缩略图分成多行，返回(行列表, 消耗的图片数)"""
         rows = []
@@ -113,6 +182,48 @@ class ThumbnailMaker:
                 x += img.width
             y += row_heights[row_idx]
         
+        return self._save_montage(canvas, montage_index, first_image_name)
+    
+    def create_montage_streaming(self, rows, montage_index, first_image_name):
+        """
+        流式创建拼接图：rows 中只有图片头信息，逐行解码、粘贴后立即释放
+        
+        解码失败的图片位置留空（黑色），不影响其他图片的布局
+        """
+        total_images = sum(len(row) for row in rows)
+        if total_images < 2:
+            return None
+        
+        row_heights = [max(h.height for h in row) for row in rows]
+        row_widths = [sum(h.width for h in row) for row in rows]
+        canvas_width = max(row_widths)
+        canvas_height = sum(row_heights)
+        canvas_bytes = canvas_width * canvas_height * 3
+        
+        canvas = Image.new('RGB', (canvas_width, canvas_height))
+        
+        y = 0
+        for row_idx, row in enumerate(rows):
+            row_thumbs = [self.create_thumbnail(h.path) for h in row]
+            self.est_peak_bytes = max(self.est_peak_bytes, canvas_bytes + sum(
+                t.width * t.height * 3 for t in row_thumbs if t))
+            
+            x = 0
+            for header, thumb in zip(row, row_thumbs):
+                if thumb:
+                    if thumb.size != (header.width, header.height):
+                        thumb = thumb.resize((header.width, header.height), Image.Resampling.LANCZOS)
+                    canvas.paste(thumb, (x, y))
+                x += header.width
+            
+            # 粘贴完立即释放本行缩略图
+            del row_thumbs
+            y += row_heights[row_idx]
+        
+        return self._save_montage(canvas, montage_index, first_image_name)
+    
+    def _save_montage(self, canvas, montage_index, first_image_name):
+        """保存拼接图"""
         first_name_base = os.path.splitext(first_image_name)[0]
         output_filename = f'{self.tag}_{montage_index}_{first_name_base}.jpg'
         output_path = os.path.join(self.target_dir, output_filename)
@@ -120,40 +231,42 @@ class ThumbnailMaker:
         try:
             # 使用较高质量但不过度优化（optimize=False 更快）
             canvas.save(output_path, 'JPEG', quality=85)
+            self.outputs.append(output_filename)
             return output_path
         except Exception as e:
             print(f'{self.tag}: 保存失败: {e}')
             return None
     
-    def delete_old_thumbnails(self):
+    def delete_old_thumbnails(self, old_files=None):
         """删除该tag的所有旧缩略图
         
         文件名格式: tag_id_name.jpg
         通过找到最后两个下划线来提取tag名称
+        
+        Args:
+            old_files: 预先扫描得到的旧缩略图路径列表（批量模式使用，避免每个tag都扫描sample目录）
         """
         deleted_count = 0
         
+        if old_files is not None:
+            for path in old_files:
+                try:
+                    os.remove(path)
+                    deleted_count += 1
+                except Exception:
+                    pass
+            if deleted_count > 0:
+                print(f'{self.tag}: Delete {deleted_count}')
+            return
+        
         try:
             with os.scandir(self.target_dir) as entries:
                 for entry in entries:
                     if not entry.is_file() or not entry.name.lower().endswith('.jpg'):
                         continue
                     
-                    name = entry.name
-                    # 找到最后两个下划线的位置
-                    last_underscore = name.rfind('_')
-                    if last_underscore == -1:
-                        continue
-                    
-                    second_last_underscore = name.rfind('_', 0, last_underscore)
-                    if second_last_underscore == -1:
-                        continue
-                    
-                    # 提取tag名称（从开头到倒数第二个下划线之前）
-                    file_tag = name[:second_last_underscore]
-                    
                     # 如果tag匹配，删除文件
-                    if file_tag == self.tag:
+                    if _sample_file_tag(entry.name) == self.tag:
                         try:
                             os.remove(entry.path)
                             deleted_count += 1
@@ -165,26 +278,44 @@ class ThumbnailMaker:
         if deleted_count > 0:
             print(f'{self.tag}: Delete {deleted_count}')
     
-    def process(self):
-        """执行完整流程：删除旧文件 -> 生成缩略图 -> 创建拼接图"""
-        self.delete_old_thumbnails()
+    def process(self, image_list=None, old_files=None):
+        """
+        执行完整流程：删除旧文件 -> 生成缩略图 -> 创建拼接图
         
-        image_paths, image_names = self.get_images_sorted_by_time()
-        if not image_paths:
-            return
+        Args:
+            image_list: 预先获取的最新图片列表（get_newest_images 的返回值）
+            old_files: 预先扫描得到的旧缩略图路径列表
+        
+        Returns:
+            int: 实际解码成功的图片数量（解码失败的、凑不成拼接图的不计）
+        """
+        self.delete_old_thumbnails(old_files)
+        self.decoded = 0
+        self.outputs = []
+        
+        if image_list is None:
+            image_list = self.get_newest_images()
+        if not image_list:
+            return 0
+        
+        if self.streaming:
+            self._process_streaming(image_list)
+            return self.decoded
         
         # 批量创建缩略图
         thumbnails = []
         valid_names = []
         
-        for path, name in zip(image_paths, image_names):
+        for _, path, name, _ in image_list:
             thumb = self.create_thumbnail(path)
             if thumb:
                 thumbnails.append(thumb)
                 valid_names.append(name)
         
         if len(thumbnails) < 2:
-            return
+            return self.decoded
+        
+        thumbs_bytes = sum(t.width * t.height * 3 for t in thumbnails)
         
         # 创建拼接图
         created_count = 0
@@ -196,10 +327,183 @@ class ThumbnailMaker:
             if sum(len(row) for row in rows) < 2:
                 break
             
+            canvas_bytes = max(sum(t.width for t in row) for row in rows) * \
+                sum(max(t.height for t in row) for row in rows) * 3
+            self.est_peak_bytes = max(self.est_peak_bytes, thumbs_bytes + canvas_bytes)
+            
             if self.create_montage(rows, created_count + 1, valid_names[thumb_idx]):
                 created_count += 1
             
             thumb_idx += consumed
+        
+        return self.decoded
+    
+    def _process_streaming(self, image_list):
+        """流式流程：先用图片头计算布局，再逐张拼接图、逐行解码"""
+        headers = self.read_image_headers(image_list)
+        if len(headers) < 2:
+            return
+        
+        created_count = 0
+        header_idx = 0
+        
+        while header_idx < len(headers):
+            rows, consumed = self.split_into_rows(headers, header_idx)
+            
+            if sum(len(row) for row in rows) < 2:
+                break
+            
+            if self.create_montage_streaming(rows, created_count + 1, headers[header_idx].name):
+                created_count += 1
+            
+            header_idx += consumed
+
+
+def _sample_file_tag(name):
+    """从缩略图文件名 tag_id_name.jpg 中提取tag（找到最后两个下划线）"""
+    last_underscore = name.rfind('_')
+    if last_underscore == -1:
+        return None
+    
+    second_last_underscore = name.rfind('_', 0, last_underscore)
+    if second_last_underscore == -1:
+        return None
+    
+    # 提取tag名称（从开头到倒数第二个下划线之前）
+    return name[:second_last_underscore]
+
+
+def _index_sample_files(target_dir):
+    """扫描一次sample目录，按tag分组 {tag: [path, ...]}"""
+    index = {}
+    try:
+        with os.scandir(target_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith('.jpg'):
+                    continue
+                file_tag = _sample_file_tag(entry.name)
+                if file_tag:
+                    index.setdefault(file_tag, []).append(entry.path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f'扫描目录失败 {target_dir}: {e}')
+    return index
+
+
+def _list_tag_folders(gelbooru_path):
+    """列出所有tag文件夹（排除 sample 和 new）"""
+    excluded = {'sample', os.path.basename(os.path.normpath(config['path']['new']))}
+    tags = []
+    try:
+        with os.scandir(gelbooru_path) as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.name not in excluded:
+                    tags.append(entry.name)
+    except Exception as e:
+        print(f'扫描文件夹失败 {gelbooru_path}: {e}')
+    return sorted(tags)
+
+
+def _outputs_present(last, image_list, old_files):
+    """上次生成的拼接图是否都还在 sample 目录（旧版指纹只有字符串，没有文件名时按"至少有一张"判断）"""
+    existing = {os.path.basename(path) for path in old_files}
+    if isinstance(last, dict):
+        return set(last.get('outputs', [])) <= existing
+    return bool(existing) or len(image_list) < 2
+
+
+def _regenerate_tag(tag, last, old_files, force=False):
+    """
+    进程池工作函数：重建单个tag的拼接图
+    
+    输入指纹相同且上次生成的拼接图都还在时跳过（拼接图被删除的会重建）
+    
+    Args:
+        last: 上次的指纹记录 {'fingerprint', 'outputs'}（旧版为指纹字符串）
+    
+    Returns:
+        tuple: (tag, 指纹记录, decoded_count, skipped)
+    """
+    maker = ThumbnailMaker(tag)
+    image_list = maker.get_newest_images()
+    fingerprint = maker.fingerprint(image_list)
+    last_fingerprint = last.get('fingerprint') if isinstance(last, dict) else last
+    
+    if not force and fingerprint == last_fingerprint and _outputs_present(last, image_list, old_files):
+        outputs = last['outputs'] if isinstance(last, dict) else sorted(os.path.basename(p) for p in old_files)
+        return tag, {'fingerprint': fingerprint, 'outputs': outputs}, 0, True
+    
+    decoded = maker.process(image_list, old_files)
+    return tag, {'fingerprint': fingerprint, 'outputs': maker.outputs}, decoded, False
+
+
+def regenerate_all(workers=None, force=False):
+    """
+    批量重建所有tag的拼接图（多进程）
+    
+    - 进程池大小默认为CPU核心数
+    - 指纹（最新N张图片列表 + 参数）与上次相同、且上次生成的拼接图都还在的tag直接跳过
+    - 指纹和生成的文件名保存在 sample/.fingerprints.json
+    
+    Args:
+        workers: 进程数，None 使用 os.cpu_count()
+        force: True 忽略指纹，全部重建
+    
+    Returns:
+        dict: 统计信息
+    """
+    gelbooru_path = config['path']['Gelbooru']
+    target_dir = os.path.join(gelbooru_path, 'sample')
+    os.makedirs(target_dir, exist_ok=True)
+    fingerprint_path = os.path.join(target_dir, FINGERPRINT_FILE)
+    
+    try:
+        fingerprints = read_json(fingerprint_path)
+    except Exception:
+        fingerprints = {}
+    
+    tags = _list_tag_folders(gelbooru_path)
+    sample_index = _index_sample_files(target_dir)
+    workers = workers or os.cpu_count() or 1
+    
+    stats = {'total': len(tags), 'rebuilt': 0, 'skipped': 0, 'failed': 0, 'decoded': 0}
+    print(f"共 {len(tags)} 个tag，进程数: {workers}")
+    
+    start_time = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_regenerate_tag, tag, fingerprints.get(tag),
+                            sample_index.get(tag, []), force): tag
+            for tag in tags
+        }
+        
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            tag = futures[future]
+            try:
+                _, entry, decoded, skipped = future.result()
+            except Exception as e:
+                stats['failed'] += 1
+                print(f'{tag}: 缩略图重建失败: {e}')
+                continue
+            
+            fingerprints[tag] = entry
+            stats['decoded'] += decoded
+            stats['skipped' if skipped else 'rebuilt'] += 1
+            
+            # 定期保存指纹，中断后可以从断点继续
+            if done % 200 == 0:
+                write_json(fingerprint_path, fingerprints)
+                elapsed = time.time() - start_time
+                print(f'[{done}/{len(tags)}] {done / elapsed:.1f} tags/s')
+    
+    write_json(fingerprint_path, fingerprints)
+    
+    elapsed = time.time() - start_time
+    stats['elapsed'] = elapsed
+    stats['tags_per_sec'] = len(tags) / elapsed if elapsed > 0 else 0
+    stats['images_per_sec'] = stats['decoded'] / elapsed if elapsed > 0 else 0
+    return stats
 
 
 def main(tag):
@@ -207,5 +511,23 @@ def main(tag):
     ThumbnailMaker(tag).process()
 
 
+def benchmark(tag):
+    """对比一次性拼接和流式拼接的耗时与像素内存峰值（估算）"""
+    for streaming in (False, True):
+        maker = ThumbnailMaker(tag, streaming=streaming)
+        start = time.time()
+        decoded = maker.process()
+        elapsed = time.time() - start
+        label = 'streaming' if streaming else 'eager'
+        print(f'{tag} [{label}]: {decoded} images  {elapsed:.2f}s  '
+              f'est. peak {maker.est_peak_bytes / 1024 / 1024:.1f} MB')
+
+
 if __name__ == '__main__':
-    main('cinamon_(cinamori)')
+    import sys
+    
+    # python sampletag.py bench {tag}  -> 对比两种拼接方式
+    if len(sys.argv) > 2 and sys.argv[1] == 'bench':
+        benchmark(sys.argv[2])
+    else:
+        main('cinamon_(cinamori)')
@@ -1,7 +1,10 @@
 # 标签管理模块
 import os
 import json
-from core import config, get_database, load_tag_mapping
+import heapq
+import threading
+from operator import itemgetter
+from core import config, get_database, get_tag_mapping
 
 
 # ==================== 文件读写工具 ====================
@@ -91,6 +94,154 @@ def delete_tagjson(tag):
     db.delete_tag_progress(tag)
 
 
+# ==================== 标签下载记录（Gelbooru/{tag}/tags.txt）====================
+#
+# 文件格式（增量清单）:
+#   #sorted 0000012345 000001234567      <- 头：已排序部分的行数、整理后的文件字节数
+#   ...已去重、按ID降序排列的记录...
+#   ...整理之后追加的记录（未排序）...
+#
+# 整理时如果文件大小与头中记录的字节数相同，说明没有新追加的记录，直接返回；
+# 否则只对追加部分去重排序，再与已排序部分线性归并。
+# 没有头的旧文件视为全部是追加部分，第一次整理后自动转换为新格式。
+
+MANIFEST_HEADER = '#sorted'
+_MANIFEST_HEADER_FMT = MANIFEST_HEADER + ' {:010d} {:012d}'
+
+
+def _parse_manifest_line(line):
+    """
+    规范化一行下载记录
+    
+    Returns:
+        tuple: (pic_id, line)，无效行返回 None
+    """
+    line = line.strip().replace(' - Image View -  |', '')
+    if not line or '|' not in line:
+        return None
+    
+    parts = line.split('|')
+    if len(parts) < 4:
+        return None
+    
+    # 检查 ID 是否为数字
+    try:
+        return int(parts[3]), line
+    except ValueError:
+        return None
+
+
+def _read_manifest_header(tagpath):
+    """读取清单头，返回 (已排序行数, 整理后字节数)，没有头返回 None"""
+    try:
+        with open(tagpath, 'r', encoding='utf-8') as f:
+            first = f.readline()
+    except FileNotFoundError:
+        return None
+    
+    if not first.startswith(MANIFEST_HEADER):
+        return None
+    try:
+        _, count, size = first.split()
+        return int(count), int(size)
+    except ValueError:
+        return None
+
+
+def _read_manifest(tagpath):
+    """读取清单，返回 (已排序部分, 追加部分)"""
+    with open(tagpath, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    
+    if not lines or not lines[0].startswith(MANIFEST_HEADER):
+        return [], lines
+    
+    try:
+        sorted_count = int(lines[0].split()[1])
+    except (IndexError, ValueError):
+        return [], lines[1:]
+    return lines[1:sorted_count + 1], lines[sorted_count + 1:]
+
+
+def _merge_manifest(base, delta):
+    """
+    将追加部分归并到已排序部分（结果与整体去重后按ID降序稳定排序完全一致）
+    
+    - 重复行保留最后一次出现的位置（追加部分中的行优先于已排序部分）
+    - ID相同的行按出现顺序排列
+    """
+    seen = set()
+    delta_items = []
+    for raw in reversed(delta):
+        item = _parse_manifest_line(raw)
+        if item is None or item[1] in seen:
+            continue
+        seen.add(item[1])
+        delta_items.append(item)
+    delta_items.reverse()
+    delta_items.sort(key=itemgetter(0), reverse=True)
+    
+    base_items = ((int(line.split('|')[3]), line) for line in base if line not in seen)
+    return [line for _, line in heapq.merge(base_items, delta_items, key=itemgetter(0), reverse=True)]
+
+
+def _write_manifest(tagpath, lines):
+    """原子写入清单（先写临时文件再替换），头中记录行数和文件字节数"""
+    tmp_path = tagpath + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(_MANIFEST_HEADER_FMT.format(0, 0) + '\n')
+        if lines:
+            f.write('\n'.join(lines) + '\n')
+    
+    # 头是定宽的，写完后回填真实的字节数（Windows下换行为\r\n，只能写完再取大小）
+    size = os.path.getsize(tmp_path)
+    with open(tmp_path, 'r+b') as f:
+        f.write(_MANIFEST_HEADER_FMT.format(len(lines), size).encode('utf-8'))
+    
+    os.replace(tmp_path, tagpath)
+
+
+def compact_tag_manifest(tagpath):
+    """
+    整理下载记录：没有追加内容时只读取文件头，否则只归并追加部分
+    
+    Args:
+        tagpath: tags.txt 路径
+    """
+    try:
+        size = os.path.getsize(tagpath)
+    except FileNotFoundError:
+        return  # 文件不存在，无需整理
+    
+    header = _read_manifest_header(tagpath)
+    if header and header[1] == size:
+        return  # 没有新追加的记录
+    
+    base, delta = _read_manifest(tagpath)
+    _write_manifest(tagpath, _merge_manifest(base, delta))
+
+
+def read_tag_manifest(tag):
+    """
+    读取标签的下载记录（去重、按ID降序），内容与整理后的 tags.txt 一致
+    
+    Args:
+        tag: 标签名（retag，已经过特殊字符替换）
+    
+    Returns:
+        list: 记录行列表（格式：tag|time|filename|id|tags），文件不存在返回 []
+    """
+    tagpath = os.path.join(config['path']['Gelbooru'], tag, 'tags.txt')
+    try:
+        base, delta = _read_manifest(tagpath)
+    except FileNotFoundError:
+        return []
+    
+    if not delta:
+        return base
+    return _merge_manifest(base, delta)
+
+
 def update_tags(tag, line, mode='a'):
     """
     更新标签的下载记录文件
@@ -114,51 +265,100 @@ def update_tags(tag, line, mode='a'):
             print(f'写入标签记录失败 {tagpath}: {e}')
     
     elif mode == 'u':
-        # 整理模式：去重、排序
+        # 整理模式：增量归并去重、排序
         try:
-            with open(tagpath, 'r', encoding='utf-8') as f:
-                lines = [l.strip().replace(' - Image View -  |', '') for l in f if l.strip()]
-        except FileNotFoundError:
-            return  # 文件不存在，无需整理
+            compact_tag_manifest(tagpath)
         except Exception as e:
-            print(f'读取标签记录失败 {tagpath}: {e}')
-            return
+            print(f'整理标签记录失败 {tagpath}: {e}')
+
+
+class ExpireTagCollector:
+    """
+    过期/失效标签收集器（线程安全）
+    
+    - 运行期间在内存中累积过期tag，nulltag 只在 flush() 时写入一次
+    - deadtag 列表和现有 nulltag 列表只读取一次
+    - 维护过期tag计数，统计时不再重新读取文件
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}         # 待写入的tag（dict保持添加顺序）
+        self._existing = None      # nulltag 文件中已有的tag列表
+        self._existing_set = None
+        self._dead_tags = None     # deadtag 集合
+        self._new_count = 0        # pending 中不在 nulltag 文件里的tag数
+    
+    def _load(self):
+        """首次使用时读取 nulltag 和 deadtag（调用方持有锁）"""
+        if self._existing is None:
+            self._existing = [t for t in readfile(config['path']['nulltag']) if t]
+            self._existing_set = set(self._existing)
+            self._dead_tags = set(readfile(config['path']['deadtag']))
+            self._new_count = sum(1 for t in self._pending if t not in self._existing_set)
+    
+    def add(self, expire_tag):
+        """
+        添加过期tag
         
-        # 去重（保留最后出现的）
-        seen = set()
-        unique_lines = []
+        - 如果是 replace_tag，转换为 original_tag
+        - 已在 deadtag 中的tag不添加
+        - 重复添加的tag移动到末尾（与逐个写文件时的顺序一致）
+        """
+        final_tag = get_tag_mapping().get_original(expire_tag)
         
-        for line in reversed(lines):
-            if not line or '|' not in line:
-                continue
+        with self._lock:
+            self._load()
+            if final_tag in self._dead_tags:
+                return
             
-            parts = line.split('|')
-            if len(parts) < 4:
-                continue
+            if final_tag in self._pending:
+                del self._pending[final_tag]
+            elif final_tag not in self._existing_set:
+                self._new_count += 1
+            self._pending[final_tag] = None
+    
+    def count(self):
+        """当前过期tag总数（nulltag 文件 + 尚未写入的部分）"""
+        with self._lock:
+            self._load()
+            return len(self._existing_set) + self._new_count
+    
+    def flush(self):
+        """将累积的过期tag一次性写入 nulltag"""
+        with self._lock:
+            if not self._pending:
+                return
+            self._load()
             
-            # 检查 ID 是否为数字
-            try:
-                pic_id = int(parts[3])
-            except ValueError:
-                continue
+            tag_list = [t for t in self._existing if t not in self._pending]
+            tag_list.extend(self._pending)
+            writefile(config['path']['nulltag'], tag_list)
             
-            if line not in seen:
-                seen.add(line)
-                unique_lines.insert(0, line)
-        
-        # 按 ID 降序排序
-        unique_lines.sort(key=lambda x: int(x.split('|')[3]), reverse=True)
-        
-        # 写回文件
-        try:
-            writefile(tagpath, unique_lines)
-        except Exception as e:
-            print(f'整理标签记录失败 {tagpath}: {e}')
+            self._existing = tag_list
+            self._existing_set = set(tag_list)
+            self._pending = {}
+            self._new_count = 0
+    
+    def reset(self):
+        """丢弃缓存（nulltag/deadtag 被外部修改后调用，下次使用时重新读取）"""
+        with self._lock:
+            self._existing = None
+            self._existing_set = None
+            self._dead_tags = None
+
+
+_expire_collector = ExpireTagCollector()
+
+
+def get_expire_collector():
+    """获取过期tag收集器"""
+    return _expire_collector
 
 
 def add_expire_tag(expire_tag):
     """
-    添加过期/失效标签到 nulltag 列表
+    添加过期/失效标签到 nulltag 列表（只记录到内存，由 flush_expire_tags 统一写入）
     
     功能：
     - 检查是否为 replace_tag，如果是则转换为 original_tag
@@ -168,38 +368,241 @@ def add_expire_tag(expire_tag):
     Args:
         expire_tag: 过期的标签名（可能是 original_tag 或 replace_tag）
     """
-    nulltag_path = config['path']['nulltag']
-    deadtag_path = config['path']['deadtag']
+    _expire_collector.add(expire_tag)
+
+
+def flush_expire_tags():
+    """将本次运行收集的过期标签写入 nulltag 文件（运行结束和进度检查点时调用，没有新标签时不写）"""
+    try:
+        _expire_collector.flush()
+    except Exception as e:
+        print(f'写入过期标签失败: {e}')
+
+
+# ==================== input 文件引擎 ====================
+#
+# input.txt 格式:
+#   TAG ...                       <- 标题行（忽略）
+#   tag [endpage] [start_pic] [end_pic]
+#   done tag ...                  <- 已完成
+#
+# 文件只解析一次，之后仅在 mtime/size 变化时重新解析；
+# done 标记、进度删除、tags.txt 追加在内存中累积，由 flush() 统一写入。
+
+def _parse_input_line(line):
+    """
+    解析 input 文件的一行
     
-    # 加载 tag 映射关系（replace_tag -> original_tag）
-    tag_mapping = load_tag_mapping(reverse=True)
+    Returns:
+        tuple: (tag, done, params) 或 None（空行/标题行）
+               params 为 (endpage, start_pic, end_pic)，done 行为 None
+    """
+    line = line.strip()
+    if not line or line.startswith('TAG'):
+        return None
+    
+    parts = line.split()
+    if parts[0] == 'done':
+        return (parts[1], True, None) if len(parts) > 1 else None
+    
+    # 补全参数：tag [endpage] [start_pic] [end_pic]
+    if len(parts) == 1:
+        parts.extend(['1', '0', '0'])
+    elif len(parts) == 2:
+        parts.extend(['0', '0'])
+    elif len(parts) == 3:
+        parts.append('0')
     
-    # 如果是 replace_tag，转换为 original_tag
-    final_tag = tag_mapping.get(expire_tag, expire_tag)
+    try:
+        params = (int(parts[1]), int(parts[2]), str(parts[3]))
+    except ValueError:
+        return None
+    return (parts[0], False, params)
+
+
+def _remove_start_files(tag, verbose=False):
+    """删除标签的 .start 文件（支持多种格式）"""
+    new_path = config['path']['new']
+    replace_tag = tag.replace('/', '_').replace('\\', '_')
+    start_patterns = [
+        os.path.join(new_path, f'zzz{replace_tag}.start'),
+        os.path.join(new_path, f'{tag}.start'),
+        os.path.join(new_path, f'zzztag{replace_tag}.start')
+    ]
     
-    # 读取 deadtag 列表（排除已标记为永久失效的tag）
-    dead_tags = set(readfile(deadtag_path))
+    for start_file in start_patterns:
+        if os.path.exists(start_file):
+            try:
+                os.remove(start_file)
+                if verbose:
+                    print(f"  ✓ 删除启动文件: {os.path.basename(start_file)}")
+            except Exception as e:
+                if verbose:
+                    print(f"  ⚠️  删除启动文件失败: {e}")
+
+
+class InputFile:
+    """
+    input.txt 处理引擎（线程安全）
     
-    # 如果 tag 已在 deadtag 中，不添加到 nulltag
-    if final_tag in dead_tags:
-        return
+    - 文件解析为内存模型（原始行 + 解析结果），只在 mtime/size 变化时重新解析
+    - refresh() 只做一次 stat，适合 Mode 1 每秒轮询
+    - mark_done() 只修改内存，flush() 时依次：原子替换 input 文件、批量删除进度、批量追加 tags.txt
+    """
     
-    # 读取现有 nulltag 列表
-    tags = readfile(nulltag_path)
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._path = None
+        self._stat = None          # (mtime_ns, size)
+        self._lines = []           # 原始行（不含空行）
+        self._entries = []         # [(行号, tag, done, params)]
+        self._pending_done = {}    # 待写入的完成tag（dict保持顺序）
+        self.generation = 0        # 每次重新解析 +1
     
-    # 去重并添加到末尾
-    tag_list = [t for t in tags if t and t != final_tag]
-    tag_list.append(final_tag)
+    def _stat_file(self):
+        try:
+            st = os.stat(self._path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+    
+    def _parse(self, stat):
+        """读取并解析文件（调用方持有锁）"""
+        self._lines = [line for line in readfile(self._path) if line.strip()]
+        self._entries = []
+        for i, line in enumerate(self._lines):
+            parsed = _parse_input_line(line)
+            if parsed:
+                self._entries.append((i,) + parsed)
+        self._stat = stat
+        self.generation += 1
+        
+        # 文件被外部修改后，重新应用尚未写入的 done 标记
+        if self._pending_done:
+            for tag in self._pending_done:
+                self._apply_done(tag)
+    
+    def _apply_done(self, tag):
+        """在内存模型中给 tag 的行加上 done 前缀（调用方持有锁）"""
+        for k, (i, entry_tag, done, params) in enumerate(self._entries):
+            if entry_tag == tag and not done:
+                self._lines[i] = f'done {self._lines[i]}'
+                self._entries[k] = (i, entry_tag, True, None)
+    
+    def refresh(self):
+        """
+        检查文件是否变化，变化时重新解析
+        
+        Returns:
+            bool: 是否重新解析
+        """
+        with self._lock:
+            path = config['path']['input']
+            if path != self._path:
+                self._path = path
+                self._stat = None
+            
+            stat = self._stat_file()
+            if self._stat is not None and stat == self._stat:
+                return False
+            self._parse(stat)
+            return True
+    
+    def active_entries(self):
+        """未完成的条目 [(tag, (endpage, start_pic, end_pic)), ...]"""
+        with self._lock:
+            self.refresh()
+            return [(tag, params) for _, tag, done, params in self._entries if not done]
+    
+    def done_tags(self):
+        """已完成的条目 [tag, ...]"""
+        with self._lock:
+            self.refresh()
+            return [tag for _, tag, done, _ in self._entries if done]
+    
+    def mark_done(self, tag):
+        """标记 tag 为完成（只修改内存，flush 时写入）"""
+        with self._lock:
+            self.refresh()
+            self._apply_done(tag)
+            self._pending_done[tag] = None
+    
+    def _write(self, lines):
+        """原子替换 input 文件（调用方持有锁）"""
+        tmp_path = self._path + '.tmp'
+        writefile(tmp_path, lines)
+        os.replace(tmp_path, self._path)
+        self._stat = self._stat_file()
+    
+    def flush(self):
+        """
+        写入累积的修改
+        
+        Returns:
+            list: 本次写入的完成tag
+        """
+        with self._lock:
+            if not self._pending_done:
+                return []
+            
+            # 写入前确认文件未被外部修改（修改过则重新解析并应用 done 标记）
+            if self._stat_file() != self._stat:
+                self._parse(self._stat_file())
+            
+            done_list = list(self._pending_done)
+            self._pending_done = {}
+            
+            # 1. input 文件
+            self._write(self._lines)
+            
+            # 2. 数据库进度
+            get_database().delete_tag_progress_many(done_list)
+            
+            # 3. .start 文件
+            for tag in done_list:
+                _remove_start_files(tag, verbose=True)
+            
+            # 4. tags.txt（只追加未存在的）
+            try:
+                added = _tag_catalog.append_missing(done_list)
+                if added:
+                    print(f"  ✓ 已将 {added} 个标签添加到 tags.txt")
+            except Exception as e:
+                print(f"  ⚠️  添加到 tags.txt 失败: {e}")
+            
+            return done_list
     
-    # 写回
-    writefile(nulltag_path, tag_list)
+    def remove_done(self):
+        """删除所有 done 行"""
+        with self._lock:
+            self.flush()
+            self.refresh()
+            done_rows = {i for i, _, done, _ in self._entries if done}
+            self._write([line for i, line in enumerate(self._lines) if i not in done_rows])
+            self._parse(self._stat)
+
+
+_input_file = InputFile()
+
+
+def get_input_file():
+    """获取 input 文件引擎"""
+    return _input_file
+
+
+def flush_input():
+    """写入 input 文件引擎累积的修改"""
+    try:
+        _input_file.flush()
+    except Exception as e:
+        print(f'写入 input 文件失败: {e}')
 
 
 def set_input_done(tag):
     """
     标记标签为已完成（在 input 文件中添加 done 前缀）
     
-    功能：
+    只修改内存模型，由 flush_input() 统一完成：
     1. 在 input.txt 中添加 done 前缀
     2. 从数据库删除进度记录
     3. 删除 .start 文件（如果存在）
@@ -208,112 +611,149 @@ def set_input_done(tag):
     Args:
         tag: 标签名
     """
-    import os
-    import glob
-    
-    input_path = config['path']['input']
-    new_path = config['path']['new']
+    _input_file.mark_done(tag)
+
+
+# ==================== 标签轮换目录（tags.txt）====================
+#
+# tags.txt 是 Mode 3 的轮换队列，数据以数据库 tag_catalog 表为准：
+# - 每个进程首次使用时，若 tags.txt 在上次导出后被外部修改（或目录为空），按文件重新导入
+# - 移到末尾 / 插到开头都是单条 UPSERT
+# - 修改后只标记 dirty，由 flush_tags() 统一导出到 tags.txt
+
+TAGS_TXT_STATE_KEY = 'tags_txt_stat'
+
+
+class TagCatalog:
+    """标签轮换目录（线程安全）"""
     
-    # 1. 读取所有行
-    try:
-        lines = readfile(input_path)
-    except Exception:
-        return
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._synced = False
+        self._dirty = False
     
-    # 2. 修改对应行
-    modified_lines = []
-    for line in lines:
-        if not line:
-            continue
+    @staticmethod
+    def _file_stat(path):
+        try:
+            st = os.stat(path)
+            return f'{st.st_mtime_ns}:{st.st_size}'
+        except OSError:
+            return None
+    
+    @staticmethod
+    def _read_file(path):
+        """读取 tags.txt 并去重（保留首次出现的位置）"""
+        return list(dict.fromkeys(tag.strip() for tag in readfile(path) if tag.strip()))
+    
+    def _sync(self):
+        """首次使用时与 tags.txt 同步（调用方持有锁）"""
+        if self._synced:
+            return
+        db = get_database()
+        path = config['path']['tags']
+        stat = self._file_stat(path)
+        if stat is not None and (stat != db.get_state(TAGS_TXT_STATE_KEY) or db.get_catalog_count() == 0):
+            tags = self._read_file(path)
+            db.replace_catalog(tags)
+            db.set_state(TAGS_TXT_STATE_KEY, stat)
+            print(f'已从 tags.txt 导入 {len(tags)} 个标签')
+        self._synced = True
+    
+    def tags(self):
+        """按轮换顺序返回所有标签"""
+        with self._lock:
+            self._sync()
+            return get_database().get_catalog_tags()
+    
+    def move_to_end(self, tags):
+        """将标签移到末尾（不存在的追加）"""
+        with self._lock:
+            self._sync()
+            if get_database().catalog_move_to_end(list(tags)):
+                self._dirty = True
+    
+    def prepend(self, tags):
+        """将标签插到开头（已存在的移到开头）"""
+        with self._lock:
+            self._sync()
+            if get_database().catalog_prepend(list(tags)):
+                self._dirty = True
+    
+    def append_missing(self, tags):
+        """
+        追加目录中不存在的标签
         
-        parts = line.split()
-        if parts and parts[0] == tag:
-            modified_lines.append(f'done {line}')
-        else:
-            modified_lines.append(line)
-    
-    # 3. 写回
-    writefile(input_path, modified_lines)
-    
-    # 4. 从数据库删除
-    delete_tagjson(tag)
-    
-    # 5. 删除 .start 文件（支持多种格式）
-    replace_tag = tag.replace('/', '_').replace('\\', '_')
-    start_patterns = [
-        os.path.join(new_path, f'zzz{replace_tag}.start'),
-        os.path.join(new_path, f'{tag}.start'),
-        os.path.join(new_path, f'zzztag{replace_tag}.start')
-    ]
-    
-    for start_file in start_patterns:
-        if os.path.exists(start_file):
-            try:
-                os.remove(start_file)
-                print(f"  ✓ 删除启动文件: {os.path.basename(start_file)}")
-            except Exception as e:
-                print(f"  ⚠️  删除启动文件失败: {e}")
-    
-    # 6. 将 tag 添加到 tags.txt（如果未存在）
+        Returns:
+            int: 实际追加的数量
+        """
+        with self._lock:
+            self._sync()
+            added = get_database().catalog_append_missing(list(tags))
+            if added:
+                self._dirty = True
+            return added
+    
+    def flush(self):
+        """导出到 tags.txt（原子替换）"""
+        with self._lock:
+            if not self._dirty:
+                return
+            path = config['path']['tags']
+            tmp_path = path + '.tmp'
+            writefile(tmp_path, get_database().get_catalog_tags())
+            os.replace(tmp_path, path)
+            get_database().set_state(TAGS_TXT_STATE_KEY, self._file_stat(path))
+            self._dirty = False
+    
+    def reset(self):
+        """下次使用时重新检查 tags.txt"""
+        with self._lock:
+            self._synced = False
+
+
+_tag_catalog = TagCatalog()
+
+
+def get_tag_catalog():
+    """获取标签轮换目录"""
+    return _tag_catalog
+
+
+def flush_tags():
+    """将标签目录的修改导出到 tags.txt"""
     try:
-        tags_list = read_tags()
-        if tag not in tags_list:
-            add_tags([tag])
-            print(f"  ✓ 已将 {tag} 添加到 tags.txt")
+        _tag_catalog.flush()
     except Exception as e:
-        print(f"  ⚠️  添加到 tags.txt 失败: {e}")
+        print(f'导出 tags.txt 失败: {e}')
 
 
-# ==================== 辅助函数（保持向后兼容）====================
-
 def read_tags():
     """
-    读取 tags.txt 并去重
+    按轮换顺序读取标签（已去重）
     
     Returns:
         list: 标签列表
     """
-    tags = readfile(config['path']['tags'])
-    
-    # 去重，保持顺序
-    seen = set()
-    unique_tags = []
-    for tag in tags:
-        tag = tag.strip()
-        if tag and tag not in seen:
-            seen.add(tag)
-            unique_tags.append(tag)
-    
-    return unique_tags
+    return _tag_catalog.tags()
 
 
 def add_tags(done_list):
     """
-    添加标签到 tags.txt 末尾（已存在的先移除再添加）
+    将标签移到轮换队列末尾（不存在的追加）
     
     Args:
         done_list: 标签列表
     """
-    tags = read_tags()
-    
-    # 移除已存在的标签
-    for tag in done_list:
-        while tag in tags:
-            tags.remove(tag)
-    
-    # 添加到末尾
-    tags.extend(done_list)
-    
-    # 写回
-    writefile(config['path']['tags'], tags)
+    _tag_catalog.move_to_end(done_list)
 
 
+# ==================== 辅助函数（保持向后兼容）====================
+
 def add_folder_tag():
     """
     扫描 Gelbooru 目录，将新文件夹添加为标签
     """
     folder_path = config['path']['Gelbooru']
-    list_file = config['path']['tags']
     exclude_file = config['path']['exauthor']
     dead_tag_file = config['path']['deadtag']
     
@@ -325,7 +765,7 @@ def add_folder_tag():
         exclude.update(readfile(dead_tag_file))
     
     # 读取已存在的标签
-    existing = set(readfile(list_file))
+    existing = set(read_tags())
     # 扫描文件夹
     new_folders = []
     try:
@@ -339,17 +779,12 @@ def add_folder_tag():
         print(f'扫描文件夹失败 {folder_path}: {e}')
         return
     
-    # 追加新标签（去重，避免重复添加）
+    # 追加新标签（已存在的不重复添加）
     if new_folders:
         try:
-            # 读取现有标签，避免重复
-            existing_tags = set(readfile(list_file))
-            to_add = [folder for folder in new_folders if folder not in existing_tags]
-            if to_add:
-                with open(list_file, 'a', encoding='utf-8') as f:
-                    for folder in to_add:
-                        f.write(folder + '\n')
-                print(f'添加了 {len(to_add)} 个新标签')
+            added = _tag_catalog.append_missing(new_folders)
+            if added:
+                print(f'添加了 {added} 个新标签')
         except Exception as e:
             print(f'写入标签失败: {e}')
 
@@ -361,78 +796,42 @@ def init_input(ind=0):
     功能：
     - 识别 done tag1 时：删除数据库记录 + 删除 .start 文件 + 添加到 tags.txt
     - 新tag：初始化到数据库
+    - input 文件只解析一次，数据库和 tags.txt 批量写入
     
     Args:
         ind: 索引（保留参数，向后兼容）
     """
-    import os
-    
     db = get_database()
-    tagjson = read_tagjson()
-    input_lines = readfile(config['path']['input'])
-    new_path = config['path']['new']
+    engine = get_input_file()
+    engine.flush()
     
     if ind == 0:
-        for line in input_lines:
-            line = line.strip()
-            if not line or line.startswith('TAG'):
-                continue
-            
-            # 处理 done 标记
-            if line.startswith('done '):
-                tag_name = line.split()[1] if len(line.split()) > 1 else None
-                if tag_name:
-                    # 删除数据库记录
-                    delete_tagjson(tag_name)
-                    
-                    # 删除 .start 文件
-                    replace_tag = tag_name.replace('/', '_').replace('\\', '_')
-                    start_patterns = [
-                        os.path.join(new_path, f'zzz{replace_tag}.start'),
-                        os.path.join(new_path, f'{tag_name}.start'),
-                        os.path.join(new_path, f'zzztag{replace_tag}.start')]
-                    
-                    for start_file in start_patterns:
-                        if os.path.exists(start_file):
-                            try:
-                                os.remove(start_file)
-                            except Exception:
-                                pass
-                    
-                    # 添加到 tags.txt（如果未存在）
-                    try:
-                        tags_list = read_tags()
-                        if tag_name not in tags_list:
-                            add_tags([tag_name])
-                    except Exception:
-                        pass
-                
-                continue
-            
-            # 解析标签配置
-            parts = line.split()
-            if not parts or parts[0] in tagjson:
-                continue
-            
-            # 补全参数：tag [endpage] [start_pic] [end_pic]
-            if len(parts) == 1:
-                parts.extend(['1', '0', '0'])
-            elif len(parts) == 2:
-                parts.extend(['0', '0'])
-            elif len(parts) == 3:
-                parts.append('0')
+        engine.refresh()
+        
+        # 处理 done 标记
+        done_list = list(dict.fromkeys(engine.done_tags()))
+        if done_list:
+            db.delete_tag_progress_many(done_list)
+            for tag_name in done_list:
+                _remove_start_files(tag_name)
             
-            # 添加到数据库
-            db.init_tag_progress(
-                tag=parts[0],
-                endpage=int(parts[1]),
-                start_pic=int(parts[2]),
-                end_pic=str(parts[3]),
-                status=0
-            )
+            # 添加到 tags.txt（如果未存在）
+            try:
+                _tag_catalog.append_missing(done_list)
+            except Exception:
+                pass
+        
+        # 新tag：添加到数据库
+        tagjson = read_tagjson()
+        rows = {}
+        for tag_name, (endpage, start_pic, end_pic) in engine.active_entries():
+            if tag_name not in tagjson:
+                rows[tag_name] = (tag_name, endpage, start_pic, end_pic, 0)
+        db.init_tag_progress_many(list(rows.values()))
     
     # 确保至少有一个条目（防止空数据库）
-    if not read_tagjson():
+    tagjson = read_tagjson()
+    if not tagjson:
         db.init_tag_progress(
             tag=' ',
             endpage=1,
@@ -440,38 +839,36 @@ def init_input(ind=0):
             end_pic='0',
             status=9
         )
+        tagjson = read_tagjson()
     
-    # 更新 tags.txt
-    tagjson = read_tagjson()
+    # 更新 tags.txt（只追加不存在的标签）
     active_tags = [tag for tag, info in tagjson.items() 
                    if info.get('status', 0) not in [7, 8, 9]]
     if active_tags:
         try:
-            with open(config['path']['tags'], 'a', encoding='utf-8') as f:
-                f.write('\n'.join(active_tags) + '\n')
+            _tag_catalog.append_missing(active_tags)
         except Exception as e:
             print(f'更新 tags.txt 失败: {e}')
 
 
 def del_input_done():
     """删除 input 文件中的 done 标记行"""
-    input_lines = readfile(config['path']['input'])
-    active_lines = [line for line in input_lines 
-                    if line and not line.startswith('done')]
-    writefile(config['path']['input'], active_lines)
+    get_input_file().remove_done()
 
 
 def add_dead_tag():
     """将过期标签合并到主标签列表"""
-    tags = readfile(config['path']['tags'])
-    expire_tags = readfile(config['path']['nulltag'])
+    # 先写入尚未落盘的过期标签
+    flush_expire_tags()
+    
+    expire_tags = [tag for tag in readfile(config['path']['nulltag']) if tag.strip()]
     
-    #合并（过期标签在前）
-    all_tags = expire_tags + tags
-    writefile(config['path']['tags'], all_tags)
+    # 合并（过期标签在前）
+    _tag_catalog.prepend(expire_tags)
     
     # 清空过期列表
     writefile(config['path']['nulltag'], [])
+    _expire_collector.reset()
 
 
 # ==================== 测试 ====================